@@ -1,58 +1,69 @@
 from PyQt5.QtCore import pyqtSlot, QByteArray
 from PyQt5 import QtBluetooth as QtBt
 
+import discovery
+import protocol
+
 SERVICE_UUID = "A7EA14CF-1000-43BA-AB86-1D6E136A2E9E"
 CHAR_UUID = "A7EA14CF-1100-43BA-AB86-1D6E136A2E9E"
+# Characteristic of the versioned frames, see protocol.py, preferred to CHAR_UUID when the sensor has it
+FRAME_CHAR_UUID = "A7EA14CF-1200-43BA-AB86-1D6E136A2E9E"
 
 
-def discovered_device(self, *args, **kwargs):
-    pass
-
-
-@pyqtSlot(QtBt.QBluetoothDeviceDiscoveryAgent.Error)
-def deviceScanError(self, error: QtBt.QBluetoothDeviceDiscoveryAgent.Error):
-    # print('Thread = {}          Function = deviceScanError()'.format(threading.currentThread().getName()))
-    print('Device scan error: ', error)
-
-
-@pyqtSlot()
-def deviceScanDone(self):
-    # print('Thread = {}          Function = deviceScanDone()'.format(threading.currentThread().getName()))
-    print("Device scan done.")
-    for obj in self.agent.discoveredDevices():
-        try:
-            uuids, completeness = obj.serviceUuids()
-            for uuid in uuids:
-                # print(uuid)
-                if SERVICE_UUID.lower() in uuid.toString():
-                    print("FOUND", uuid.toString(), ' in ', obj.name())
-                    self.BLE_device = obj
-                    self.BLE_UUID_service = uuid
-        except Exception as e:
-            print(e)
-    if self.BLE_device is not None:
-        print('Attempt to connect to device: ', self.BLE_device.name())
-        self.text_box.append(" > > >  Bluetooth device detected: {0} \n".format(str(self.BLE_device.name())))
-        self.controller = QtBt.QLowEnergyController.createCentral(self.BLE_device)
-        self.controller.connected.connect(self.deviceConnected)
-        self.controller.disconnected.connect(self.deviceDisconnected)
-        self.controller.error.connect(self.errorReceived)
-        self.controller.serviceDiscovered.connect(self.addLEservice)
-        self.controller.discoveryFinished.connect(self.serviceScanDone)
-        self.controller.setRemoteAddressType(QtBt.QLowEnergyController.PublicAddress)
-        self.controller.connectToDevice()
-    else:
-        print("Service not found.")
-    self.scanning = False
-
-
-@pyqtSlot()
-def scan_for_devices(self):
-    # print('Thread = {}          Function = scan_for_devices()'.format(threading.currentThread().getName()))
+def connect_ble_device(self, device):
+    # device is found by discovery.DeviceDiscovery, its info is the QBluetoothDeviceInfo and the service UUID
+    self.BLE_device, self.BLE_UUID_service = device.info
+    self.BLE_key = device.key
     self.BLE_scan_complete = False
-
-    self.scanning = True
-    self.agent.start()
+    print('Attempt to connect to device: ', self.BLE_device.name())
+    self.text_box.append(" > > >  Bluetooth device detected: {0} \n".format(str(self.BLE_device.name())))
+    self.controller = QtBt.QLowEnergyController.createCentral(self.BLE_device)
+    self.controller.connected.connect(self.deviceConnected)
+    self.controller.disconnected.connect(self.deviceDisconnected)
+    self.controller.error.connect(self.errorReceived)
+    self.controller.serviceDiscovered.connect(self.addLEservice)
+    self.controller.discoveryFinished.connect(self.serviceScanDone)
+    self.controller.setRemoteAddressType(QtBt.QLowEnergyController.PublicAddress)
+    self.controller.connectToDevice()
+
+
+def connect_cached_ble_device(self):
+    # The last sensor used is connected to without scanning, see ble_cache_failed for when it cannot be reached.
+    # Returns False when no sensor was used yet.
+    key = self.settings.value("ble_address", "")
+    if not key:
+        return False
+    name = self.settings.value("ble_name", "")
+    # The devices are identified by a UUID on macOS, by their address elsewhere
+    if key.startswith('{'):
+        info = QtBt.QBluetoothDeviceInfo(QtBt.QBluetoothUuid(key), name, 0)
+    else:
+        info = QtBt.QBluetoothDeviceInfo(QtBt.QBluetoothAddress(key), name, 0)
+    info.setCoreConfigurations(QtBt.QBluetoothDeviceInfo.LowEnergyCoreConfiguration)
+    service = QtBt.QBluetoothUuid(self.settings.value("ble_service", SERVICE_UUID))
+    print('Reconnect to the last device: ', name)
+    self.ble_cache_attempt = True
+    self.connect_ble_device(discovery.Device('BLE', key, 'BLE: {0}'.format(name), (info, service)))
+    self.ble_connect_timer.start()
+    return True
+
+
+def ble_cache_failed(self):
+    # The cached device did not answer, it is forgotten for this session and the devices are scanned
+    if not self.ble_cache_attempt:
+        return
+    print('Last device not reachable, scanning.')
+    self.ble_cache_attempt = False
+    self.ble_use_cache = False
+    self.ble_connect_timer.stop()
+    self.controller.blockSignals(True)
+    self.controller.disconnectFromDevice()
+    self.controller.deleteLater()
+    self.controller = None
+    self.BLE_device = None
+    self.BLE_service = None
+    self.BLE_characteristic = None
+    self.update_ble_discovery()
 
 
 @pyqtSlot()
@@ -68,29 +79,40 @@ def addLEservice(self, servUid):  # debugging purpose function, can delete later
 
 def errorReceived(self, error):
     print('BLE controller error: ', error)
+    self.ble_cache_failed()
 
 
 def deviceDisconnected(self):
     print("Device disconnected")
+    if self.ble_cache_attempt:
+        self.ble_cache_failed()
+        return
     self.BLE_device = None
     self.BLE_service = None
     self.BLE_characteristic = None
+    # Look for the device again
+    self.update_ble_discovery()
 
 
 @pyqtSlot()
 def serviceScanDone(self):
     print("Service scan done.")
 
-    for servicesUids in self.controller.services():
-        self.ble_service_uuid = QtBt.QBluetoothUuid(servicesUids)
-        print(self.ble_service_uuid.toString())
-        self.foundService = self.controller.createServiceObject(self.ble_service_uuid)
-        if self.foundService == None:
-            print("Service not created", self.ble_service_uuid.toString())
-        self.itemService.append(self.ble_service_uuid)
-
-    # print(self.itemService)
+    # Only the service of the sensor is opened, and its characteristics are discovered right away, so the
+    # acquisition starts without waiting for them
+    self.BLE_service = self.controller.createServiceObject(self.BLE_UUID_service)
+    if self.BLE_service is None:
+        print("ERR: Cannot open service", self.BLE_UUID_service.toString())
+        self.ble_cache_failed()
+        return
+    self.BLE_service.error.connect(self.handleServiceError)
+    self.BLE_service.characteristicChanged.connect(self.ble_callback)
     self.BLE_scan_complete = True
+    if self.BLE_service.state() == QtBt.QLowEnergyService.ServiceDiscovered:
+        self.handleServiceOpened(self.BLE_service.state())
+    else:
+        self.BLE_service.stateChanged.connect(self.handleServiceOpened)
+        self.BLE_service.discoverDetails()
 
     # for serv in self.controller.services():
     #     print(serv)
@@ -147,15 +169,45 @@ def handleServiceOpened(self, state):
     print('Service state: ', state)
     if self.BLE_service.state() == QtBt.QLowEnergyService.ServiceDiscovered:
         print('Characteristics:')
+        self.BLE_characteristic = None
+        self.ble_framed = False
+        # The characteristic used last time, when it is the same device. The frames are still preferred, the
+        # firmware of the sensor may have been updated since.
+        cached = self.settings.value("ble_characteristic", "") if self.ble_cache_attempt else ""
         for characteristic in self.BLE_service.characteristics():
             print(characteristic)
             print(characteristic.uuid().toString())
-            if CHAR_UUID.lower() in characteristic.uuid().toString():
+            if FRAME_CHAR_UUID.lower() in characteristic.uuid().toString():
+                self.BLE_characteristic = characteristic
+                self.ble_framed = True
+            elif CHAR_UUID.lower() in characteristic.uuid().toString() and not self.ble_framed:
                 self.BLE_characteristic = characteristic
 
         print(self.BLE_characteristic)
-
-        self.BLE_characteristic_ready.emit()
+        if self.ble_framed:
+            # Qt 5.14 and later report the MTU, the sensor sizes its frames to it
+            mtu = self.controller.mtu() if hasattr(self.controller, 'mtu') else 23
+            print("Framed data, MTU: {0}, up to {1} samples per frame".format(mtu, protocol.frame_capacity(mtu)))
+        if self.BLE_characteristic is None:
+            print("ERR: Characteristic not found\n")
+            self.ble_cache_failed()
+            return
+        if cached and cached != self.BLE_characteristic.uuid().toString():
+            print("Characteristic changed since the last connection: ", self.BLE_characteristic.uuid().toString())
+
+        if self.activeBLE:
+            # The acquisition started before the type of the packets was known, its counters are tracked anew
+            self.start_link_metrics(self.ble_counter_modulus())
+
+        # Remembered for the next connection, see connect_cached_ble_device
+        self.ble_connect_timer.stop()
+        self.ble_cache_attempt = False
+        self.ble_use_cache = True
+        self.settings.setValue("ble_address", self.BLE_key)
+        self.settings.setValue("ble_name", self.BLE_device.name())
+        self.settings.setValue("ble_service", self.BLE_UUID_service.toString())
+        self.settings.setValue("ble_characteristic", self.BLE_characteristic.uuid().toString())
+        self.ble_device_ready()
 
 
 @pyqtSlot()
@@ -165,7 +217,6 @@ def characteristic_ready(self):
     self.descriptor = self.BLE_characteristic.descriptor(self.type)
     # self.descriptor = self.BLE_characteristic.descriptors()[0]
     self.array = QByteArray(b'\x01\x00')  # turn on NOTIFY for characteristic
-    self.BLE_service.characteristicChanged.connect(self.ble_callback)
     self.BLE_service.writeDescriptor(self.descriptor, self.array)  # turn on NOTIFY
 
 
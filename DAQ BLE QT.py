@@ -1,29 +1,24 @@
+import startup  # first, so that the imports of the application are profiled
+
+startup.profile_imports()
+
 import logging
 import os
-import struct
 import sys
 import time
-import timeit
 import traceback
 import warnings
-import re
-from collections import deque
 from datetime import datetime
-from decimal import Decimal
-from math import log, exp
 # import os
 from pathlib import Path
 from random import random
 
-import nidaqmx
 import numpy as np
-import pandas as pd
 # from pyqtgraph import PlotWidget, plot
 import pyqtgraph as pg
 from PyQt5 import QtSerialPort
-from PyQt5 import QtBluetooth as QtBt
 from PyQt5.QtCore import (
-    pyqtSlot, QByteArray, QObject, pyqtSignal, QRunnable, Qt, QTimer, QSettings, QSize, QThread, QEventLoop, QIODevice
+    pyqtSlot, QByteArray, QObject, pyqtSignal, QRunnable, Qt, QTimer, QSettings, QSize, QIODevice, QThreadPool
 )
 from PyQt5.QtGui import QPalette, QColor, QIcon, QPixmap, QKeySequence
 from PyQt5.QtWidgets import (
@@ -49,21 +44,22 @@ from PyQt5.QtWidgets import (
     QShortcut,
     QGroupBox,
 )
-from nidaqmx import system as daq_system
-from nidaqmx.constants import AcquisitionType, TerminalConfiguration  # , TaskMode
-from scipy import signal
-from scipy.fft import fft, fftfreq
-from scipy.optimize import OptimizeWarning
-from scipy.optimize import curve_fit
 
+import BLEfunctions
+import buffers
 import constants
-import filters
+import core
+import detection
+import discovery
+import protocol
+import recording
+import render
 
 # import serial
 # import threading
 # import statistics
 
-warnings.simplefilter("error", OptimizeWarning)
+# nidaqmx, scipy, pandas and pyarrow are imported when first used, so the window shows up without them
 warnings.simplefilter("error", np.ComplexWarning)
 
 
@@ -86,12 +82,17 @@ class WorkerSignals(QObject):
     progress
         int indicating % progress
 
+    chunk
+        ndarray part of the data, sent while processing
+
     """
     finished = pyqtSignal()
     error = pyqtSignal(tuple)
     result = pyqtSignal(object)
     name = pyqtSignal(str)
     data = pyqtSignal(float)
+    progress = pyqtSignal(int)
+    chunk = pyqtSignal(object)
 
 
 class Worker(QRunnable):
@@ -120,6 +121,8 @@ class Worker(QRunnable):
         # Add the callback to our kwargs
         self.kwargs['data_callback'] = self.signals.data
         self.kwargs['name_callback'] = self.signals.name
+        self.kwargs['progress_callback'] = self.signals.progress
+        self.kwargs['chunk_callback'] = self.signals.chunk
 
     @pyqtSlot()
     def run(self):
@@ -146,6 +149,14 @@ class SignalCommunicate(QObject):
     # got_new_sensor_data = pyqtSignal(float, float)
     # position_updated = pyqtSignal(float)
     request_graph_update = pyqtSignal()
+    request_plot_update = pyqtSignal(tuple)
+    log_message = pyqtSignal(str)
+
+
+def _core_attribute(name):
+    # The acquisition state lives in the FlowAnalyzer shared with the headless daemon
+    return property(lambda self: getattr(self.analyzer, name),
+                    lambda self, value: setattr(self.analyzer, name, value))
 
 
 class MainWindow(QMainWindow):
@@ -190,32 +201,45 @@ class MainWindow(QMainWindow):
     base_voltage_box = None
     drop_voltage_box = None
     graphWidget = None
+    pyramids = ()
     fftWidget = None
     p1 = None
     p2 = None
     ''' Data '''
-    x_channel_one = None
-    y_channel_one = None
-    x_channel_two = None
-    y_channel_two = None
-    data_channel_one = None
-    data_channel_two = None
-    yf_channel_one = None
-    xf_channel_one = None
-    yf_channel_two = None
-    xf_channel_two = None
+    x_channel_one = _core_attribute('x_channel_one')
+    y_channel_one = _core_attribute('y_channel_one')
+    x_channel_two = _core_attribute('x_channel_two')
+    y_channel_two = _core_attribute('y_channel_two')
+    x_temperature_one = _core_attribute('x_temperature_one')
+    y_temperature_one = _core_attribute('y_temperature_one')
+    x_temperature_two = _core_attribute('x_temperature_two')
+    y_temperature_two = _core_attribute('y_temperature_two')
+    data_channel_one = _core_attribute('data_channel_one')
+    data_channel_two = _core_attribute('data_channel_two')
+    yf_channel_one = _core_attribute('yf_channel_one')
+    xf_channel_one = _core_attribute('xf_channel_one')
+    yf_channel_two = _core_attribute('yf_channel_two')
+    xf_channel_two = _core_attribute('xf_channel_two')
+    sample_count_one = _core_attribute('sample_count_one')
+    sample_count_two = _core_attribute('sample_count_two')
+    timeCounter = _core_attribute('timeCounter')
     filename = None
     ''' Flags '''
     calibrated = False
     calibration = None
-    maxX = None
+    maxX = _core_attribute('max_points')
     deviceText = None
+    pump = _core_attribute('pump')
+    use_channel_one = _core_attribute('use_channel_one')
+    use_channel_two = _core_attribute('use_channel_two')
+    save_raw_data = False
+    fft_peak = _core_attribute('fft_peak')
     ''' DAQ '''
     activeDAQ = False
     daq_device = None
-    task = None
-    discard = True
-    discard_counter = 9
+    daq = None
+    autosave_writers = None
+    autosave_rows = (0, 0)
     ''' BLE '''
     useBLE = False
     activeBLE = False
@@ -228,16 +252,23 @@ class MainWindow(QMainWindow):
     BLE_characteristic = None
     controller = None
     serviceUid = None
-    scanning = False
-    ble_rx_counter = 0
+    BLE_key = None
+    ble_use_cache = True  # reconnect to the last device without scanning, see BLEfunctions.connect_cached_ble_device
+    ble_cache_attempt = False
+    ble_framed = False  # versioned frames, or legacy packets, see BLEfunctions.handleServiceOpened
     ''' Serial '''
     activeUSB = False
+    serial_decoder = None
+    link_tracker = None  # sequence accounting of the BLE or serial packets, see start_link_metrics
     ''' Flow '''
-    flow_detected = False
+    flow_detected = _core_attribute('flow_detected')
+    last_flow = _core_attribute('last_flow')
+    BBPS_base_voltage = _core_attribute('BBPS_base_voltage')
+    values_deque = _core_attribute('values_deque')
+    spectral_flow_value = _core_attribute('spectral_flow_value')
     blink = False
     blink_on = False
     steady_flow = False
-    BBPS_base_voltage = None
 
     # endregion init
 
@@ -246,6 +277,10 @@ class MainWindow(QMainWindow):
 
         logging.debug("Initialization.")
 
+        ''' Acquisition and analysis '''
+        self.analyzer = core.FlowAnalyzer(on_event=lambda now, message: self.signalComm.log_message.emit(
+            now.strftime("%Y-%m-%d %H:%M:%S") + ": " + message))
+
         self.settings = QSettings('Sencilia', 'Flow Sensor')
 
         ''' Design main window '''
@@ -276,45 +311,37 @@ class MainWindow(QMainWindow):
         self.resize_shortcut.activated.connect(self._resize_window)
         # print(self.pump_combo_sc.currentIndex())
         self.pump_combo_sc.setCurrentIndex(self.settings.value("pump", 0))
+        self.pump = self.pump_combo_sc.currentData()
         self.sensor_id_box_one.setText(self.settings.value("sensor_id_1", ""))
         self.sensor_id_box_two.setText(self.settings.value("sensor_id_2", ""))
         self.tester_name_box.setText(self.settings.value("tester_name", ""))
 
-        ''' NI DAQ '''
-        self.system = daq_system.System.local()
-        self.zi_1 = [None] * 12
-        self.zi_2 = [None] * 12
-        self.zi_3 = [None] * 12
-        self.tempos = []
-
-        ''' Raw data '''
-        self.raw_data_channel_one = []
-        self.raw_data_channel_two = []
-
         ''' Graph '''
         self.p3 = pg.PlotItem()
-        self.x_channel_one = list(range(256))
-        self.x_channel_two = list(range(256))
-        self.y_channel_one = [random() * 256 for _ in range(256)]
-        self.y_channel_two = [random() * 256 for _ in range(256)]
+        self.x_channel_one = buffers.RingBuffer(self.maxX, range(256))
+        self.x_channel_two = buffers.RingBuffer(self.maxX, range(256))
+        self.y_channel_one = buffers.RingBuffer(self.maxX, [random() * 256 for _ in range(256)])
+        self.y_channel_two = buffers.RingBuffer(self.maxX, [random() * 256 for _ in range(256)])
+        # Level of detail of the long series: channel one, channel two, temperature one, temperature two
+        self.pyramids = [buffers.MinMaxPyramid(constants.PLOT_PYRAMID_FACTOR) for _ in range(4)]
         self.data_line_channel_one = self.p3.plot(
-            self.x_channel_one,
-            self.y_channel_one,
+            self.x_channel_one.view(),
+            self.y_channel_one.view(),
             pen=pg.mkPen(color=(255, 20, 20))
         )
         self.graphWidget.addItem(self.data_line_channel_one)
 
         self.data_line_channel_two = self.p3.plot(
-            self.x_channel_two,
-            self.y_channel_two,
+            self.x_channel_two.view(),
+            self.y_channel_two.view(),
             pen=pg.mkPen(color=(20, 255, 20))
         )
         self.p2.addItem(self.data_line_channel_two)
 
         ''' FFT '''
-        self.yf_channel_one = fft(self.y_channel_one, constants.FFT_N2)
+        self.yf_channel_one = np.fft.fft(self.y_channel_one.view(), constants.FFT_N2)
         self.yf_channel_one = 2.0 / constants.FFT_N1 * np.abs(self.yf_channel_one[0:constants.FFT_N2 // 2])
-        self.xf_channel_one = fftfreq(constants.FFT_N2, constants.SAMPLING_RATE)[:constants.FFT_N2 // 2]
+        self.xf_channel_one = np.fft.fftfreq(constants.FFT_N2, constants.SAMPLING_RATE)[:constants.FFT_N2 // 2]
         self.fft_line_channel_one = self.fftWidget.plot(
             self.xf_channel_one[0:constants.FFT_N2 // 7 + 1],
             self.yf_channel_one[0:constants.FFT_N2 // 7 + 1],
@@ -328,27 +355,38 @@ class MainWindow(QMainWindow):
             [random() * 32 + 16 for _ in range(len(self.xf_channel_one[0:constants.FFT_N2 // 7 + 1]))],
             pen=pg.mkPen(color=(20, 255, 20, 255))
         )
-        self.yf_channel_two = fft(self.y_channel_two, constants.FFT_N2)
+        self.yf_channel_two = np.fft.fft(self.y_channel_two.view(), constants.FFT_N2)
         self.yf_channel_two = 2.0 / constants.FFT_N1 * np.abs(self.yf_channel_two[0:constants.FFT_N2 // 2])
-        self.xf_channel_two = fftfreq(constants.FFT_N2, constants.SAMPLING_RATE)[:constants.FFT_N2 // 2]
+        self.xf_channel_two = np.fft.fftfreq(constants.FFT_N2, constants.SAMPLING_RATE)[:constants.FFT_N2 // 2]
 
         '''' Temperature graph '''
-        self.x_temperature_one = list(range(256))
-        self.x_temperature_two = list(range(256))
-        self.y_temperature_one = [random() * 256 for _ in range(256)]
-        self.y_temperature_two = [random() * 256 for _ in range(256)]
-
-        ''' Timer '''
-        self.timerCombo = QTimer(self)
-        self.timerCombo.setInterval(500)
-        self.timerCombo.timeout.connect(self.update_combo)
-        self.timerCombo.start()
-
-        self.timeCounter = Decimal('0.0')
+        self.x_temperature_one = buffers.RingBuffer(self.maxX, range(256))
+        self.x_temperature_two = buffers.RingBuffer(self.maxX, range(256))
+        self.y_temperature_one = buffers.RingBuffer(self.maxX, [random() * 256 for _ in range(256)])
+        self.y_temperature_two = buffers.RingBuffer(self.maxX, [random() * 256 for _ in range(256)])
+
+        ''' Devices '''
+        # Found on a background thread, the combo boxes are only updated when a device is added or removed
+        self.discovery = discovery.DeviceDiscovery(ble_service_uuid=BLEfunctions.SERVICE_UUID, parent=self)
+        self.discovery.device_added.connect(self.device_added)
+        self.discovery.device_removed.connect(self.device_removed)
+        self.discovery.start()
+        self._update_start_buttons()
 
         self.signalComm = SignalCommunicate()
+        # Redraw requests are coalesced in frames, the plots are only drawn while the scientific view is shown
+        self.renderer = render.RenderScheduler(constants.RENDER_FPS, self)
+        self.renderer.register('series', self.render_series, self.graphWidget.isVisible)
+        self.renderer.register('spectrum', self.render_spectrum, self.fftWidget.isVisible)
+        self.renderer.frame_rendered.connect(self.frame_rendered)
+        self.main_layout.currentChanged.connect(self.renderer.schedule)
         self.signalComm.request_graph_update.connect(self.update_graph)
-        self.last_flow = time.time() - 11
+        self.signalComm.request_plot_update.connect(self.plot_update_requested)
+        self.signalComm.log_message.connect(self.text_box.append)
+        # add_data_block runs on the DAQ worker thread, the GUI thread only reads the data under this lock
+        self.data_lock = self.analyzer.lock
+        self.threadpool = QThreadPool()
+        self.loader = None
 
         self.autosave_timer = QTimer(self)
         self.autosave_timer.timeout.connect(self.autosave_callback)
@@ -361,18 +399,19 @@ class MainWindow(QMainWindow):
         ''' Calibration '''
         self.calibrateData = 0
 
-        ''' Flow estimation through frequency components '''
-        self.values_deque = deque()
-
         ''' BLE '''
         # print('Thread = {}          Function = init()'.format(threading.currentThread().getName()))
-        self.agent = QtBt.QBluetoothDeviceDiscoveryAgent(self)
-        self.agent.deviceDiscovered.connect(self.discovered_device)
-        self.agent.finished.connect(self.deviceScanDone)
-        self.agent.error.connect(self.deviceScanError)
-        self.agent.setLowEnergyDiscoveryTimeout(2000)
         self.itemService = []
         self.BLE_characteristic_ready.connect(self.characteristic_ready)
+        self.ble_connect_timer = QTimer(self)
+        self.ble_connect_timer.setSingleShot(True)
+        self.ble_connect_timer.setInterval(constants.BLE_CONNECT_TIMEOUT)
+        self.ble_connect_timer.timeout.connect(self.ble_cache_failed)
+
+        # Live throughput and packet loss of the BLE or serial link
+        self.link_timer = QTimer(self)
+        self.link_timer.setInterval(constants.LINK_METRICS_INTERVAL)
+        self.link_timer.timeout.connect(self.show_link_metrics)
 
         ''' Flow '''
         self.timerFlow = QTimer(self)
@@ -384,10 +423,9 @@ class MainWindow(QMainWindow):
         vb = self.p1.getViewBox()
 
     # Import the Bluetooth functions from external file.
-    from BLEfunctions import scan_for_devices
-    from BLEfunctions import discovered_device
-    from BLEfunctions import deviceScanError
-    from BLEfunctions import deviceScanDone
+    from BLEfunctions import connect_ble_device
+    from BLEfunctions import connect_cached_ble_device
+    from BLEfunctions import ble_cache_failed
     from BLEfunctions import characteristic_ready
     from BLEfunctions import handleServiceError
     from BLEfunctions import handleServiceOpened
@@ -433,6 +471,8 @@ class MainWindow(QMainWindow):
 
         self._update_graph_views()
         self.p1.vb.sigResized.connect(self._update_graph_views)
+        self.p1.vb.sigXRangeChanged.connect(self.graph_range_changed)
+        self.fftWidget.getViewBox().sigXRangeChanged.connect(self.graph_range_changed)
 
         scientific_layout.addWidget(left_widget)
 
@@ -524,8 +564,10 @@ class MainWindow(QMainWindow):
         channel_layout = QHBoxLayout(channel_widget)
         self.channel_one_box = QCheckBox("Channel 1")
         self.channel_one_box.setChecked(True)
+        self.channel_one_box.stateChanged.connect(self.channel_box_changed)
         self.channel_two_box = QCheckBox("Channel 2")
         self.channel_two_box.setChecked(True)
+        self.channel_two_box.stateChanged.connect(self.channel_box_changed)
         channel_layout.addWidget(self.channel_one_box)
         channel_layout.addWidget(self.channel_two_box)
         self.channel_one_box.setFixedWidth(100)
@@ -565,6 +607,7 @@ class MainWindow(QMainWindow):
         self.ScaleBox = QCheckBox("Full scale")
         self.ScaleBox.stateChanged.connect(self.scale_box_changed)
         self.ScaleBox.setChecked(True)
+        self.sliderX.valueChanged.connect(self.plot_window_changed)
         groupbox = QGroupBox("Graphical settings")
         vbox = QVBoxLayout()
         groupbox.setLayout(vbox)
@@ -787,37 +830,67 @@ class MainWindow(QMainWindow):
         # flow_voltage = struct.unpack('fff', ble_data_byte_array.data())
         # print(flow_voltage)
 
+        # Frames carry both voltages, legacy packets only the flow voltage, see protocol.py
+        if not self.activeBLE:
+            return
+        start = time.perf_counter()
         try:
-            if len(ble_data_byte_array.data()) == 4:
-                flow_voltage = struct.unpack('f', ble_data_byte_array.data())
-                data_one = (flow_voltage, 1)
-                self.add_data_point(data_one, None)
-            if len(ble_data_byte_array.data()) == 8:
-                flow_voltage = struct.unpack('ff', ble_data_byte_array.data())
-                data_one = (flow_voltage[1], 1)
-                self.add_data_point(data_one, None)
-            if len(ble_data_byte_array.data()) == 12:
-                flow_voltage = struct.unpack('fff', ble_data_byte_array.data())
-                print(" Counter: %:.2f".format(flow_voltage[0]))
-                data_one = (flow_voltage[2], 1)
-                self.add_data_point(data_one, None)
-                data_one = (flow_voltage[2], 1)
-                self.add_data_point(data_one, None)
-            if len(ble_data_byte_array.data()) == 16:
-                flow_voltage = struct.unpack('ffff', ble_data_byte_array.data())
-                # print(" Counter: {:.2f}".format(flow_voltage[0]))
-                if flow_voltage[0] - self.ble_rx_counter > 1.01:
-                    print("Packages missing: {:.0f}".format(flow_voltage[0] - self.ble_rx_counter))
-                self.ble_rx_counter = flow_voltage[0]
-                data_one = (flow_voltage[1], 1)
-                self.add_data_point(data_one, None)
-                data_one = (flow_voltage[2], 1)
-                self.add_data_point(data_one, None)
-                data_one = (flow_voltage[3], 1)
-                self.add_data_point(data_one, None)
+            data = ble_data_byte_array.data()
+            if self.ble_framed:
+                counter, samples = protocol.decode_frame(data)
+                flow_voltage = samples[0]
+                temp_voltage = samples[1] if len(samples) > 1 else np.ones(len(flow_voltage))
+            else:
+                if len(data) not in protocol.LEGACY_SIZES:
+                    return
+                counter, flow_voltage = protocol.decode_legacy(data)
+                temp_voltage = np.ones(len(flow_voltage))
+            # print(" Counter: {:.2f}".format(counter))
+            samples = self.link_tracker.push(counter, np.vstack((flow_voltage, temp_voltage)))
+            if samples is not None:
+                self.add_data_block((samples[0], samples[1]), None)
         except Exception as err:
             logging.exception("ble_callback error: %s", str(err))
-        # self.add_data_point(data_one, data_two)
+        self.link_tracker.record_busy(time.perf_counter() - start)
+
+    '''
+    Function to start the sequence accounting of a new BLE or serial stream, see protocol.SequenceTracker.
+    modulus is the value at which the packet counters wrap around, None if they never do.
+    '''
+    def start_link_metrics(self, modulus=None):
+        self.link_tracker = protocol.SequenceTracker(constants.LINK_GAP_FILL, constants.LINK_MAX_GAP, modulus)
+        self.link_timer.start()
+
+    '''
+    Function returning the value at which the counters of the BLE packets wrap around, None if they never do
+    or while the characteristic, and so the type of the packets, is not known.
+    '''
+    def ble_counter_modulus(self):
+        # The counters of the frames wrap around as uint32, the legacy ones are floats
+        if self.BLE_characteristic is None or not self.ble_framed:
+            return None
+        return 2**32
+
+    '''
+    Function to stop showing the link metrics, and log their totals.
+    '''
+    def stop_link_metrics(self):
+        self.link_timer.stop()
+        if self.link_tracker is not None:
+            logging.info("[Link] {0}".format(self.link_tracker.metrics()))
+        # A packet arriving after the stop must not update the totals of this session
+        self.link_tracker = None
+        self.statusBar().clearMessage()
+
+    '''
+    Callback timer function to show the throughput and the packet loss of the link in the status bar.
+    '''
+    def show_link_metrics(self):
+        metrics = self.link_tracker.metrics()
+        self.statusBar().showMessage(
+            "{packet_rate:.1f} packets/s, {sample_rate:.1f} samples/s, loss {recent_loss_rate:.1%} "
+            "(total {lost} lost, {duplicated} duplicated, {out_of_order} late), "
+            "host load {host_load:.0%}".format(**metrics))
 
     '''
     Callback function to sync the BLE box between the two layouts.
@@ -832,11 +905,7 @@ class MainWindow(QMainWindow):
             self.text_box.append(now.strftime("%Y-%m-%d %H:%M:%S") + ": Bluetooth enabled.")
         else:
             self.text_box.append(now.strftime("%Y-%m-%d %H:%M:%S") + ": Bluetooth disabled.")
-        if self.useBLE and self.BLE_device is None:
-            self.scan_for_devices()
-            if not self.timerCombo.isActive():
-                self.timerCombo.setInterval(500)
-                self.timerCombo.start()
+        self.update_ble_discovery()
 
     '''
     Callback function to sync the BLE box between the two layouts.
@@ -849,314 +918,114 @@ class MainWindow(QMainWindow):
     Function to adjust the graph after every new data point is added.
     '''
     def update_graph(self):
-        try:
-            # print('Thread = {}          Function = update_graph()'.format(threading.currentThread().getName()))
-            self.data_line_channel_one.setData(self.x_channel_one, self.y_channel_one)
-            self.data_line_channel_two.setData(self.x_channel_two, self.y_channel_two)
+        self.renderer.request()
+
+    '''
+    Callback function for the plot updates requested by add_data_block.
+    '''
+    def plot_update_requested(self, items):
+        if self.temperature_fft_box.isChecked():
+            # The temperature replaces the spectrum and changes with every sample
+            items = items + ('spectrum',)
+        self.renderer.request(*items)
+
+    '''
+    Function to redraw the time series, called by the render scheduler.
+    '''
+    def render_series(self):
+        # print('Thread = {}          Function = render_series()'.format(threading.currentThread().getName()))
+        with self.data_lock:
+            self._set_series_data(self.data_line_channel_one, self.x_channel_one, self.y_channel_one,
+                                  self.pyramids[0], self.p1.vb)
+            self._set_series_data(self.data_line_channel_two, self.x_channel_two, self.y_channel_two,
+                                  self.pyramids[1], self.p2)
+
+        # TODO: improve scale
+        # if len(self.y_channel_one) > 2:
+        #     self.p1.setYRange(min(self.y_channel_one), max(self.y_channel_one))
+
+    '''
+    Function to redraw the spectrum or the temperature, called by the render scheduler.
+    '''
+    def render_spectrum(self):
+        with self.data_lock:
             if self.temperature_fft_box.isChecked():
-                self.fft_line_channel_one.setData(self.x_temperature_one, self.y_temperature_one)
-                self.fft_line_channel_two.setData(self.x_temperature_two, self.y_temperature_two)
+                fft_view = self.fftWidget.getViewBox()
+                self._set_series_data(self.fft_line_channel_one, self.x_temperature_one, self.y_temperature_one,
+                                      self.pyramids[2], fft_view)
+                self._set_series_data(self.fft_line_channel_two, self.x_temperature_two, self.y_temperature_two,
+                                      self.pyramids[3], fft_view)
             else:
                 self.fft_line_channel_one.setData(self.xf_channel_one[0:constants.FFT_N2 // 8],
                                                   self.yf_channel_one[0:constants.FFT_N2 // 8])
                 self.fft_line_channel_two.setData(self.xf_channel_two[0:constants.FFT_N2 // 8],
                                                   self.yf_channel_two[0:constants.FFT_N2 // 8])
 
-            # TODO: improve scale
-            # if len(self.y_channel_one) > 2:
-            #     self.p1.setYRange(min(self.y_channel_one), max(self.y_channel_one))
-        except Exception as err:
-            logging.exception("update_graph error: %s", str(err))
+                ''' Adjust FFT scale '''
+                if self.fft_peak < 0.02:
+                    self.fftWidget.setYRange(0, 0.02)
+                else:
+                    self.fftWidget.setYRange(0, self.fft_peak)
 
     '''
-    Function to add a new data point to the graph and analise it.
+    Callback function to log the render time of the frames.
     '''
-    def add_data_point(self, data_one=None, data_two=None):
-
-        if not self.ScaleBox.isChecked():
-            self.maxX = (self.sliderX.value() + 1) * 6
+    def frame_rendered(self, frame_time):
+        if len(self.renderer.frame_times) == self.renderer.frame_times.maxlen:
+            times = self.renderer.frame_times
+            logging.debug("[Render time] Mean: {:.4f}s, Max: {:.4f}s".format(np.mean(times), max(times)))
+            times.clear()
 
-        timestamp = round(time.time() * 1000)
-
-        r1 = 0
-        r2 = 0
+    '''
+    Function to plot a series. A series that keeps all the data and is longer than the plot width times
+    PLOT_MAX_POINTS_PER_PIXEL is reduced to a minimum and a maximum per pixel of the visible range.
+    '''
+    def _set_series_data(self, line, x_buffer, y_buffer, pyramid, view_box):
+        x = x_buffer.view()
+        y = y_buffer.view()
+        width = max(int(view_box.width()), 1)
+        if y_buffer.capacity is not None or len(y) <= constants.PLOT_MAX_POINTS_PER_PIXEL * width:
+            pyramid.clear()
+            line.setData(x, y)
+            return
 
-        if data_one is not None:
-            flow_voltage_one, temp_voltage_one = data_one
-            beta = 3976
-            try:
-                resistance = 2983 / ((5.039 / temp_voltage_one) - 1)
-                temperature = beta / log(resistance / (2000 * exp(- beta / 298.15))) - 273.15
-                # print(temperature)
-            except Exception as err:
-                # logging.exception("math error: %s", str(err))
-                temperature = 0.0
-            if len(self.x_channel_one) == 0:
-                self.x_channel_one.append(0)
-                self.x_temperature_one.append(0)
-            else:
-                self.x_channel_one.append(self.x_channel_one[-1] + 0.1)
-                self.x_temperature_one.append(self.x_temperature_one[-1] + 0.1)
-            self.y_channel_one.append(flow_voltage_one)
-            self.y_temperature_one.append(temperature)
-            if not self.ScaleBox.isChecked():
-                while len(self.x_channel_one) > self.maxX:
-                    self.x_channel_one = self.x_channel_one[1:]
-                    self.y_channel_one = self.y_channel_one[1:]
-                    self.x_temperature_one = self.x_temperature_one[1:]
-                    self.y_temperature_one = self.y_temperature_one[1:]
-            datapoint = {'timestamp': [timestamp],
-                         'time': [self.timeCounter],
-                         'flow_voltage': [flow_voltage_one],
-                         'temp_voltage': [temp_voltage_one],
-                         'temperature': [temperature]}
-            # self.data_channel_one = self.data_channel_one.append(datapoint, ignore_index=True)
-            datapoint = pd.DataFrame(data=datapoint)
-            self.data_channel_one = pd.concat([self.data_channel_one, datapoint], ignore_index=True)
-            ''' FFT'''
-            if len(self.x_channel_one) > constants.FFT_N1:
-                y = self.y_channel_one[-constants.FFT_N1:]
-                y = y - np.average(y)
-                self.yf_channel_one = fft(y * constants.KAISER_WINDOW, constants.FFT_N2)
-                self.yf_channel_one = 2.0 / constants.FFT_N1 * np.abs(self.yf_channel_one[0:constants.FFT_N2 // 2])
-                self.xf_channel_one = fftfreq(constants.FFT_N2, constants.SAMPLING_RATE)[:constants.FFT_N2 // 2]
-                r1 = max(self.yf_channel_one[0:constants.FFT_N2 // 7 + 1])
-
-        if data_two is not None:
-            flow_voltage_two, temp_voltage_two = data_two
-            beta = 3976
-            try:
-                resistance = 2688 / ((5.039 / temp_voltage_two) - 1)
-                temperature = beta / log(resistance / (2000 * exp(- beta / 298.15))) - 273.15
-            except Exception as err:
-                # logging.exception("math error: %s", str(err))
-                temperature = 0.0
-            datapoint = {'timestamp': [timestamp],
-                         'time': [self.timeCounter],
-                         'flow_voltage': [flow_voltage_two],
-                         'temp_voltage': [temp_voltage_two],
-                         'temperature': [temperature]}
-            if len(self.x_channel_two) == 0:
-                self.x_channel_two.append(0)
-                self.x_temperature_two.append(0)
-            else:
-                self.x_channel_two.append(self.x_channel_two[-1] + 0.1)
-                self.x_temperature_two.append(self.x_temperature_two[-1] + 0.1)
-            self.y_channel_two.append(flow_voltage_two)
-            self.y_temperature_two.append(temperature)
-            if not self.ScaleBox.isChecked():
-                while len(self.x_channel_two) > self.maxX:
-                    self.x_channel_two = self.x_channel_two[1:]
-                    self.y_channel_two = self.y_channel_two[1:]
-                    self.x_temperature_two = self.x_temperature_two[1:]
-                    self.y_temperature_two = self.y_temperature_two[1:]
-            datapoint = pd.DataFrame(data=datapoint)
-            self.data_channel_two = pd.concat([self.data_channel_two, datapoint], ignore_index=True)
-            # self.data_channel_two = self.data_channel_two.append(datapoint, ignore_index=True)
-                # logging.exception("math error: %s", str(err))
-            ''' FFT'''
-            if len(self.x_channel_two) > constants.FFT_N1:
-                y = self.y_channel_two[-constants.FFT_N1:]
-                y = y - np.average(y)
-                self.yf_channel_two = fft(y * constants.KAISER_WINDOW, constants.FFT_N2)
-                self.yf_channel_two = 2.0 / constants.FFT_N1 * np.abs(self.yf_channel_two[0:constants.FFT_N2 // 2])
-                self.xf_channel_two = fftfreq(constants.FFT_N2, constants.SAMPLING_RATE)[:constants.FFT_N2 // 2]
-                r2 = max(self.yf_channel_two[0:constants.FFT_N2 // 7 + 1])
-
-        if data_one is None and data_two is not None:
-            if len(self.x_channel_one) == 0:
-                self.x_channel_one.append(0)
-            else:
-                self.x_channel_one.append(self.x_channel_one[-1] + 0.1)
-            self.y_channel_one.append(0)
-            if not self.ScaleBox.isChecked():
-                while len(self.x_channel_one) > self.maxX:
-                    self.x_channel_one = self.x_channel_one[1:]
-                    self.y_channel_one = self.y_channel_one[1:]
+        pyramid.sync(y)
+        if view_box.autoRangeEnabled()[0]:
+            start, stop = 0, len(y)
+        else:
+            x_min, x_max = view_box.viewRange()[0]
+            # One more sample on each side so the line reaches the borders
+            start = np.searchsorted(x, x_min, side='left') - 1
+            stop = np.searchsorted(x, x_max, side='right') + 1
+        index, values = pyramid.query(y, start, stop, width)
+        line.setData(x[index], values)
 
-        # TODO: improve scale
-        # maxy = max(self.y)
-        # miny = min(self.y)
-        # delta = maxy - miny
-        # if delta < 2:
-        #     self.graphWidget.setYRange(miny, maxy)
-        # else:
-        #     self.graphWidget.setYRange(miny, maxy)
-        # nn = 1.5
-        # maxy *= nn
-        # miny *= nn
-        # maxabs = max([abs(maxy), abs(miny)])
-        # self.graphWidget.setYRange(-maxabs, maxabs)
-
-        self.timeCounter += Decimal('0.1')
-
-        ''' Adjust FFT scale '''
-        if not self.temperature_fft_box.isChecked():
-            r = max(r1, r2)
-            if r < 0.02:
-                self.fftWidget.setYRange(0, 0.02)
-            else:
-                self.fftWidget.setYRange(0, r)
-
-        # Alaris GW Cardinal Health pump
-        if self.pump_combo_sc.currentData() == "ALGW":
-            ''' Flow estimation through frequency components '''
-            def freq_to_flow(frequency):
-                return frequency / 0.001251233545
-            # 0.00123995
-            # 0.001251233545
-
-            if len(self.x_channel_one) > constants.FFT_N1:
-                yf = np.copy(self.yf_channel_one)
-                value = False
-                peaks, properties = signal.find_peaks(yf, constants.MIN_PEAKS)
-                if len(properties['peak_heights']) > 0:
-                    index_max = np.argmax(properties['peak_heights'])
-                    if peaks[index_max] < 30:
-                        properties['peak_heights'] = np.delete(properties['peak_heights'], index_max)
-                        peaks = np.delete(peaks, index_max)
-                        if len(properties['peak_heights']) > 0:
-                            index_max = np.argmax(properties['peak_heights'])
-                            # print("Removed the first peak, peak: ", peaks[index_max], " Frequency: ",
-                            #       peaks[index_max] / constants.FFT_N2, " Flow: ",
-                            #   freq_to_flow((peaks[index_max] / constants.FFT_N2) / constants.SAMPLING_RATE))
-                            value = freq_to_flow((peaks[index_max] / constants.FFT_N2) / constants.SAMPLING_RATE)
-                        else:
-                            # print("Removed the only peak.")
-                            value = np.NAN
-                    else:
-                        # print("Using the first peak, peak: ", peaks[index_max], " Frequency: ",
-                        #       peaks[index_max] / constants.FFT_N2, " Flow: ",
-                        #       freq_to_flow((peaks[index_max] / constants.FFT_N2) / constants.SAMPLING_RATE))
-                        value = freq_to_flow((peaks[index_max] / constants.FFT_N2) / constants.SAMPLING_RATE)
-                else:
-                    # print("There are no peaks.")
-                    value = np.NAN
-
-                self.values_deque.append(value)
-
-                if len(self.values_deque) > constants.MAX_DEQUE_SIZE:
-                    self.values_deque.popleft()
-
-            ''' Flow detection '''
-
-            def func(fx, fa, fb):
-                return fa + fb * fx
-
-            if len(self.x_channel_one) > constants.ALGW_FLOW_DETECTION_BLOCK_LEN and self.channel_one_box.isChecked():
-                try:
-                    now = datetime.now()
-
-                    chunk = self.y_channel_one[-constants.ALGW_FLOW_DETECTION_BLOCK_LEN:]
-                    x = np.linspace(0, len(chunk), len(chunk))
-                    p_opt, p_cov = curve_fit(func, x, chunk)
-                    b = p_opt[1]
-
-                    if b < constants.ALGW_FLOW_START_NEG_THRESHOLD:
-                        if not self.flow_detected:
-                            print("Flow detected, b: ", b)
-                            self.text_box.append(now.strftime("%Y-%m-%d %H:%M:%S") + ": Flow detected.")
-                        self.flow_detected = True
-                    if b > constants.ALGW_FLOW_STOP_POS_THRESHOLD:
-                        if self.flow_detected:
-                            print("Flow stopped, b: ", b)
-                            self.last_flow = time.time()
-                            self.text_box.append(now.strftime("%Y-%m-%d %H:%M:%S") + ": Flow stopped.")
-                        self.flow_detected = False
-                except OptimizeWarning as err:
-                    logging.exception("OptimizeWarning error: %s", str(err))
-                except Exception as err:
-                    logging.exception("Generic error in curve estimation: %s", str(err))
-
-        # B Braun Perfusor Space pump
-        elif self.pump_combo_sc.currentData() == "BBPS":
-            '''Flow Detection'''
-            def func(fx, fa, fb):
-                return fa + fb * fx
-
-            if len(self.x_channel_one) > constants.BBPS_FLOW_DETECTION_BLOCK_LEN and self.channel_one_box.isChecked():
-                try:
-                    now = datetime.now()
-                    chunk = self.y_channel_one[-constants.BBPS_FLOW_DETECTION_BLOCK_LEN:]
-                    x = np.linspace(0, len(chunk), len(chunk))
-                    p_opt, p_cov = curve_fit(func, x, chunk)
-                    b = p_opt[1]
-                    if b < constants.BBPS_FLOW_START_NEG_THRESHOLD:
-                        if not self.flow_detected:
-                            # first detection of the flow, get the base voltage
-                            self.BBPS_base_voltage = np.average(self.y_channel_one[
-                                                                constants.BBPS_START:constants.BBPS_STOP])
-                            print(self.BBPS_base_voltage)
-                            print("Flow detected, b: ", b)
-                            self.text_box.append(now.strftime("%Y-%m-%d %H:%M:%S") + ": Flow detected.")
-                        self.flow_detected = True
-                    if b > constants.BBPS_FLOW_STOP_POS_THRESHOLD:
-                        if self.flow_detected:
-                            # flow stoped
-                            self.BBPS_base_voltage = None
-                            print("Flow stopped, b: ", b)
-                            self.last_flow = time.time()
-                            self.text_box.append(now.strftime("%Y-%m-%d %H:%M:%S") + ": Flow stopped.")
-                        self.flow_detected = False
-                except OptimizeWarning as err:
-                    logging.exception("OptimizeWarning error: %s", str(err))
-                except Exception as err:
-                    logging.exception("Generic error in curve estimation: %s", str(err))
+    '''
+    Callback function to redraw the reduced series when the visible range changes.
+    '''
+    def graph_range_changed(self):
+        if any(len(pyramid) > 0 for pyramid in self.pyramids[:2]):
+            self.renderer.request('series')
+        if any(len(pyramid) > 0 for pyramid in self.pyramids[2:]):
+            self.renderer.request('spectrum')
 
-        self.signalComm.request_graph_update.emit()
+    '''
+    Function to add new data points to the graph and analise them, see FlowAnalyzer.add_data_block.
+    It can run on the DAQ worker thread, so it must not touch the widgets:
+    messages go through signalComm and the flags are kept up to date by the widget callbacks.
+    '''
+    def add_data_block(self, block_one=None, block_two=None):
+        spectrum_updated = self.analyzer.add_data_block(block_one, block_two)
+        self.signalComm.request_plot_update.emit(('series', 'spectrum') if spectrum_updated else ('series',))
 
     '''
-    Callback function to receive data from the DAQ.
+    Function to add the new data points of several sensors at once, see FlowAnalyzer.add_sensor_block.
+    It runs on the DAQ worker thread, like add_data_block.
     '''
-    def daq_callback(self, task_handle, every_n_samples_event_type, number_of_samples, callback_data):
-        # print('Thread = {}          Function = daq_callback()'.format(threading.currentThread().getName()))
-        # DEBUG
-        start_time = timeit.default_timer()
-        try:
-            sample = self.task.read(number_of_samples_per_channel=1_000)
-            i = 0
-            if self.channel_one_box.isChecked() and self.raw_data_box.isChecked():
-                self.raw_data_channel_one.extend(sample[i])
-
-            if self.channel_two_box.isChecked() and self.raw_data_box.isChecked():
-                i += 2
-                self.raw_data_channel_two.extend(sample[i])
-
-            for i in range(len(sample)):
-                sample[i], self.zi_1[i] = filters.decimate(sample[i], 10, zi=self.zi_1[i])
-                sample[i], self.zi_2[i] = filters.decimate(sample[i], 10, zi=self.zi_2[i])
-                sample[i], self.zi_3[i] = filters.decimate(sample[i], 10, zi=self.zi_3[i])
-            if self.discard:
-                self.discard_counter -= 1
-                if self.discard_counter < 1:
-                    self.discard = False
-                return 0
-
-            i = 0
-            data_one = None
-            data_two = None
-            if self.channel_one_box.isChecked():
-                flow_voltage = 1000 * sum(sample[i]) / len(sample[i])
-                i += 1
-                temp_voltage = sum(sample[i]) / len(sample[i])
-                i += 1
-                data_one = (flow_voltage, temp_voltage)
-
-            if self.channel_two_box.isChecked():
-                flow_voltage = 1000 * sum(sample[i]) / len(sample[i])
-                i += 1
-                temp_voltage = sum(sample[i]) / len(sample[i])
-                data_two = (flow_voltage, temp_voltage)
-
-            self.add_data_point(data_one, data_two)
-        except Exception as err:
-            logging.exception("daq_callback error: : %s", str(err))
-        self.tempos.append(timeit.default_timer() - start_time)
-        if len(self.tempos) % 600 == 0:
-            logging.debug("[DAQ processing time] Mean: {:.4f}s, Deviation: {:.2e}s, Max: {:.4f}s".format(
-                np.mean(self.tempos), np.std(self.tempos), max(self.tempos)))
-            self.tempos = []
-        return 0
+    def add_sensor_block(self, flow_voltage, temp_voltage, sensors):
+        spectrum_updated = self.analyzer.add_sensor_block(flow_voltage, temp_voltage, sensors)
+        self.signalComm.request_plot_update.emit(('series', 'spectrum') if spectrum_updated else ('series',))
+
     #
     # def usb_callback(self, data):
     #     print(data)
@@ -1166,120 +1035,74 @@ class MainWindow(QMainWindow):
     '''
     @pyqtSlot()
     def receive(self):
-        while self.serial.canReadLine():
-            text = self.serial.readLine().data().decode()
-            text = text.rstrip('\r\n')
-            result = re.findall(r"[-+]?(?:\d*\.\d+|\d+)", text)
-            # print(text.split())
-            # print(result)
-            if "Received" in text:
-                value = float(result[2])
-                # print("Received Serial:", value)
-                # self.new_data.emit(value)
-                data_one = (value, 0.0)
-                self.add_data_point(data_one, None)
-            else:
-                print(text)
+        # Everything available is read and decoded at once, binary frames or text lines, see protocol.py
+        if not self.activeUSB:
+            return
+        start = time.perf_counter()
+        frames, messages = self.serial_decoder.feed(self.serial.readAll().data())
+        for text in messages:
+            print(text)
+        blocks = []
+        for counter, samples in frames:
+            if len(samples) < 2:
+                samples = np.vstack((samples[0], np.zeros(samples.shape[1])))
+            samples = self.link_tracker.push(counter, samples[:2])
+            if samples is not None:
+                blocks.append(samples)
+        if blocks:
+            samples = np.concatenate(blocks, axis=1)
+            self.add_data_block((samples[0], samples[1]), None)
+        self.link_tracker.record_busy(time.perf_counter() - start)
 
     '''
     Callback timer function to control the displays.
     It is called evey 500ms.
     '''
     def check_flow(self):
-        # Alaris GW Cardinal Health pump
-        if self.pump_combo_sc.currentData() == "ALGW":
-            if self.flow_detected:
-                now = datetime.now()
-                if len(self.values_deque) > 20:
-                    std_value = np.std(self.values_deque)
-                    mean_value = np.mean(self.values_deque)
-                    std_over_mean = abs(std_value / mean_value)
-                    logging.debug("[FLOW ESTIMATION] std: {:.2f}, mean: {:.2f}, ratio: {:.2f}".format(
-                        std_value, mean_value, std_over_mean))
-                else:
-                    std_over_mean = 10
-
-                if std_over_mean > 0.5 or np.isnan(np.sum(self.values_deque)):
-                    if self.blink_on:
-                        self.flow_label.display('---')
-                        self.flow_label2.display('---')
-                        self.blink_on = False
-                    else:
-                        self.flow_label.display('')
-                        self.flow_label2.display('')
-                        self.blink_on = True
-                    if not self.blink:
-                        self.text_box.append(now.strftime("%Y-%m-%d %H:%M:%S") + ": Calculating...")
-                    self.blink = True
-                    self.steady_flow = False
-                else:
-                    self.blink = False
-                    if not self.steady_flow:
-                        self.text_box.append(now.strftime("%Y-%m-%d %H:%M:%S") + ": Steady flow detected.")
-                        self.steady_flow = True
-                    values = list(self.values_deque)
-                    values.sort()
-                    try:
-                        value = np.mean(values)
-                        value = 0 if value < 0 else value
-                        value = round(value)
-                        self.flow_label.display(value)
-                        self.flow_label2.display(value)
-                    except Exception as err:
-                        logging.exception("flow calculation error: : %s", str(err))
-            else:
-                if (time.time() - self.last_flow) > 10:
-                    self.flow_label.display('000')
-                    self.flow_label2.display('000')
-                else:
-                    if self.blink_on:
-                        self.flow_label.display('---')
-                        self.flow_label2.display('---')
-                        self.blink_on = False
-                    else:
-                        self.flow_label.display('')
-                        self.flow_label2.display('')
-                        self.blink_on = True
-
-        # B Braun Perfusor Space pump
-        elif self.pump_combo_sc.currentData() == "BBPS":
-            ''' Flow estimation through voltage delta'''
-            if self.BBPS_base_voltage is not None:
-                voltage_delta = np.abs(np.average(self.y_channel_one[-5:]) - self.BBPS_base_voltage)
-                flow = np.exp((voltage_delta+constants.BBPS_A)/constants.BBPS_B)
-                print("voltage delta: ", voltage_delta)
-                print("flow: ", flow)
-
-                logging.debug("voltage delta: " + str(voltage_delta))
-                logging.debug("flow: " + str(flow))
-
-                now = datetime.now()
-                if voltage_delta > 2:
-                    flow = 0
-                    self.text_box.append(now.strftime("%Y-%m-%d %H:%M:%S") + ": Flow out of linear region.")
-
-                if not self.steady_flow:
-                    self.text_box.append(now.strftime("%Y-%m-%d %H:%M:%S") + ": Steady flow detected.")
-                    self.steady_flow = True
-                try:
-                    value = round(flow)
-                    self.flow_label.display(value)
-                    self.flow_label2.display(value)
-                except Exception as err:
-                    logging.exception("flow calculation error: : %s", str(err))
-            else:
-                if (time.time() - self.last_flow) > 10:
-                    self.flow_label.display('000')
-                    self.flow_label2.display('000')
-                else:
-                    if self.blink_on:
-                        self.flow_label.display('---')
-                        self.flow_label2.display('---')
-                        self.blink_on = False
-                    else:
-                        self.flow_label.display('')
-                        self.flow_label2.display('')
-                        self.blink_on = True
+        # The estimate of the first sensor, see core.FlowAnalyzer.flow_estimates
+        pump = self.pump_combo_sc.currentData()
+        if pump not in ("ALGW", "BBPS"):
+            return
+        now = datetime.now()
+        # Alaris GW Cardinal Health pump, B Braun Perfusor Space pump once its base voltage is known
+        active = self.flow_detected if pump == "ALGW" else self.BBPS_base_voltage is not None
+        if active:
+            flow = self.analyzer.flow_estimates()[0]
+            logging.debug("[FLOW ESTIMATION] flow: {0}".format(flow))
+            if np.isnan(flow):
+                self.blink_flow()
+                if not self.blink:
+                    self.text_box.append(now.strftime("%Y-%m-%d %H:%M:%S") + ": Calculating...")
+                self.blink = True
+                self.steady_flow = False
+                return
+            self.blink = False
+            if pump == "BBPS" and flow == 0:
+                self.text_box.append(now.strftime("%Y-%m-%d %H:%M:%S") + ": Flow out of linear region.")
+            if not self.steady_flow:
+                self.text_box.append(now.strftime("%Y-%m-%d %H:%M:%S") + ": Steady flow detected.")
+                self.steady_flow = True
+            value = round(flow)
+            self.flow_label.display(value)
+            self.flow_label2.display(value)
+        elif (time.time() - self.last_flow) > 10:
+            self.flow_label.display('000')
+            self.flow_label2.display('000')
+        else:
+            self.blink_flow()
+
+    '''
+    Function to blink the flow displays while the flow is not known.
+    '''
+    def blink_flow(self):
+        if self.blink_on:
+            self.flow_label.display('---')
+            self.flow_label2.display('---')
+            self.blink_on = False
+        else:
+            self.flow_label.display('')
+            self.flow_label2.display('')
+            self.blink_on = True
 
 
     '''
@@ -1318,9 +1141,7 @@ class MainWindow(QMainWindow):
         if self.activeDAQ:
             self.text_box.append(now.strftime("%Y-%m-%d %H:%M:%S") + ":  Stop data acquisition.")
             self.activeDAQ = False
-            self.task.stop()
-            self.task.close()
-            logging.debug("Stop DAQ data acquisition.")
+            self.stop_daq()
 
             self.save_to_file()
 
@@ -1352,35 +1173,20 @@ class MainWindow(QMainWindow):
 
             self.setup_new_data()
 
-            self.discard = True
-            self.discard_counter = 9
+            self.save_raw_data = self.raw_data_box.isChecked()
 
-            self.task = nidaqmx.Task()
             self.activeDAQ = True
-            self.daq_device = self.system.devices[self.device_combo_sc.currentIndex()].name
-            self.autosave_timer.setInterval(60 * 60 * 1000)
-
-            if self.channel_one_box.isChecked():
-                channel = self.daq_device + "/ai1"
-                _ = self.task.ai_channels.add_ai_voltage_chan(channel,
-                                                              terminal_config=TerminalConfiguration.DIFFERENTIAL)
-
-                channel = self.daq_device + "/ai0"
-                _ = self.task.ai_channels.add_ai_voltage_chan(channel,
-                                                              terminal_config=TerminalConfiguration.RSE)
-
-            if self.channel_two_box.isChecked():
-                channel = self.daq_device + "/ai3"
-                _ = self.task.ai_channels.add_ai_voltage_chan(channel,
-                                                              terminal_config=TerminalConfiguration.DIFFERENTIAL)
-                channel = self.daq_device + "/ai2"
-                _ = self.task.ai_channels.add_ai_voltage_chan(channel,
-                                                              terminal_config=TerminalConfiguration.RSE)
-                # DEBUG
-            self.task.timing.cfg_samp_clk_timing(10_000, sample_mode=AcquisitionType.CONTINUOUS)
-            self.task.register_every_n_samples_acquired_into_buffer_event(1_000, self.daq_callback)
-            self.task.start()
-            logging.debug("Start DAQ data acquisition.")
+            self.daq_device = self.device_combo_sc.currentData()[1]
+            self.autosave_timer.setInterval(constants.AUTOSAVE_INTERVAL)
+
+            raw_path = None
+            if self.save_raw_data:
+                raw_path = self.settings.value("working_dir", "") + now.strftime("%Y-%m-%d %H-%M-%S") + ' raw data.fsraw'
+                self.text_box.append(now.strftime("%Y-%m-%d %H:%M:%S") + ": Saving raw data to: {0}".format(raw_path))
+            sensors = [sensor for sensor, box in enumerate((self.channel_one_box, self.channel_two_box))
+                       if box.isChecked()]
+            self.daq = core.DaqAcquisition(self.daq_device, sensors, self.add_sensor_block, raw_path)
+            self.daq.start()
             self.startButton.setText("Stop")
             self.startButton2.setText("Stop")
 
@@ -1391,7 +1197,9 @@ class MainWindow(QMainWindow):
                 self.BLE_service.writeDescriptor(self.descriptor, array)  # turn off NOTIFY
             except AttributeError as ex:
                 pass
+            self.stop_link_metrics()
             time.sleep(0.4)
+            self.stop_autosave()
             self.save_to_file()
             self.startButton.setText("Start")
             self.startButton2.setText("Start")
@@ -1404,20 +1212,14 @@ class MainWindow(QMainWindow):
             self.device_combo_sc.setEnabled(False)
             self.device_combo_user.setEnabled(False)
             self.setup_new_data()
-            # start receiving data from BLE
-            self.BLE_service = self.controller.createServiceObject(self.BLE_UUID_service)
-            self.BLE_service.error.connect(self.handleServiceError)
-            if self.BLE_service is None:
-                print("ERR: Cannot open service\n")
-
-            if self.BLE_service.state() == QtBt.QLowEnergyService.ServiceDiscovered:
-                self.handleServiceOpened(self.BLE_service.state())
-
-            elif self.BLE_service.state() == QtBt.QLowEnergyService.DiscoveryRequired:
-                self.BLE_service.stateChanged.connect(self.handleServiceOpened)
-                self.BLE_service.discoverDetails()
+            # The tracker exists whenever activeBLE is set, it is started again once the type of the packets is
+            # known if the device connects later, see BLEfunctions.handleServiceOpened
+            self.start_link_metrics(self.ble_counter_modulus())
+            # start receiving data from BLE, the characteristic is found once connected, see serviceScanDone
+            if self.BLE_characteristic is None:
+                print("ERR: BLE device not ready\n")
             else:
-                print("Cannot discover service\n")
+                self.BLE_characteristic_ready.emit()
 
             logging.debug("Start BLE data acquisition.")
             self.startButton.setText("Stop")
@@ -1429,7 +1231,11 @@ class MainWindow(QMainWindow):
         if self.activeUSB:
             # self.serial_timer.terminate()
             self.serial.close()
+            logging.debug("Serial frames: {0}, resynchronizations: {1}, bytes skipped: {2}".format(
+                self.serial_decoder.frames, self.serial_decoder.resyncs, self.serial_decoder.skipped))
+            self.stop_link_metrics()
             time.sleep(0.2)
+            self.stop_autosave()
             self.save_to_file()
             self.activeUSB = False
             self.startButton.setText("Start")
@@ -1451,6 +1257,8 @@ class MainWindow(QMainWindow):
             # self.serial_timer.start()
             self.serial.setPortName(self.device_combo_sc.currentData()[1])
             self.serial.setBaudRate(115200)
+            self.serial_decoder = protocol.SerialDecoder(constants.SERIAL_PROTOCOL)
+            self.start_link_metrics(modulus=2**32)
             self.serial.readyRead.connect(self.receive)
             self.serial.open(QIODevice.ReadWrite)
             self.activeUSB = True
@@ -1472,36 +1280,57 @@ class MainWindow(QMainWindow):
             msg.exec_()
             logging.debug("Data acquisition in progress. Returning from setup_new_data.")
             return
-        self.x_channel_one = []
-        self.y_channel_one = []
-        self.xf_channel_one = []
-        self.yf_channel_one = []
-        self.x_channel_two = []
-        self.y_channel_two = []
-        self.xf_channel_two = []
-        self.yf_channel_two = []
-        self.x_temperature_one = []
-        self.y_temperature_one = []
-        self.x_temperature_two = []
-        self.y_temperature_two = []
-
-        ''' Raw data '''
-        self.raw_data_channel_one = []
-        self.raw_data_channel_two = []
+        if self.loader is not None:
+            # Stop loading the previous file
+            self.loader.cancel()
+            self.loader = None
+        with self.data_lock:
+            self.analyzer.reset()
+        self.analyzer.load_backends()
 
         self.filename = None
         if self.base_voltage_box is not None:
             self.base_voltage_box.setData([], [])
         if self.drop_voltage_box is not None:
             self.drop_voltage_box.setData([], [])
-        self.data_channel_one = pd.DataFrame(
-            columns=['timestamp', 'time', 'flow_voltage', 'temp_voltage', 'temperature'])
-        self.data_channel_two = pd.DataFrame(
-            columns=['timestamp', 'time', 'flow_voltage', 'temp_voltage', 'temperature'])
-        self.timeCounter = Decimal('0.0')
         self.signalComm.request_graph_update.emit()
         logging.debug("setup_new_data returning.")
 
+    '''
+    Function to stop the DAQ acquisition, and close the raw data and autosave files.
+    '''
+    def stop_daq(self):
+        if self.daq is None:
+            return
+        self.daq.stop()
+        if self.daq.raw_writer is not None:
+            now = datetime.now()
+            self.text_box.append(now.strftime("%Y-%m-%d %H:%M:%S") + ": Raw data saved to: {0}".format(self.daq.raw_path))
+        self.daq = None
+        self.stop_autosave()
+
+    '''
+    Function to describe the session of one channel, saved with the data.
+    '''
+    def session_metadata(self, channel):
+        if channel == 1:
+            sensor_id, flow_rate, back_pressure = \
+                self.sensor_id_box_one, self.flow_rate_box_one, self.back_pressure_box_one
+        else:
+            sensor_id, flow_rate, back_pressure = \
+                self.sensor_id_box_two, self.flow_rate_box_two, self.back_pressure_box_two
+        return {
+            'channel': channel,
+            'tester': self.tester_name_box.text(),
+            'pump': self.pump_combo_sc.currentData(),
+            'sensor_id': sensor_id.text(),
+            'flow_rate': flow_rate.text(),
+            'back_pressure': back_pressure.text(),
+            'device': self.device_combo_sc.currentText(),
+            'sampling_period': constants.SAMPLING_RATE,
+            'saved': datetime.now().isoformat(),
+        }
+
     '''
     Function to save the data to a file.
     '''
@@ -1554,19 +1383,22 @@ class MainWindow(QMainWindow):
         extra1 = " [" + extra1 + "]"
         extra2 = " [" + extra2 + "]"
 
+        extension = '.' + constants.RECORDING_FORMAT
+        file_filter = "Parquet Files (*.parquet);;CSV Files (*.csv);;All Files (*)"
+
         if self.channel_one_box.isChecked():
             filename, _ = save_file_dialog.getSaveFileName(
                 self,
-                "Save CSV file",
-                working_dir + now.strftime("%Y-%m-%d %H-%M-%S") + extra1 + ' data1.csv',
-                filter="All Files (*);;CSV Files (*.csv)",
+                "Save data file",
+                working_dir + now.strftime("%Y-%m-%d %H-%M-%S") + extra1 + ' data1' + extension,
+                filter=file_filter,
                 options=options
             )
             if filename:
                 logging.debug("Saving to: {0}".format(str(filename)))
                 self.filename = filename
                 self.text_box.append(now.strftime("%Y-%m-%d %H:%M:%S") + ": Saving to: {0}".format(str(filename)))
-                self.data_channel_one.to_csv(filename, index=False)
+                recording.write_recording(self.data_channel_one.to_dataframe(), filename, self.session_metadata(1))
                 p = Path(filename)
                 working_dir = str(p.parent) + "\\"
             else:
@@ -1575,64 +1407,20 @@ class MainWindow(QMainWindow):
         if self.channel_two_box.isChecked():
             filename, _ = save_file_dialog.getSaveFileName(
                 self,
-                "Save CSV file",
-                working_dir + now.strftime("%Y-%m-%d %H-%M-%S") + extra2 + ' data2.csv',
-                filter="All Files (*);;CSV Files (*.csv)",
+                "Save data file",
+                working_dir + now.strftime("%Y-%m-%d %H-%M-%S") + extra2 + ' data2' + extension,
+                filter=file_filter,
                 options=options
             )
             if filename:
                 logging.debug("Saving to: {0}".format(str(filename)))
                 self.text_box.append(now.strftime("%Y-%m-%d %H:%M:%S") + ": Saving to: {0}".format(str(filename)))
-                self.data_channel_two.to_csv(filename, index=False)
+                recording.write_recording(self.data_channel_two.to_dataframe(), filename, self.session_metadata(2))
                 p = Path(filename)
                 working_dir = str(p.parent) + "\\"
             else:
                 logging.debug("Not saving file 2.")
 
-            if len(self.raw_data_channel_one) > 0:
-                filename, _ = save_file_dialog.getSaveFileName(
-                    self,
-                    "Save CSV file",
-                    working_dir + now.strftime("%Y-%m-%d %H-%M-%S") + ' raw data1.csv',
-                    filter="All Files (*);;CSV Files (*.csv)",
-                    options=options
-                )
-                if filename:
-                    QApplication.setOverrideCursor(Qt.WaitCursor)
-                    logging.debug("Saving to: {0}".format(str(filename)))
-                    self.text_box.append(now.strftime("%Y-%m-%d %H:%M:%S") + ": Saving to: {0}".format(str(filename)))
-                    raw_data_one = pd.DataFrame(
-                        data=self.raw_data_channel_one,
-                        columns=['flow_voltage'])
-                    raw_data_one.to_csv(filename, index=False)
-                    p = Path(filename)
-                    working_dir = str(p.parent) + "\\"
-                    QApplication.restoreOverrideCursor()
-                else:
-                    logging.debug("Not saving raw data file 1.")
-
-            if len(self.raw_data_channel_two) > 0:
-                filename, _ = save_file_dialog.getSaveFileName(
-                    self,
-                    "Save CSV file",
-                    working_dir + now.strftime("%Y-%m-%d %H-%M-%S") + ' raw data2.csv',
-                    filter="All Files (*);;CSV Files (*.csv)",
-                    options=options
-                )
-                if filename:
-                    QApplication.setOverrideCursor(Qt.WaitCursor)
-                    logging.debug("Saving to: {0}".format(str(filename)))
-                    self.text_box.append(now.strftime("%Y-%m-%d %H:%M:%S") + ": Saving to: {0}".format(str(filename)))
-                    raw_data_two = pd.DataFrame(
-                        data=self.raw_data_channel_two,
-                        columns=['flow_voltage'])
-                    raw_data_two.to_csv(filename, index=False)
-                    p = Path(filename)
-                    working_dir = str(p.parent) + "\\"
-                    QApplication.restoreOverrideCursor()
-                else:
-                    logging.debug("Not saving raw data file 2.")
-
         self.settings.setValue("working_dir", working_dir)
 
     '''
@@ -1653,15 +1441,14 @@ class MainWindow(QMainWindow):
         options = QFileDialog.Options()
         options |= QFileDialog.DontUseNativeDialog
         filename, _ = QFileDialog.getOpenFileName(self, "QFileDialog.getOpenFileName()", "",
-                                                  "Data files (*.csv);;All Files (*)", options=options)
+                                                  "Data files (*.parquet *.csv *.fsraw);;All Files (*)",
+                                                  options=options)
 
         if filename:
             logging.debug("filename: %s", filename)
-            pd_file = pd.read_csv(filename)
-
             try:
-                y = pd_file['flow_voltage']
-            except KeyError as err:
+                loader = recording.RecordingLoader(filename, 'flow_voltage')
+            except (KeyError, ValueError) as err:
                 msg = QMessageBox()
                 msg.setIcon(QMessageBox.Warning)
                 msg.setText("Error")
@@ -1670,82 +1457,145 @@ class MainWindow(QMainWindow):
                 msg.exec_()
                 logging.exception("Incompatible file format. Exception: %s", str(err))
                 return
+            if loader.metadata is not None:
+                logging.debug("Session: %s", loader.metadata)
 
             self.setup_new_data()
 
-            self.x_channel_one = np.array(list(range(len(y)))) / 10
-            self.y_channel_one = y
+            # Keep the whole file, the display window is applied when new data arrives
+            self.x_channel_one = buffers.RingBuffer(None)
+            self.y_channel_one = buffers.RingBuffer(None)
+            self.loaded_period = loader.period
 
             self.filename = filename
-            logging.debug("File loaded, updating graph.")
-
-            self.signalComm.request_graph_update.emit()
+            self.loader = loader
+            worker = Worker(self.load_recording, loader)
+            worker.signals.chunk.connect(lambda values: self.recording_chunk_loaded(loader, values))
+            worker.signals.progress.connect(self.recording_load_progress)
+            worker.signals.error.connect(self.recording_load_error)
+            worker.signals.finished.connect(lambda: self.recording_load_finished(loader))
+            self.threadpool.start(worker)
         else:
             logging.debug("No file selected.")
 
     '''
-    Callback function from timer to update the device combo box.
+    Function to read a recording chunk by chunk, it runs on a worker thread.
     '''
-    def update_combo(self):
-        # logging.debug("update_combo called.")
-        # print('Thread = {}          Function = updateCombo()'.format(threading.currentThread().getName()))
-        combo_ble = False
-        combo_daq = False
-        combo_usb = False
-        for i in range(self.device_combo_sc.count()):
-            if self.device_combo_sc.itemData(i)[0] == "BLE":
-                combo_ble = True
-            if self.device_combo_sc.itemData(i)[0] == "DAQ":
-                combo_daq = True
-            if self.device_combo_sc.itemData(i)[0] == "USB":
-                combo_usb = True
-
-        if len(self.system.devices) > 0 and not combo_daq:
-            combo_daq = True
-            self.timerCombo.setInterval(60000)
+    def load_recording(self, loader, chunk_callback, progress_callback, **kwargs):
+        for values in loader:
+            chunk_callback.emit(values)
+            progress_callback.emit(int(100 * loader.progress))
+        return loader.rows_read
 
-            for device in self.system.devices:
-                now = datetime.now()
-                self.text_box.append(now.strftime("%Y-%m-%d %H:%M:%S") +
-                                     ": Data acquisition system, model {0} detected.".format(device.product_type))
-                self.device_combo_sc.addItem('DAQ: {0}'.format(device.product_type), ["DAQ"])
-                self.device_combo_user.addItem('DAQ: {0}'.format(device.product_type), ["DAQ"])
+    '''
+    Callback function to show a chunk of the recording being loaded.
+    '''
+    def recording_chunk_loaded(self, loader, values):
+        if loader is not self.loader:
+            return
+        start = len(self.y_channel_one)
+        self.x_channel_one.extend((start + np.arange(len(values))) * self.loaded_period)
+        self.y_channel_one.extend(values)
+        self.signalComm.request_graph_update.emit()
 
-                logging.debug("Data acquisition system, model {0} detected.".format(device.product_type))
+    '''
+    Callback function to show the progress of the recording being loaded.
+    '''
+    def recording_load_progress(self, percent):
+        self.statusBar().showMessage("Loading {0}: {1}%".format(self.filename, percent))
 
-        if not self.scanning:
-            if self.BLE_device is not None:
-                pass
+    '''
+    Callback function if the recording could not be loaded.
+    '''
+    def recording_load_error(self, error):
+        exc_type, value, trace = error
+        logging.error("Error loading %s: %s", self.filename, trace)
+        msg = QMessageBox()
+        msg.setIcon(QMessageBox.Warning)
+        msg.setText("Error")
+        msg.setInformativeText('Could not load the file: {0}'.format(value))
+        msg.setWindowTitle("Error")
+        msg.exec_()
 
-        if not self.scanning and self.BLE_device is None and self.useBLE:
-            pass
-            print("combo, launch device_scan")
-            self.scan_for_devices()
+    '''
+    Callback function when the recording is loaded.
+    '''
+    def recording_load_finished(self, loader):
+        if loader is not self.loader or loader.cancelled:
+            return
+        self.loader = None
+        self.statusBar().showMessage("Loaded {0}: {1} samples".format(self.filename, len(self.y_channel_one)), 5000)
+        logging.debug("File loaded, updating graph.")
+        self.signalComm.request_graph_update.emit()
 
-        if self.BLE_scan_complete and not combo_ble:
-            combo_ble = True
-            self.device_combo_sc.addItem('BLE: {0}'.format(self.controller.remoteName()), ["BLE"])
-            self.device_combo_user.addItem('BLE: {0}'.format(self.controller.remoteName()), ["BLE"])
-            self.timerCombo.setInterval(60000)
+    '''
+    Callback function for the devices found by the discovery service.
+    '''
+    def device_added(self, device):
+        if device.kind == "BLE":
+            # Listed once connected and its services are discovered, see ble_device_ready
+            if self.BLE_device is None:
+                self.connect_ble_device(device)
+                self.update_ble_discovery()
+            return
+        if self._device_index(device.kind, device.key) >= 0:
+            return
+        now = datetime.now()
+        self.text_box.append(now.strftime("%Y-%m-%d %H:%M:%S") + ": Device detected: {0}.".format(device.label))
+        logging.debug("Device detected: {0}.".format(device.label))
+        self.device_combo_sc.addItem(device.label, [device.kind, device.key])
+        self.device_combo_user.addItem(device.label, [device.kind, device.key])
+        self._update_start_buttons()
 
-        if not combo_usb:
-            combo_usb = True
-            info = QtSerialPort.QSerialPortInfo()
-            result = [port.portName() for port in info.availablePorts()]
-            for port in result:
-                self.device_combo_sc.addItem('Serial: {0}'.format(port), ["USB", port])
-                self.device_combo_user.addItem('Serial: {0}'.format(port), ["USB", port])
-
-        if combo_ble or combo_daq or combo_usb:
-            self.startButton.setEnabled(True)
-            self.startButton2.setEnabled(True)
-            # self.timerCombo.stop()
-        else:
-            self.startButton.setEnabled(False)
-            self.startButton2.setEnabled(False)
+    '''
+    Callback function for the devices unplugged, the device in use stays listed until the acquisition stops.
+    '''
+    def device_removed(self, device):
+        if device.kind == "BLE":
+            # The connection is followed by the controller, see deviceDisconnected
+            return
+        index = self._device_index(device.kind, device.key)
+        acquiring = self.activeDAQ or self.activeBLE or self.activeUSB
+        if index < 0 or (acquiring and index == self.device_combo_sc.currentIndex()):
+            return
+        now = datetime.now()
+        self.text_box.append(now.strftime("%Y-%m-%d %H:%M:%S") + ": Device removed: {0}.".format(device.label))
+        logging.debug("Device removed: {0}.".format(device.label))
+        self.device_combo_sc.removeItem(index)
+        self.device_combo_user.removeItem(index)
+        self._update_start_buttons()
+
+    '''
+    Function called once the services of the BLE device are discovered, to list it.
+    '''
+    def ble_device_ready(self):
+        key = self.BLE_key
+        if self._device_index("BLE", key) < 0:
+            self.device_combo_sc.addItem('BLE: {0}'.format(self.controller.remoteName()), ["BLE", key])
+            self.device_combo_user.addItem('BLE: {0}'.format(self.controller.remoteName()), ["BLE", key])
+        self._update_start_buttons()
 
-        if combo_ble and combo_daq:
-            self.timerCombo.stop()
+    '''
+    Function to scan for BLE devices only while Bluetooth is enabled and no device is connected.
+    The last device used is tried first, the scan only runs if it cannot be reached.
+    '''
+    def update_ble_discovery(self):
+        if self.useBLE and self.BLE_device is None and self.ble_use_cache:
+            self.connect_cached_ble_device()
+        self.discovery.set_ble_enabled(self.useBLE and self.BLE_device is None)
+
+    def _device_index(self, kind, key):
+        for i in range(self.device_combo_sc.count()):
+            if self.device_combo_sc.itemData(i)[:2] == [kind, key]:
+                return i
+        return -1
+
+    def _update_start_buttons(self):
+        if self.activeDAQ or self.activeBLE or self.activeUSB:
+            return
+        available = self.device_combo_sc.count() > 0
+        self.startButton.setEnabled(available)
+        self.startButton2.setEnabled(available)
 
     '''
     Function to generate the report.
@@ -1765,29 +1615,13 @@ class MainWindow(QMainWindow):
             msg.exec_()
             return
 
-        def func(fx, fa, fb):
-            return fa + fb * fx
-
-        flow_detected_channel_1 = False
-        starting_index_channel_1 = 0
-        stopping_index_channel_1 = 0
-        for i in range(len(self.y_channel_one) - constants.ALGW_FLOW_DETECTION_BLOCK_LEN):
-            cut = self.y_channel_one[i - constants.ALGW_FLOW_DETECTION_BLOCK_LEN:i]
-            if len(cut) < constants.ALGW_FLOW_DETECTION_BLOCK_LEN:
-                continue
-            x = np.linspace(0, len(cut), len(cut))
-            try:
-                popt, pcov = curve_fit(func, x, cut)
-                if popt[1] < constants.ALGW_FLOW_START_NEG_THRESHOLD and not flow_detected_channel_1:
-                    flow_detected_channel_1 = True
-                    starting_index_channel_1 = i
-                if popt[1] > constants.ALGW_FLOW_STOP_POS_THRESHOLD:
-                    if flow_detected_channel_1: stopping_index_channel_1 = i
-                    break
-            except OptimizeWarning as err:
-                logging.exception("report_button_click OptimizeWarning error: %s", str(err))
-            except Exception as err:
-                logging.exception("report_button_click curve_fit error: %s", str(err))
+        y = self.y_channel_one.view()
+        starting_index_channel_1, stopping_index_channel_1 = detection.segment_flow(
+            y,
+            constants.ALGW_FLOW_DETECTION_BLOCK_LEN,
+            constants.ALGW_FLOW_START_NEG_THRESHOLD,
+            constants.ALGW_FLOW_STOP_POS_THRESHOLD
+        )
 
         if starting_index_channel_1 == 0 or stopping_index_channel_1 == 0:
             QApplication.restoreOverrideCursor()
@@ -1807,24 +1641,19 @@ class MainWindow(QMainWindow):
         drop_start = starting_index_channel_1 + constants.DROP_VOLTAGE_START
         drop_stop = stopping_index_channel_1 - constants.DROP_VOLTAGE_STOP
 
-        base_voltage_channel_1 = self.y_channel_one[base_start:base_stop]
-        drop_voltage_channel_1 = self.y_channel_one[drop_start:drop_stop]
+        stats = detection.RangeStats(y)
 
-        avg_base = np.average(base_voltage_channel_1)
-        avg_drop = np.average(drop_voltage_channel_1)
+        avg_base = stats.mean(base_start, base_stop)
+        avg_drop = stats.mean(drop_start, drop_stop)
 
         voltage_drop = avg_base - avg_drop
         percentage_drop = 100 - ((avg_base / avg_drop) * 100)
 
-        max_base_y = np.max(base_voltage_channel_1)
-        max_base_x = np.argmax(base_voltage_channel_1) + base_start
-        min_base_y = np.min(base_voltage_channel_1)
-        min_base_x = np.argmin(base_voltage_channel_1) + base_start
+        max_base_y = stats.max(base_start, base_stop)
+        min_base_y = stats.min(base_start, base_stop)
 
-        max_drop_y = np.max(drop_voltage_channel_1)
-        max_drop_x = np.argmax(drop_voltage_channel_1)
-        min_drop_y = np.min(drop_voltage_channel_1)
-        min_drop_x = np.argmin(drop_voltage_channel_1)
+        max_drop_y = stats.max(drop_start, drop_stop)
+        min_drop_y = stats.min(drop_start, drop_stop)
 
         drop_range = np.abs(max_drop_y - min_drop_y)
 
@@ -1872,16 +1701,27 @@ class MainWindow(QMainWindow):
     def scale_box_changed(self):
         # print(self.ScaleBox.isChecked())
         self.sliderX.setEnabled(not self.ScaleBox.isChecked())
+        self.plot_window_changed()
         # if not self.sliderX.isEnabled():
         #     self.sliderX.set
 
+    '''
+    Function to update the number of points kept in the plot window.
+    The buffers are resized when the next data point arrives.
+    '''
+    def plot_window_changed(self):
+        if self.ScaleBox.isChecked():
+            self.maxX = None
+        else:
+            self.maxX = (self.sliderX.value() + 1) * 6
+
     '''
     Function to start of stop the autosave timer.
     '''
     def autosave_box_changed(self):
         logging.debug("Autosave box changed.")
         if self.autosave_box.isChecked():
-            self.autosave_timer.setInterval(60 * 60 * 1000)
+            self.autosave_timer.setInterval(constants.AUTOSAVE_INTERVAL)
             self.autosave_timer.start()
         else:
             self.autosave_timer.stop()
@@ -1891,14 +1731,7 @@ class MainWindow(QMainWindow):
     '''
     def temperature_fft_box_changed(self):
         logging.debug("Temperature FFT box changed.")
-        if self.temperature_fft_box.isChecked():
-            self.fft_line_channel_one.setData(self.x_temperature_one, self.y_temperature_one)
-            self.fft_line_channel_two.setData(self.x_temperature_two, self.y_temperature_two)
-        else:
-            self.fft_line_channel_one.setData(self.xf_channel_one[0:constants.FFT_N2 // 8],
-                                              self.yf_channel_one[0:constants.FFT_N2 // 8])
-            self.fft_line_channel_two.setData(self.xf_channel_two[0:constants.FFT_N2 // 8],
-                                              self.yf_channel_two[0:constants.FFT_N2 // 8])
+        self.render_spectrum()
         self.fftWidget.enableAutoRange(axis='y')
         self.fftWidget.setAutoVisible(y=True)
     '''
@@ -1917,8 +1750,16 @@ class MainWindow(QMainWindow):
     Callback function for syncing the pump selected on both layouts.
     '''
     def pump_combo_sc_changed(self):
+        self.pump = self.pump_combo_sc.currentData()
         self.pump_combo_user.setCurrentIndex(self.pump_combo_sc.currentIndex())
 
+    '''
+    Callback function to keep the channel flags used during the acquisition up to date.
+    '''
+    def channel_box_changed(self):
+        self.use_channel_one = self.channel_one_box.isChecked()
+        self.use_channel_two = self.channel_two_box.isChecked()
+
     '''
     Callback function for syncing the pump selected on both layouts.
     '''
@@ -1926,87 +1767,95 @@ class MainWindow(QMainWindow):
         self.pump_combo_sc.setCurrentIndex(self.pump_combo_user.currentIndex())
 
     '''
-    Callback function for automatically saving the data every hour.
-    It stops the data acquisition, save the data and starts the data acquisition again.
+    Callback function for automatically saving the data.
+    It appends the rows acquired since the last call to the autosave files on a background thread,
+    without stopping the data acquisition. A new file is started every AUTOSAVE_SEGMENT_SECONDS.
     It uses the last folder selected by the user.
     '''
     def autosave_callback(self):
-        if self.activeDAQ:
-            self.task.stop()
-            working_dir = self.settings.value("working_dir", "")
-            working_dir = working_dir + "temp_data\\"
-            try:
-                os.mkdir(working_dir)
-            except FileExistsError as ex:
-                pass
-            now = datetime.now()
-            sensor_id_box_one_text = self.sensor_id_box_one.text()
-            if sensor_id_box_one_text == "":
-                sensor_id_box_one_text = "Sensor"
-            flow_rate_box_one_text = self.flow_rate_box_one.text()
-            if flow_rate_box_one_text == "":
-                flow_rate_box_one_text = "0"
-            back_pressure_box_one_text = self.back_pressure_box_one.text()
-            if back_pressure_box_one_text == "":
-                back_pressure_box_one_text = "0"
-
-            sensor_id_box_two_text = self.sensor_id_box_two.text()
-            if sensor_id_box_two_text == "":
-                sensor_id_box_two_text = "Sensor"
-            flow_rate_box_two_text = self.flow_rate_box_two.text()
-            if flow_rate_box_two_text == "":
-                flow_rate_box_two_text = "0"
-            back_pressure_box_two_text = self.back_pressure_box_two.text()
-            if back_pressure_box_two_text == "":
-                back_pressure_box_two_text = "0"
-
-            extra1 = self.tester_name_box.text() + ", " + self.pump_combo_sc.currentData() + ", " + sensor_id_box_one_text \
-                     + ", F " + flow_rate_box_one_text + ", BP " + back_pressure_box_one_text
-            extra2 = self.tester_name_box.text() + ", " + self.pump_combo_sc.currentData() + ", " + sensor_id_box_two_text \
-                     + ", F " + flow_rate_box_two_text + ", BP " + back_pressure_box_two_text
-            invalid = r'<>:"/\|?*[]'
-
-            for char in invalid:
-                extra1 = extra1.replace(char, '')
-                extra2 = extra2.replace(char, '')
-
-            extra1 = " [" + extra1 + "]"
-            extra2 = " [" + extra2 + "]"
-
-            if self.channel_one_box.isChecked():
-                filename = working_dir + now.strftime("%Y-%m-%d %H-%M-%S") + extra1 + ' data1.csv'
-                logging.debug("Saving to: {0}".format(str(filename)))
-                self.data_channel_one.to_csv(filename, index=False)
+        if not (self.activeDAQ or self.activeBLE or self.activeUSB):
+            return
+        if self.autosave_writers is None:
+            self.autosave_writers = self.create_autosave_writers()
+        self.flush_autosave()
 
-            if self.channel_two_box.isChecked():
-                filename = working_dir + now.strftime("%Y-%m-%d %H-%M-%S") + extra2 + ' data2.csv'
-                logging.debug("Saving to: {0}".format(str(filename)))
-                self.data_channel_two.to_csv(filename, index=False)
-
-            self.x_channel_one = []
-            self.y_channel_one = []
-            self.xf_channel_one = []
-            self.yf_channel_one = []
-            self.x_channel_two = []
-            self.y_channel_two = []
-            self.xf_channel_two = []
-            self.yf_channel_two = []
-
-            ''' Raw data '''
-            self.raw_data_channel_one = []
-            self.raw_data_channel_two = []
-
-            self.filename = None
-            if self.base_voltage_box is not None:
-                self.base_voltage_box.setData([], [])
-            if self.drop_voltage_box is not None:
-                self.drop_voltage_box.setData([], [])
-            self.data_channel_one = pd.DataFrame(
-                columns=['timestamp', 'time', 'flow_voltage', 'temp_voltage', 'temperature'])
-            self.data_channel_two = pd.DataFrame(
-                columns=['timestamp', 'time', 'flow_voltage', 'temp_voltage', 'temperature'])
-
-            self.task.start()
+    '''
+    Function to create the autosave files writers of the channels in use, None for the others.
+    BLE and serial sensors only use the first channel.
+    '''
+    def create_autosave_writers(self):
+        working_dir = self.settings.value("working_dir", "")
+        working_dir = working_dir + "temp_data\\"
+        try:
+            os.mkdir(working_dir)
+        except FileExistsError as ex:
+            pass
+        sensor_id_box_one_text = self.sensor_id_box_one.text()
+        if sensor_id_box_one_text == "":
+            sensor_id_box_one_text = "Sensor"
+        flow_rate_box_one_text = self.flow_rate_box_one.text()
+        if flow_rate_box_one_text == "":
+            flow_rate_box_one_text = "0"
+        back_pressure_box_one_text = self.back_pressure_box_one.text()
+        if back_pressure_box_one_text == "":
+            back_pressure_box_one_text = "0"
+
+        sensor_id_box_two_text = self.sensor_id_box_two.text()
+        if sensor_id_box_two_text == "":
+            sensor_id_box_two_text = "Sensor"
+        flow_rate_box_two_text = self.flow_rate_box_two.text()
+        if flow_rate_box_two_text == "":
+            flow_rate_box_two_text = "0"
+        back_pressure_box_two_text = self.back_pressure_box_two.text()
+        if back_pressure_box_two_text == "":
+            back_pressure_box_two_text = "0"
+
+        extra1 = self.tester_name_box.text() + ", " + self.pump_combo_sc.currentData() + ", " + sensor_id_box_one_text \
+                 + ", F " + flow_rate_box_one_text + ", BP " + back_pressure_box_one_text
+        extra2 = self.tester_name_box.text() + ", " + self.pump_combo_sc.currentData() + ", " + sensor_id_box_two_text \
+                 + ", F " + flow_rate_box_two_text + ", BP " + back_pressure_box_two_text
+        invalid = r'<>:"/\|?*[]'
+
+        for char in invalid:
+            extra1 = extra1.replace(char, '')
+            extra2 = extra2.replace(char, '')
+
+        extra1 = " [" + extra1 + "]"
+        extra2 = " [" + extra2 + "]"
+
+        extension = '.' + constants.RECORDING_FORMAT
+        writers = []
+        for channel, extra, used in ((1, extra1, self.use_channel_one), (2, extra2, self.use_channel_two)):
+            if not used:
+                writers.append(None)
+                continue
+            writers.append(recording.SegmentWriter(working_dir, extra + ' data{0}'.format(channel) + extension,
+                                                   rotate_seconds=constants.AUTOSAVE_SEGMENT_SECONDS,
+                                                   rotate_rows=constants.AUTOSAVE_SEGMENT_ROWS,
+                                                   metadata=self.session_metadata(channel)))
+        return writers
+
+    '''
+    Function to queue the rows that were not autosaved yet.
+    '''
+    def flush_autosave(self):
+        frames, self.autosave_rows = self.analyzer.rows_since(self.autosave_rows)
+        for writer, frame in zip(self.autosave_writers, frames):
+            if writer is not None:
+                writer.write(frame)
+
+    '''
+    Function to save the last rows and close the autosave files.
+    '''
+    def stop_autosave(self):
+        if self.autosave_writers is not None:
+            self.flush_autosave()
+            for writer in filter(None, self.autosave_writers):
+                writer.close()
+                for path in writer.paths:
+                    logging.debug("Autosaved to: {0}".format(path))
+        self.autosave_writers = None
+        self.autosave_rows = (0, 0)
 
     '''
     Action to close the application.
@@ -2048,6 +1897,7 @@ class MainWindow(QMainWindow):
     def closeEvent(self, event):
 
         if not self.activeDAQ and not self.activeBLE:
+            self.discovery.stop()
             self.save_settings()
             logging.debug("Exiting.")
             event.accept()
@@ -2059,8 +1909,9 @@ class MainWindow(QMainWindow):
 
         if reply == QMessageBox.Yes:
             logging.debug("Canceling data acquisition and exiting.")
-            self.task.stop()
-            self.task.close()
+            self.stop_daq()
+            self.stop_autosave()
+            self.discovery.stop()
             self.save_settings()
             event.accept()
         else:
@@ -2068,43 +1919,46 @@ class MainWindow(QMainWindow):
             event.ignore()
 
 
-try:
-    os.mkdir("log")
-except FileExistsError as ex:
-    pass
-
-logging.basicConfig(
-    filename="log/log.txt",
-    format='%(asctime)s: %(levelname)s - %(message)s',
-    # format='%(asctime)s %(message)s',
-    datefmt='%Y/%m/%d %I:%M:%S',
-    # encoding='utf-8',
-    level=logging.DEBUG
-)
-
-pg.setConfigOptions(antialias=True)
-
-QApplication.setAttribute(Qt.HighDpiScaleFactorRoundingPolicy.PassThrough)
-app = QApplication(sys.argv)
-app.setStyle("Fusion")
-clipboard = app.clipboard()
-
-# Now use a palette to switch to dark colors:
-palette = QPalette()
-palette.setColor(QPalette.Window, QColor(53, 53, 53))
-palette.setColor(QPalette.WindowText, Qt.white)
-palette.setColor(QPalette.Base, QColor(25, 25, 25))
-palette.setColor(QPalette.AlternateBase, QColor(53, 53, 53))
-palette.setColor(QPalette.ToolTipBase, Qt.black)
-palette.setColor(QPalette.ToolTipText, Qt.white)
-palette.setColor(QPalette.Text, Qt.white)
-palette.setColor(QPalette.Button, QColor(53, 53, 53))
-palette.setColor(QPalette.ButtonText, Qt.white)
-palette.setColor(QPalette.BrightText, Qt.red)
-palette.setColor(QPalette.Link, QColor(42, 130, 218))
-palette.setColor(QPalette.Highlight, QColor(42, 130, 218))
-palette.setColor(QPalette.HighlightedText, Qt.black)
-app.setPalette(palette)
-w = MainWindow()
-w.show()
-sys.exit(app.exec_())
+if __name__ == '__main__':
+    try:
+        os.mkdir("log")
+    except FileExistsError as ex:
+        pass
+
+    logging.basicConfig(
+        filename="log/log.txt",
+        format='%(asctime)s: %(levelname)s - %(message)s',
+        # format='%(asctime)s %(message)s',
+        datefmt='%Y/%m/%d %I:%M:%S',
+        # encoding='utf-8',
+        level=logging.DEBUG
+    )
+
+    pg.setConfigOptions(antialias=True)
+
+    QApplication.setAttribute(Qt.HighDpiScaleFactorRoundingPolicy.PassThrough)
+    app = QApplication(sys.argv)
+    app.setStyle("Fusion")
+    clipboard = app.clipboard()
+
+    # Now use a palette to switch to dark colors:
+    palette = QPalette()
+    palette.setColor(QPalette.Window, QColor(53, 53, 53))
+    palette.setColor(QPalette.WindowText, Qt.white)
+    palette.setColor(QPalette.Base, QColor(25, 25, 25))
+    palette.setColor(QPalette.AlternateBase, QColor(53, 53, 53))
+    palette.setColor(QPalette.ToolTipBase, Qt.black)
+    palette.setColor(QPalette.ToolTipText, Qt.white)
+    palette.setColor(QPalette.Text, Qt.white)
+    palette.setColor(QPalette.Button, QColor(53, 53, 53))
+    palette.setColor(QPalette.ButtonText, Qt.white)
+    palette.setColor(QPalette.BrightText, Qt.red)
+    palette.setColor(QPalette.Link, QColor(42, 130, 218))
+    palette.setColor(QPalette.Highlight, QColor(42, 130, 218))
+    palette.setColor(QPalette.HighlightedText, Qt.black)
+    app.setPalette(palette)
+    w = MainWindow()
+    w.show()
+    # Reported once the event loop runs, after the window was first painted
+    QTimer.singleShot(0, lambda: startup.report("Window shown"))
+    sys.exit(app.exec_())
@@ -0,0 +1,365 @@
+import numpy as np
+
+SAMPLE_COLUMNS = ('timestamp', 'time', 'flow_voltage', 'temp_voltage', 'temperature')
+SAMPLE_DTYPES = {
+    'timestamp': np.int64,
+    'time': np.float64,
+    'flow_voltage': np.float64,
+    'temp_voltage': np.float64,
+    'temperature': np.float64,
+}
+
+
+class SampleStore:
+    """
+    Growable columnar store for the processed samples of one channel.
+
+    Every column lives in a preallocated NumPy array. When the arrays are full
+    their capacity is doubled, so appending a sample costs amortized O(1)
+    instead of the O(n) of concatenating a one row DataFrame.
+    The data is only turned into a DataFrame when it is saved or analysed.
+
+    Parameters
+    ----------
+    capacity : int, optional
+        Number of rows allocated up front. Defaults to one hour at 10 Hz.
+    """
+
+    def __init__(self, capacity=36_000):
+        self._size = 0
+        self._columns = {name: np.empty(capacity, dtype=SAMPLE_DTYPES[name]) for name in SAMPLE_COLUMNS}
+
+    def __len__(self):
+        return self._size
+
+    @property
+    def capacity(self):
+        return len(self._columns['timestamp'])
+
+    def append(self, timestamp, time, flow_voltage, temp_voltage, temperature):
+        """
+        Append one row to the store.
+        """
+        if self._size == self.capacity:
+            self._grow(self._size + 1)
+        i = self._size
+        self._columns['timestamp'][i] = timestamp
+        self._columns['time'][i] = time
+        self._columns['flow_voltage'][i] = flow_voltage
+        self._columns['temp_voltage'][i] = temp_voltage
+        self._columns['temperature'][i] = temperature
+        self._size += 1
+
+    def extend(self, timestamp, time, flow_voltage, temp_voltage, temperature):
+        """
+        Append several rows to the store. Each argument is an array with one
+        value per row, or a single value shared by every row.
+        """
+        count = np.broadcast(timestamp, time, flow_voltage, temp_voltage, temperature).size
+        if self._size + count > self.capacity:
+            self._grow(self._size + count)
+        rows = slice(self._size, self._size + count)
+        self._columns['timestamp'][rows] = timestamp
+        self._columns['time'][rows] = time
+        self._columns['flow_voltage'][rows] = flow_voltage
+        self._columns['temp_voltage'][rows] = temp_voltage
+        self._columns['temperature'][rows] = temperature
+        self._size += count
+
+    def column(self, name):
+        """
+        Return a read only view of the stored values of one column.
+        """
+        view = self._columns[name][:self._size]
+        view.flags.writeable = False
+        return view
+
+    def clear(self):
+        """
+        Forget all rows, keeping the allocated memory.
+        """
+        self._size = 0
+
+    def to_dataframe(self, start=0, stop=None):
+        """
+        Build a DataFrame with the rows from `start` to `stop`.
+        """
+        import pandas as pd
+        if stop is None:
+            stop = self._size
+        return pd.DataFrame({name: self._columns[name][start:stop] for name in SAMPLE_COLUMNS},
+                            columns=list(SAMPLE_COLUMNS))
+
+    def _grow(self, minimum):
+        capacity = max(2 * self.capacity, minimum, 1)
+        for name in SAMPLE_COLUMNS:
+            column = np.empty(capacity, dtype=SAMPLE_DTYPES[name])
+            column[:self._size] = self._columns[name][:self._size]
+            self._columns[name] = column
+
+
+class RingBuffer:
+    """
+    FIFO of the most recent values that can be read as one contiguous array.
+
+    A bounded buffer writes every value twice, at ``i`` and ``i + capacity``,
+    so the stored values are always a contiguous slice of the storage and
+    `view` can hand them to the plot without copying. An unbounded buffer
+    (``capacity=None``) keeps every value and doubles its storage when full.
+
+    With `rows`, every value is a column of `rows` values, one per sensor for
+    example, and the buffer is read as a ``(rows, len)`` array.
+
+    Parameters
+    ----------
+    capacity : int or None, optional
+        Maximum number of values kept. None keeps all of them.
+    values : array_like, optional
+        Initial content.
+    dtype : data-type, optional
+        Type of the stored values.
+    rows : int or None, optional
+        Number of values in each column, None for single values.
+    """
+
+    def __init__(self, capacity=None, values=(), dtype=np.float64, rows=None):
+        self._dtype = dtype
+        self._rows = rows
+        self._allocate(capacity, self._columns(values))
+
+    def __len__(self):
+        return self._size
+
+    def __getitem__(self, item):
+        return self.view()[item]
+
+    def __array__(self, dtype=None, copy=None):
+        if dtype is None:
+            return self.view()
+        return self.view().astype(dtype)
+
+    @property
+    def capacity(self):
+        """
+        Maximum number of values kept, None if unbounded.
+        """
+        return self._capacity if self._bounded else None
+
+    def view(self):
+        """
+        Return the stored values, oldest first, without copying.
+        """
+        return self._data[..., self._start:self._start + self._size]
+
+    def append(self, value):
+        """
+        Add one value, dropping the oldest one if the buffer is full.
+        """
+        if not self._bounded:
+            if self._size == self._capacity:
+                self._grow(self._size + 1)
+            self._data[..., self._size] = value
+            self._size += 1
+            return
+
+        position = (self._start + self._size) % self._capacity
+        self._data[..., position] = value
+        self._data[..., position + self._capacity] = value
+        if self._size == self._capacity:
+            self._start = (self._start + 1) % self._capacity
+        else:
+            self._size += 1
+
+    def extend(self, values):
+        """
+        Add several values, dropping the oldest ones if the buffer overflows.
+        """
+        values = self._columns(values)
+        count = values.shape[-1]
+        if count == 0:
+            return
+
+        if not self._bounded:
+            if self._size + count > self._capacity:
+                self._grow(self._size + count)
+            self._data[..., self._size:self._size + count] = values
+            self._size += count
+            return
+
+        if count >= self._capacity:
+            self._data[..., :self._capacity] = values[..., -self._capacity:]
+            self._data[..., self._capacity:] = values[..., -self._capacity:]
+            self._start = 0
+            self._size = self._capacity
+            return
+
+        positions = (self._start + self._size + np.arange(count)) % self._capacity
+        self._data[..., positions] = values
+        self._data[..., positions + self._capacity] = values
+        size = self._size + count
+        if size > self._capacity:
+            self._start = (self._start + size - self._capacity) % self._capacity
+            size = self._capacity
+        self._size = size
+
+    def clear(self):
+        """
+        Forget all values, keeping the allocated memory.
+        """
+        self._start = 0
+        self._size = 0
+
+    def resize(self, capacity):
+        """
+        Change the capacity, keeping the most recent values that still fit.
+        Nothing is reallocated when the capacity does not change.
+        """
+        if capacity == self.capacity:
+            return
+        values = self.view().copy()
+        if capacity is not None:
+            values = values[..., -capacity:] if capacity > 0 else values[..., :0]
+        self._allocate(capacity, values)
+
+    def _columns(self, values):
+        values = np.asarray(values, dtype=self._dtype)
+        return values.ravel() if self._rows is None else values.reshape(self._rows, -1)
+
+    def _shape(self, length):
+        return (length,) if self._rows is None else (self._rows, length)
+
+    def _allocate(self, capacity, values):
+        self._bounded = capacity is not None
+        self._capacity = capacity if self._bounded else max(values.shape[-1], 1024)
+        self._data = np.empty(self._shape(2 * self._capacity if self._bounded else self._capacity),
+                              dtype=self._dtype)
+        self._start = 0
+        self._size = 0
+        self.extend(values)
+
+    def _grow(self, minimum):
+        self._capacity = max(2 * self._capacity, minimum)
+        data = np.empty(self._shape(self._capacity), dtype=self._dtype)
+        data[..., :self._size] = self._data[..., :self._size]
+        self._data = data
+
+
+class MinMaxPyramid:
+    """
+    Multi-resolution minimum and maximum of a growing series, to plot long
+    recordings with a bounded number of points.
+
+    Level ``k`` holds the minimum and maximum of every block of
+    ``factor ** k`` samples. The levels are updated with only the samples
+    added since the last `sync`, so keeping the pyramid up to date costs
+    O(1) amortized per sample. `query` picks the coarsest level that still
+    gives at least one block per requested point, and returns a minimum and a
+    maximum per block, so spikes stay visible however far the plot is zoomed
+    out. Groups of blocks of that level are merged to get close to the
+    number of points requested. NaN values are ignored.
+
+    Parameters
+    ----------
+    factor : int, optional
+        Number of blocks of a level merged in one block of the next level.
+    """
+
+    def __init__(self, factor=8):
+        self.factor = factor
+        self._size = 0
+        self._levels = []
+
+    def __len__(self):
+        return self._size
+
+    def clear(self):
+        """
+        Forget the series.
+        """
+        self._size = 0
+        self._levels = []
+
+    def sync(self, values):
+        """
+        Update the pyramid with the series `values`, of which the first
+        `len(self)` are assumed unchanged. A series shorter than the pyramid
+        starts it over.
+        """
+        values = np.asarray(values)
+        if len(values) < self._size:
+            self.clear()
+        lower_min = lower_max = values
+        level = 0
+        while True:
+            block = self.factor
+            if level == len(self._levels):
+                if len(lower_min) < block:
+                    break
+                self._levels.append((RingBuffer(), RingBuffer()))
+            minimums, maximums = self._levels[level]
+            done = len(minimums)
+            complete = len(lower_min) // block
+            if complete > done:
+                new_min = lower_min[done * block:complete * block].reshape(-1, block)
+                new_max = lower_max[done * block:complete * block].reshape(-1, block)
+                with np.errstate(invalid='ignore'):
+                    minimums.extend(np.fmin.reduce(new_min, axis=1))
+                    maximums.extend(np.fmax.reduce(new_max, axis=1))
+            lower_min, lower_max = minimums.view(), maximums.view()
+            level += 1
+        self._size = len(values)
+
+    def query(self, values, start, stop, points):
+        """
+        Reduce ``values[start:stop]`` to at most about ``2 * points`` values.
+
+        Parameters
+        ----------
+        values : array_like
+            The series given to the last `sync`.
+        start, stop : int
+            The range of samples, clipped to the series.
+        points : int
+            Maximum number of blocks, usually the plot width in pixels.
+        Returns
+        -------
+        index : ndarray
+            Index in the series of each value, the first sample of its block.
+        y : ndarray
+            The values, the minimum then the maximum of each block.
+        """
+        values = np.asarray(values)
+        start = max(int(start), 0)
+        stop = min(int(stop), self._size)
+        if stop <= start:
+            return np.empty(0, dtype=np.int64), np.empty(0)
+
+        level = 0
+        block = 1
+        while level < len(self._levels) and (stop - start) // (block * self.factor) >= points:
+            level += 1
+            block *= self.factor
+        if level == 0:
+            return np.arange(start, stop), values[start:stop]
+
+        minimums, maximums = self._levels[level - 1]
+        first = start // block
+        last = min(-(-stop // block), len(minimums))
+        index = np.arange(first, last) * block
+        low = minimums.view()[first:last]
+        high = maximums.view()[first:last]
+        # The samples after the last complete block
+        tail = values[max(last * block, start):stop]
+        with np.errstate(invalid='ignore'):
+            if len(tail) > 0:
+                index = np.append(index, max(last * block, start))
+                low = np.append(low, np.fmin.reduce(tail))
+                high = np.append(high, np.fmax.reduce(tail))
+            # Merge groups of blocks to get close to the number of points wanted
+            group = -(-len(index) // points)
+            if group > 1:
+                edges = np.arange(0, len(index), group)
+                index = index[edges]
+                low = np.fmin.reduceat(low, edges)
+                high = np.fmax.reduceat(high, edges)
+        return np.repeat(index, 2), np.column_stack((low, high)).ravel()
@@ -1,14 +1,69 @@
 ################################
 # Constants used in flow sensor
 ################################
-from scipy.signal import kaiser
 
 # Fourier Transform
 FFT_N1 = 1024
 FFT_N2 = 16 * 1024
 SAMPLING_RATE = 1.0 / 10.0
 KAISER_WINDOW_BETA = 8
-KAISER_WINDOW = kaiser(FFT_N1, KAISER_WINDOW_BETA)
+FFT_BINS = FFT_N2 // 7 + 1  # only the low frequency band is displayed and analysed
+FFT_HOP = 10  # samples between two spectra, 1 second
+FFT_MODE = 'fft'  # 'fft' every FFT_HOP samples or 'sliding' DFT updated every sample
+
+# Plot, long series are reduced to a minimum and a maximum per pixel
+PLOT_PYRAMID_FACTOR = 8
+PLOT_MAX_POINTS_PER_PIXEL = 4  # series longer than this are reduced
+
+# Redraws are grouped in frames at most RENDER_FPS times per second
+RENDER_FPS = 25
+
+# Device discovery, DAQ devices, serial ports and BLE sensors are scanned in the background
+DISCOVERY_INTERVAL = 2  # seconds between two scans
+BLE_CONNECT_TIMEOUT = 5000  # ms to reach the last BLE sensor used before scanning for it
+
+# Serial sensors, 'binary' frames, legacy 'text' lines, or 'auto' to detect it, see protocol.SerialDecoder
+SERIAL_PROTOCOL = 'auto'
+
+# Sequence accounting of the BLE and serial packets, see protocol.SequenceTracker
+# Lost samples 'interpolate'd, or 'nan', recorded as is, which blanks the spectra and stalls the detection for a window
+LINK_GAP_FILL = 'interpolate'
+LINK_MAX_GAP = 600  # longest gap filled, in samples, 1 minute
+LINK_METRICS_INTERVAL = 1000  # ms between two updates of the status bar
+
+# Sensors, read on two analog inputs each, ai(2k+1) for the flow voltage and ai(2k) for the temperature voltage
+MAX_SENSORS = 8
+# Series resistance of the thermistor divider of each sensor, in ohm, measured on the two first boards,
+# the nominal 2.7 kohm for the others
+THERMISTOR_SERIES_RESISTANCE = (2983, 2688) + (2700,) * (MAX_SENSORS - 2)
+
+# DAQ acquisition
+DAQ_SAMPLE_RATE = 10_000  # Hz
+DAQ_BLOCK_SIZE = 1_000  # samples per channel read in each callback
+DAQ_QUEUE_SLOTS = 50  # blocks waiting to be processed, 5 seconds
+
+# Raw capture to disk
+RAW_CHUNK_SAMPLES = 10_000  # samples per channel written at once, 1 second
+RAW_CHUNKS = 8  # chunks in memory waiting to be written
+
+# Processed recordings, 'parquet' (compressed, with the session metadata) or 'csv'
+RECORDING_FORMAT = 'parquet'
+RECORDING_COMPRESSION = 'zstd'
+LOAD_CHUNK_ROWS = 100_000  # rows read at once when opening a recording
+
+# Autosave, only the new rows are appended at every flush
+AUTOSAVE_INTERVAL = 60 * 1000  # ms between two flushes
+AUTOSAVE_SEGMENT_SECONDS = 60 * 60  # a new file every hour, None for no limit
+AUTOSAVE_SEGMENT_ROWS = None  # maximum rows per file, None for no limit
+
+# Headless acquisition, see headless.py
+HEADLESS_WINDOW = 6_000  # samples kept in memory for the analysis, 10 minutes
+HEADLESS_FLUSH_INTERVAL = 10  # seconds between two writes of the new rows
+
+# DAQ decimation, 10 kHz down to 10 Hz
+# filter of each stage, 'iir' (Chebyshev type II) or 'fir' (linear phase)
+DECIMATION_FACTORS = (10, 10, 10)
+DECIMATION_FILTERS = ('iir', 'iir', 'iir')
 
 # Flow detection for Alaris GW Cardinal Health
 ALGW_FLOW_DETECTION_BLOCK_LEN = 128
@@ -38,3 +93,11 @@ DROP_VOLTAGE_STOP = 100
 
 # Signal peak detection constants
 MIN_PEAKS = 0.02  # mV - 20uV
+
+
+def __getattr__(name):
+    # The window is only computed when first used, so importing the constants stays cheap
+    if name == 'KAISER_WINDOW':
+        from spectral import kaiser_window
+        return kaiser_window(FFT_N1, KAISER_WINDOW_BETA)
+    raise AttributeError("module {0!r} has no attribute {1!r}".format(__name__, name))
@@ -0,0 +1,689 @@
+import logging
+import sys
+import threading
+import time
+import timeit
+from collections import deque
+from datetime import datetime
+from decimal import Decimal
+
+import numpy as np
+
+import buffers
+import constants
+import detection
+import pipeline
+import recording
+import spectral
+
+
+def thermistor_temperature(voltage, series_resistance):
+    """
+    Temperature in degrees Celsius of the NTC thermistor of a sensor, from the voltage across it in a divider
+    with `series_resistance` powered at 5.039 V. Voltages that cannot be converted give 0.0.
+    """
+    beta = 3976
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        resistance = series_resistance / ((5.039 / np.asarray(voltage, dtype=np.float64)) - 1)
+        ratio = np.log(resistance / (2000 * np.exp(- beta / 298.15)))
+        temperature = beta / ratio - 273.15
+    return np.where(np.isfinite(resistance) & (resistance > 0) & np.isfinite(temperature), temperature, 0.0)
+
+
+def spectral_flow(magnitude):
+    """
+    Flow of an Alaris GW pump estimated from the amplitude spectrum of its flow voltage: the frequency of the
+    highest peak, or of the second highest one when the highest is below bin 30. NaN without peaks.
+    """
+    from scipy import signal
+
+    def freq_to_flow(frequency):
+        return frequency / 0.001251233545
+    # 0.00123995
+    # 0.001251233545
+
+    yf = np.copy(magnitude)
+    peaks, properties = signal.find_peaks(yf, constants.MIN_PEAKS)
+    if len(properties['peak_heights']) > 0:
+        index_max = np.argmax(properties['peak_heights'])
+        if peaks[index_max] < 30:
+            properties['peak_heights'] = np.delete(properties['peak_heights'], index_max)
+            peaks = np.delete(peaks, index_max)
+            if len(properties['peak_heights']) > 0:
+                index_max = np.argmax(properties['peak_heights'])
+                value = freq_to_flow((peaks[index_max] / constants.FFT_N2) / constants.SAMPLING_RATE)
+            else:
+                value = np.nan
+        else:
+            value = freq_to_flow((peaks[index_max] / constants.FFT_N2) / constants.SAMPLING_RATE)
+    else:
+        value = np.nan
+    return value
+
+
+def _sensor_attribute(name, sensor):
+    # The state of the first two sensors under the names of the original two channel analysis
+    return property(lambda self: getattr(self, name)[sensor],
+                    lambda self, value: getattr(self, name).__setitem__(sensor, value))
+
+
+class FlowAnalyzer:
+    """
+    Analysis of the decimated samples of the sensors: the plotted series, the
+    recorded rows, the spectra and the flow detection and estimation of the
+    selected pump.
+
+    The samples of all the sensors are processed together, as arrays shaped
+    (sensors, samples): the temperatures, the slopes of the flow detection,
+    the spectra and the flow estimates of every sensor are computed by the
+    same NumPy operations. Only the plotted series and the recorded rows are
+    kept per sensor. The state of the first two sensors is also available
+    under the names of the original two channel analysis, `x_channel_one` or
+    `flow_detected` for example, which is the flow state of the first sensor.
+
+    It has no user interface, the GUI and the headless daemon are both
+    clients. `add_sensor_block`, `add_data_block` and `add_data_point` can be
+    called from any thread, the readers must hold `lock` while they use the
+    data.
+
+    :param max_points: Number of samples kept in the series, None keeps all of them.
+    :param pump: The pump, "ALGW" or "BBPS", selecting the flow detection.
+    :param on_event: Function called with the time and a message when the flow of a sensor starts or stops.
+    :param sensors: Number of sensors, up to constants.MAX_SENSORS unless `series_resistance` is given.
+    :param series_resistance: Series resistance of the thermistor of each sensor, in ohms, those of
+        constants.THERMISTOR_SERIES_RESISTANCE by default.
+    """
+
+    x_channel_one = _sensor_attribute('x_flow', 0)
+    y_channel_one = _sensor_attribute('y_flow', 0)
+    x_channel_two = _sensor_attribute('x_flow', 1)
+    y_channel_two = _sensor_attribute('y_flow', 1)
+    x_temperature_one = _sensor_attribute('x_temperature', 0)
+    y_temperature_one = _sensor_attribute('y_temperature', 0)
+    x_temperature_two = _sensor_attribute('x_temperature', 1)
+    y_temperature_two = _sensor_attribute('y_temperature', 1)
+    xf_channel_one = _sensor_attribute('xf', 0)
+    yf_channel_one = _sensor_attribute('yf', 0)
+    xf_channel_two = _sensor_attribute('xf', 1)
+    yf_channel_two = _sensor_attribute('yf', 1)
+    data_channel_one = _sensor_attribute('records', 0)
+    data_channel_two = _sensor_attribute('records', 1)
+    sample_count_one = _sensor_attribute('sample_counts', 0)
+    sample_count_two = _sensor_attribute('sample_counts', 1)
+    use_channel_one = _sensor_attribute('use_sensor', 0)
+    use_channel_two = _sensor_attribute('use_sensor', 1)
+    flow_detected = _sensor_attribute('flows_detected', 0)
+    last_flow = _sensor_attribute('last_flows', 0)
+    BBPS_base_voltage = _sensor_attribute('BBPS_base_voltages', 0)
+    values_deque = _sensor_attribute('flow_values', 0)
+    spectral_flow_value = _sensor_attribute('spectral_flow_values', 0)
+
+    def __init__(self, max_points=None, pump=None, on_event=None, sensors=2, series_resistance=None):
+        if series_resistance is None:
+            if not 0 < sensors <= constants.MAX_SENSORS:
+                raise ValueError('invalid number of sensors')
+            series_resistance = constants.THERMISTOR_SERIES_RESISTANCE[:sensors]
+        elif not 0 < sensors == len(series_resistance):
+            raise ValueError('invalid number of sensors')
+        self.max_points = max_points
+        self.pump = pump
+        self.on_event = on_event
+        self.sensors = sensors
+        self.use_sensor = np.ones(sensors, dtype=bool)
+        self.series_resistance = np.array(series_resistance, dtype=np.float64)
+        self.lock = threading.Lock()
+
+        ''' Flow '''
+        self.flows_detected = np.zeros(sensors, dtype=bool)
+        self.BBPS_base_voltages = [None] * sensors
+        self.last_flows = np.full(sensors, time.time() - 11)
+        self.fft_peak = 0
+
+        ''' Flow estimation through frequency components '''
+        # One estimate per sample and sensor, like the deque of the original analysis
+        self.flow_values = buffers.RingBuffer(constants.MAX_DEQUE_SIZE, rows=sensors)
+        self.spectra = spectral.SpectralEstimator(channels=sensors)
+
+        ''' Flow detection through the slope of the signal '''
+        self.ALGW_slopes = detection.SlidingSlope(constants.ALGW_FLOW_DETECTION_BLOCK_LEN, rows=sensors)
+        self.BBPS_slopes = detection.SlidingSlope(constants.BBPS_FLOW_DETECTION_BLOCK_LEN, rows=sensors)
+
+        self.reset()
+
+    def reset(self):
+        """
+        Forget the data, to start a new acquisition.
+        """
+        sensors = range(self.sensors)
+        self.x_flow = [buffers.RingBuffer(self.max_points) for _ in sensors]
+        self.y_flow = [buffers.RingBuffer(self.max_points) for _ in sensors]
+        self.x_temperature = [buffers.RingBuffer(self.max_points) for _ in sensors]
+        self.y_temperature = [buffers.RingBuffer(self.max_points) for _ in sensors]
+        self.xf = [[] for _ in sensors]
+        self.yf = [[] for _ in sensors]
+        self.sample_counts = np.zeros(self.sensors, dtype=np.int64)
+
+        self.spectra.reset()
+        self.spectral_flow_values = np.full(self.sensors, np.nan)
+        self.ALGW_slopes.reset()
+        self.BBPS_slopes.reset()
+
+        self.records = [buffers.SampleStore() for _ in sensors]
+        self.timeCounter = Decimal('0.0')
+
+    def load_backends(self):
+        """
+        Import the libraries of the analysis now. They are otherwise imported
+        by the first sample that needs them, which would stall the
+        acquisition, so this is called before an acquisition starts.
+        """
+        import pandas
+        from scipy import fft, signal
+
+    def series(self):
+        """
+        The plotted series, the sample times and values of the flow and the temperature of each sensor.
+        """
+        return tuple(series for sensor in zip(self.x_flow, self.y_flow, self.x_temperature, self.y_temperature)
+                     for series in sensor)
+
+    def rows_since(self, counts):
+        """
+        Return the rows of the first ``len(counts)`` sensors recorded after the first `counts` ones, as
+        DataFrames, and the new counts.
+        """
+        with self.lock:
+            frames = []
+            rows = []
+            for store, saved in zip(self.records, counts):
+                frames.append(store.to_dataframe(start=saved))
+                rows.append(len(store))
+        return frames, tuple(rows)
+
+    def drain_rows(self):
+        """
+        Return the rows recorded of each sensor, as DataFrames, and forget them.
+        """
+        with self.lock:
+            frames = []
+            for store in self.records:
+                frames.append(store.to_dataframe())
+                store.clear()
+        return frames
+
+    def flow_estimates(self):
+        """
+        Return the flow estimated for each sensor, NaN while no steady flow is detected.
+
+        ALGW: the mean of the flows estimated from the spectrum over the last MAX_DEQUE_SIZE samples, once
+        more than 20 are known and their standard deviation is at most half their mean.
+        BBPS: from the voltage drop since the flow started, 0 out of the linear region.
+        """
+        estimates = np.full(self.sensors, np.nan)
+        with self.lock:
+            if self.pump == "ALGW":
+                values = self.flow_values.view()
+                if values.shape[1] > 20:
+                    with np.errstate(divide='ignore', invalid='ignore'):
+                        mean = np.mean(values, axis=1)
+                        steady = np.abs(np.std(values, axis=1) / mean) <= 0.5
+                    steady &= self.flows_detected
+                    estimates[steady] = np.maximum(mean[steady], 0)
+            elif self.pump == "BBPS":
+                base = np.array([np.nan if v is None else v for v in self.BBPS_base_voltages])
+                for sensor in np.flatnonzero(~np.isnan(base)):
+                    delta = np.abs(np.average(self.y_flow[sensor][-5:]) - base[sensor])
+                    estimates[sensor] = 0 if delta > 2 else np.exp((delta + constants.BBPS_A) / constants.BBPS_B)
+        return estimates
+
+    def add_data_point(self, data_one=None, data_two=None):
+        """
+        Analyse one decimated sample of each of the two first sensors, a tuple of the flow voltage in mV and
+        the temperature voltage, or None for a sensor that is not used. Returns True if a spectrum was
+        updated.
+        """
+        return self.add_data_block(None if data_one is None else np.reshape(data_one, (2, 1)),
+                                   None if data_two is None else np.reshape(data_two, (2, 1)))
+
+    def add_data_block(self, block_one=None, block_two=None):
+        """
+        Analyse consecutive decimated samples of the two first sensors at once. A block is a pair of arrays,
+        the flow voltages in mV and the temperature voltages, or a (2, n) array, or None for a sensor that
+        is not used. Returns True if a spectrum was updated, see `add_sensor_block`.
+        """
+        blocks = [(sensor, np.asarray(block, dtype=np.float64).reshape(2, -1))
+                  for sensor, block in enumerate((block_one, block_two)) if block is not None]
+        if not blocks:
+            return False
+        sensors = [sensor for sensor, _ in blocks]
+        samples = np.stack([block for _, block in blocks], axis=1)
+        with self.lock:
+            updated = self._add_samples(samples[0], samples[1], sensors)
+            if block_one is None:
+                # The series of the first sensor keep the time axis of the plot, as zeros
+                count = samples.shape[2]
+                self.x_flow[0].extend((self.sample_counts[0] + np.arange(count)) * constants.SAMPLING_RATE)
+                self.y_flow[0].extend(np.zeros(count))
+                self.sample_counts[0] += count
+        return updated
+
+    def add_sensor_block(self, flow_voltage, temp_voltage, sensors=None):
+        """
+        Analyse consecutive decimated samples of several sensors at once, the flow voltages in mV and the
+        temperature voltages shaped (len(sensors), n), `sensors` being the indices of their sensors, all of
+        them by default. The temperatures are converted, the samples buffered, and the spectra and the flow
+        detection updated once per block for all the sensors. Returns True if a spectrum was updated.
+        """
+        sensors = np.arange(self.sensors) if sensors is None else np.asarray(sensors, dtype=np.intp)
+        flow_voltage = np.asarray(flow_voltage, dtype=np.float64).reshape(len(sensors), -1)
+        temp_voltage = np.asarray(temp_voltage, dtype=np.float64).reshape(len(sensors), -1)
+        with self.lock:
+            return self._add_samples(flow_voltage, temp_voltage, sensors)
+
+    def _add_samples(self, flow_voltage, temp_voltage, sensors):
+        count = flow_voltage.shape[1]
+        if count == 0:
+            return False
+        for series in self.series():
+            series.resize(self.max_points)
+
+        timestamp = round(time.time() * 1000)
+        # The time column counts tenths of seconds, as exact as the Decimal counter
+        times = (int(self.timeCounter * 10) + np.arange(count)) / 10
+        temperature = thermistor_temperature(temp_voltage, self.series_resistance[sensors, None])
+
+        for row, sensor in enumerate(sensors):
+            x = (self.sample_counts[sensor] + np.arange(count)) * constants.SAMPLING_RATE
+            self.x_flow[sensor].extend(x)
+            self.x_temperature[sensor].extend(x)
+            self.y_flow[sensor].extend(flow_voltage[row])
+            self.y_temperature[sensor].extend(temperature[row])
+            self.records[sensor].extend(timestamp, times, flow_voltage[row], temp_voltage[row], temperature[row])
+        self.sample_counts[sensors] += count
+
+        # The slopes and the spectra of all the sensors advance together, with zeros for the ones not sampled
+        if len(sensors) == self.sensors:
+            flow = flow_voltage[np.argsort(sensors)]
+        else:
+            flow = np.zeros((self.sensors, count))
+            flow[sensors] = flow_voltage
+        self.ALGW_slopes.extend(flow)
+        self.BBPS_slopes.extend(flow)
+        ''' FFT'''
+        spectrum_updated = self.spectra.extend(flow)
+        if spectrum_updated:
+            magnitude = self.spectra.magnitude
+            for sensor in sensors:
+                self.xf[sensor] = self.spectra.freqs
+                self.yf[sensor] = magnitude[sensor]
+
+        self.timeCounter += Decimal('0.1') * count
+
+        self.fft_peak = np.max(self.spectra.magnitude[sensors]) if self.spectra.ready else 0
+
+        # The flow is detected on the sensors sampled and used
+        active = np.zeros(self.sensors, dtype=bool)
+        active[sensors] = True
+        active &= self.use_sensor
+
+        # Alaris GW Cardinal Health pump
+        if self.pump == "ALGW":
+            ''' Flow estimation through frequency components '''
+            # The peaks are only searched again when the spectra changed, one value is kept per sample
+            if self.spectra.ready:
+                if spectrum_updated:
+                    for sensor in sensors:
+                        self.spectral_flow_values[sensor] = spectral_flow(self.yf[sensor])
+                self.flow_values.extend(np.repeat(self.spectral_flow_values[:, None], count, axis=1))
+
+            ''' Flow detection '''
+            active &= self.sample_counts > constants.ALGW_FLOW_DETECTION_BLOCK_LEN
+            slopes = self.ALGW_slopes.slope
+            started, stopped = self._detect(slopes, active, constants.ALGW_FLOW_START_NEG_THRESHOLD,
+                                            constants.ALGW_FLOW_STOP_POS_THRESHOLD)
+
+        # B Braun Perfusor Space pump
+        elif self.pump == "BBPS":
+            '''Flow Detection'''
+            active &= self.sample_counts > constants.BBPS_FLOW_DETECTION_BLOCK_LEN
+            slopes = self.BBPS_slopes.slope
+            started, stopped = self._detect(slopes, active, constants.BBPS_FLOW_START_NEG_THRESHOLD,
+                                            constants.BBPS_FLOW_STOP_POS_THRESHOLD)
+            for sensor in started:
+                # first detection of the flow, get the base voltage
+                self.BBPS_base_voltages[sensor] = np.average(self.y_flow[sensor][
+                                                             constants.BBPS_START:constants.BBPS_STOP])
+                logging.debug("Sensor {0}: BBPS base voltage: {1}".format(sensor + 1, self.BBPS_base_voltages[sensor]))
+            for sensor in stopped:
+                # flow stoped
+                self.BBPS_base_voltages[sensor] = None
+        else:
+            return spectrum_updated
+
+        now = datetime.now()
+        for sensor in started:
+            logging.debug("Flow detected, sensor: {0}, b: {1}".format(sensor + 1, slopes[sensor]))
+            self._event(now, "Sensor {0}: Flow detected.".format(sensor + 1))
+        for sensor in stopped:
+            logging.debug("Flow stopped, sensor: {0}, b: {1}".format(sensor + 1, slopes[sensor]))
+            self._event(now, "Sensor {0}: Flow stopped.".format(sensor + 1))
+
+        return spectrum_updated
+
+    def _detect(self, slopes, active, start_threshold, stop_threshold):
+        # Flow state of every sensor at once, returns the sensors whose flow started and stopped
+        with np.errstate(invalid='ignore'):
+            start = active & (slopes < start_threshold)
+            stop = active & (slopes > stop_threshold)
+        started = np.flatnonzero(start & ~self.flows_detected)
+        stopped = np.flatnonzero(stop & self.flows_detected)
+        self.flows_detected[start] = True
+        self.flows_detected[stop] = False
+        self.last_flows[stopped] = time.time()
+        return started, stopped
+
+    def _event(self, now, message):
+        logging.info(message)
+        if self.on_event is not None:
+            self.on_event(now, message)
+
+
+class DaqAcquisition:
+    """
+    Continuous acquisition of the sensor channels of a NI DAQ.
+
+    The driver callback only reads each block into a slot of a `BlockRing`.
+    A `BlockConsumer` thread optionally saves the raw samples, decimates
+    them to 10 Hz and calls `on_data_block` with the decimated flow voltages
+    in mV and temperature voltages of all the sensors, shaped (sensors, n),
+    and the indices of the sensors, as `FlowAnalyzer.add_sensor_block`
+    expects. Sensor k is read on ai(2k+1), the flow voltage, and ai(2k), the
+    temperature voltage.
+
+    The blocks are numbered by the driver callback, dropped ones included, so
+    the number of the block being passed to `on_data_block`, `block_number`,
+    identifies the same samples on devices sharing a sample clock, see
+    `SynchronizedDaqAcquisition`.
+
+    :param device: Name of the DAQ device.
+    :param sensors: Indices of the sensors to read, from 0 to constants.MAX_SENSORS - 1.
+    :param on_data_block: Function called on the worker thread with the decimated samples of each block.
+    :param raw_path: File to stream the raw samples to, see `recording.RawWriter`, None to not save them.
+    """
+
+    def __init__(self, device, sensors, on_data_block, raw_path=None):
+        # The driver and the filter design are only loaded once a DAQ is used
+        import filters
+        if not all(0 <= sensor < constants.MAX_SENSORS for sensor in sensors):
+            raise ValueError('invalid sensor')
+        self.device = device
+        self.sensors = list(sensors)
+        self.on_data_block = on_data_block
+        self.raw_path = raw_path
+        self.decimator = filters.Decimator(constants.DECIMATION_FACTORS, constants.DECIMATION_FILTERS)
+        self.task = None
+        self.blocks = None
+        self.consumer = None
+        self.reader = None
+        self.spare_block = None
+        self.raw_writer = None
+        self.discard = True
+        self.discard_counter = 9
+        self.tempos = []
+        # Python memory blocks allocated by each callback, only an estimate since other threads also allocate
+        self.allocations = np.zeros(600, dtype=np.int64)
+        # Samples per channel still in the driver buffer after each callback, how late the callbacks are
+        self.backlog = np.zeros(600, dtype=np.int64)
+        self.callback_count = 0
+        # Number and arrival time of the blocks queued, and of the block being processed
+        self.arrivals = deque()
+        self.block_number = None
+        self.block_arrival = None
+
+    def configure(self, clock_source=None, start_trigger=None):
+        """
+        Create and configure the task without starting it.
+
+        :param clock_source: Terminal of the sample clock, the internal clock of the device by default.
+        :param start_trigger: Terminal of a digital start trigger, the task starts at once by default.
+        """
+        self.discard = True
+        self.discard_counter = 9
+        import nidaqmx
+        from nidaqmx.constants import AcquisitionType, TerminalConfiguration
+        from nidaqmx.stream_readers import AnalogMultiChannelReader
+
+        self.decimator.reset()
+        self.task = nidaqmx.Task()
+
+        for sensor in self.sensors:
+            channel = "{0}/ai{1}".format(self.device, 2 * sensor + 1)
+            _ = self.task.ai_channels.add_ai_voltage_chan(channel,
+                                                          terminal_config=TerminalConfiguration.DIFFERENTIAL)
+            channel = "{0}/ai{1}".format(self.device, 2 * sensor)
+            _ = self.task.ai_channels.add_ai_voltage_chan(channel,
+                                                          terminal_config=TerminalConfiguration.RSE)
+
+        self.blocks = pipeline.BlockRing(
+            constants.DAQ_QUEUE_SLOTS, len(self.task.ai_channels), constants.DAQ_BLOCK_SIZE)
+        self.spare_block = np.empty((len(self.task.ai_channels), constants.DAQ_BLOCK_SIZE))
+        self.reader = AnalogMultiChannelReader(self.task.in_stream)
+        self.callback_count = 0
+        self.arrivals.clear()
+        if self.raw_path is not None:
+            self.raw_writer = recording.RawWriter(self.raw_path, self.task.ai_channels.channel_names,
+                                                  constants.DAQ_SAMPLE_RATE)
+            logging.debug("Saving raw data to: {0}".format(self.raw_path))
+        self.consumer = pipeline.BlockConsumer(self.blocks, self.process_block)
+        self.consumer.start()
+        self.task.timing.cfg_samp_clk_timing(constants.DAQ_SAMPLE_RATE, source=clock_source or "",
+                                             sample_mode=AcquisitionType.CONTINUOUS)
+        if start_trigger is not None:
+            self.task.triggers.start_trigger.cfg_dig_edge_start_trig(start_trigger)
+        self.task.register_every_n_samples_acquired_into_buffer_event(constants.DAQ_BLOCK_SIZE, self.callback)
+
+    def start(self):
+        """
+        Start the acquisition, configuring the task first if `configure` was not called.
+        """
+        if self.task is None:
+            self.configure()
+        self.task.start()
+        logging.debug("Start DAQ data acquisition: {0}.".format(self.device))
+
+    def stop(self):
+        """
+        Stop the task, process the blocks still queued and close the raw data file.
+        """
+        self.task.stop()
+        self.task.close()
+        self.task = None
+        self.consumer.stop()
+        if self.raw_writer is not None:
+            self.raw_writer.close()
+            logging.debug("Raw data saved: {0} samples in {1}".format(self.raw_writer.samples, self.raw_path))
+        logging.debug("Stop DAQ data acquisition. Queue overruns: %s", self.blocks.overruns)
+
+    def callback(self, task_handle, every_n_samples_event_type, number_of_samples, callback_data):
+        # Runs on the driver thread: only read the samples and hand them to the worker.
+        # The samples are read straight into a slot of the queue, so nothing is allocated here.
+        try:
+            allocated_blocks = sys.getallocatedblocks()
+            sample = self.blocks.acquire()
+            if sample is None:
+                # The queue is full: still read the block so the driver buffer does not overflow, and drop it
+                self.reader.read_many_sample(self.spare_block, number_of_samples_per_channel=constants.DAQ_BLOCK_SIZE)
+                logging.warning("DAQ queue full, blocks dropped: %s", self.blocks.overruns)
+            else:
+                self.reader.read_many_sample(sample, number_of_samples_per_channel=constants.DAQ_BLOCK_SIZE)
+                self.arrivals.append((self.callback_count, time.perf_counter()))
+                self.blocks.commit()
+            self.allocations[self.callback_count % len(self.allocations)] = \
+                sys.getallocatedblocks() - allocated_blocks
+            self.backlog[self.callback_count % len(self.backlog)] = self.task.in_stream.avail_samp_per_chan
+            self.callback_count += 1
+        except Exception as err:
+            logging.exception("daq_callback error: : %s", str(err))
+        return 0
+
+    def process_block(self, sample):
+        """
+        Process one block read from the DAQ, on the worker thread.
+        """
+        start_time = timeit.default_timer()
+        self.block_number, self.block_arrival = self.arrivals.popleft()
+        if self.raw_writer is not None:
+            self.raw_writer.write(sample)
+
+        sample = self.decimator(sample)
+        if self.discard:
+            self.discard_counter -= 1
+            if self.discard_counter < 1:
+                self.discard = False
+            return
+
+        if sample.shape[-1] == 0:
+            return
+
+        # The channels alternate flow and temperature voltages, sensor after sensor
+        self.on_data_block(1000 * sample[0::2], sample[1::2], self.sensors)
+
+        self.tempos.append(timeit.default_timer() - start_time)
+        if len(self.tempos) % 600 == 0:
+            logging.debug("[DAQ processing time] Mean: {:.4f}s, Deviation: {:.2e}s, Max: {:.4f}s".format(
+                np.mean(self.tempos), np.std(self.tempos), max(self.tempos)))
+            logging.debug("[DAQ queue] Depth: {0}, Max depth: {1}/{2}, Overruns: {3}".format(
+                self.blocks.depth, self.blocks.max_depth, self.blocks.slots, self.blocks.overruns))
+            calls = min(self.callback_count, len(self.allocations))
+            logging.debug("[DAQ callback allocations] Mean: {:.1f} blocks, Max: {} blocks".format(
+                np.mean(self.allocations[:calls]), np.max(self.allocations[:calls], initial=0)))
+            logging.debug("[DAQ callback backlog] {0}: Mean: {1:.0f} samples, Max: {2} samples".format(
+                self.device, np.mean(self.backlog[:calls]), np.max(self.backlog[:calls], initial=0)))
+            self.tempos = []
+
+
+class SynchronizedDaqAcquisition:
+    """
+    Acquisition of the sensors of several NI DAQ devices as one stream.
+
+    The first device is the master. The others take its sample clock, or only
+    its start trigger, and are started before it, so the block number k of
+    every device covers the same instants. Each device keeps its own
+    `DaqAcquisition`, with its driver callback, queue, worker thread, raw file
+    and decimator, so the devices are read and decimated in parallel. Their
+    decimated blocks are matched by block number and `on_data_block` is called
+    once per block with the samples of all the sensors, those of the master
+    first, numbered from 0 in that order. A block dropped by one device is
+    dropped for every device, so the stream stays aligned.
+
+    The lag of every device is logged every 600 blocks: the samples left in
+    its driver buffer by each callback, and how much later than the first
+    device its blocks arrive, which grows when its callbacks fall behind.
+
+    :param devices: Sequence of pairs, the name of a device and the indices of the sensors to read on it.
+    :param on_data_block: Function called with the merged blocks, see `FlowAnalyzer.add_sensor_block`.
+    :param raw_path: Raw data file name with a ``{device}`` field, one file per device, None to not save them.
+    :param sync: 'clock' to share the sample clock of the master, 'trigger' to only share its start trigger,
+        the devices then drift apart by the tolerance of their clocks.
+    :param terminal: Terminal the master exports its clock or trigger on, "PFI0" for example, wired to the
+        same terminal of the other devices. By default the signal of the master is routed by the driver,
+        which needs the devices in a PXI chassis or linked by a RTSI cable registered in NI MAX.
+    """
+
+    def __init__(self, devices, on_data_block, raw_path=None, sync='clock', terminal=None):
+        if sync not in ('clock', 'trigger'):
+            raise ValueError('invalid sync')
+        if not devices:
+            raise ValueError('no device')
+        self.on_data_block = on_data_block
+        self.sync = sync
+        self.terminal = terminal
+        self.acquisitions = []
+        for index, (device, sensors) in enumerate(devices):
+            path = None if raw_path is None else raw_path.format(device=device)
+            self.acquisitions.append(DaqAcquisition(device, sensors, self._device_block(index), path))
+        # Device and sensor on it of every sensor of the stream
+        self.channels = [(daq.device, sensor) for daq in self.acquisitions for sensor in daq.sensors]
+        self.sensors = list(range(len(self.channels)))
+        self.dropped = 0
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._skews = []
+        self._merged = 0
+
+    @property
+    def master(self):
+        return self.acquisitions[0]
+
+    def start(self):
+        """
+        Configure every device, start the others and then the master.
+        """
+        from nidaqmx.constants import Signal
+
+        self.dropped = 0
+        self._pending.clear()
+        self._skews = []
+        self._merged = 0
+        signal, source = (Signal.SAMPLE_CLOCK, "ai/SampleClock") if self.sync == 'clock' \
+            else (Signal.START_TRIGGER, "ai/StartTrigger")
+        self.master.configure()
+        if self.terminal is not None and len(self.acquisitions) > 1:
+            self.master.task.export_signals.export_signal(signal, "/{0}/{1}".format(self.master.device, self.terminal))
+        for daq in self.acquisitions[1:]:
+            if self.terminal is not None:
+                terminal = "/{0}/{1}".format(daq.device, self.terminal)
+            else:
+                terminal = "/{0}/{1}".format(self.master.device, source)
+            if self.sync == 'clock':
+                daq.configure(clock_source=terminal)
+            else:
+                daq.configure(start_trigger=terminal)
+        for daq in self.acquisitions[1:] + self.acquisitions[:1]:
+            daq.start()
+
+    def stop(self):
+        """
+        Stop the master, which stops the clock of the others, then the others.
+        """
+        for daq in self.acquisitions:
+            daq.stop()
+        logging.debug("Stop synchronized DAQ data acquisition. Blocks dropped: %s", self.dropped)
+
+    def _device_block(self, index):
+        # Called on the worker thread of each device, the last device to deliver a block passes it on
+        def receive(flow_voltage, temp_voltage, sensors):
+            daq = self.acquisitions[index]
+            number = daq.block_number
+            with self._lock:
+                parts = self._pending.setdefault(number, [None] * len(self.acquisitions))
+                parts[index] = (flow_voltage, temp_voltage, daq.block_arrival)
+                if any(part is None for part in parts):
+                    if len(self._pending) > constants.DAQ_QUEUE_SLOTS:
+                        # A device stopped delivering, its partners cannot wait for it forever
+                        del self._pending[min(self._pending)]
+                        self.dropped += 1
+                    return
+                del self._pending[number]
+                # Every device delivers its blocks in order, the older incomplete blocks will never complete
+                for stale in [pending for pending in self._pending if pending < number]:
+                    del self._pending[stale]
+                    self.dropped += 1
+
+                arrivals = [arrival for _, _, arrival in parts]
+                self._skews.append([arrival - arrivals[0] for arrival in arrivals])
+                # The blocks are passed on in order, so under the lock
+                self.on_data_block(np.concatenate([flow for flow, _, _ in parts]),
+                                   np.concatenate([temp for _, temp, _ in parts]), self.sensors)
+                self._merged += 1
+                if self._merged % 600 == 0:
+                    self._log_lag()
+        return receive
+
+    def _log_lag(self):
+        skews = np.array(self._skews)
+        for daq, skew in zip(self.acquisitions, skews.T):
+            logging.debug("[DAQ sync] {0}: Lag: Mean: {1:.4f}s, Max: {2:.4f}s, Overruns: {3}".format(
+                daq.device, np.mean(skew), np.max(skew), daq.blocks.overruns))
+        logging.debug("[DAQ sync] Blocks dropped: {0}".format(self.dropped))
+        self._skews = []
@@ -0,0 +1,238 @@
+import numpy as np
+
+from buffers import RingBuffer
+
+
+class SlidingSlope:
+    """
+    Least squares slope of the last `n` samples, updated in O(1) per sample.
+
+    Gives the same slope `b` as fitting ``a + b * x`` with `curve_fit` to the
+    last `n` samples over ``x = np.linspace(0, n, n)``, but keeps the running
+    sums of ``y`` and ``i * y`` instead of running an optimizer. The sums are
+    recomputed from the stored window every `n` samples so rounding errors do
+    not build up.
+
+    With `rows`, the slopes of several signals sampled together, one per
+    sensor, are updated at once: every sample is then a column of `rows`
+    values and the slope an array of `rows` slopes.
+
+    Parameters
+    ----------
+    n : int
+        Number of samples in the window.
+    rows : int or None, optional
+        Number of signals, None for a single one.
+    """
+
+    def __init__(self, n, rows=None):
+        self.n = n
+        self.rows = rows
+        self._window = RingBuffer(n, rows=rows)
+        i = np.arange(n)
+        self._sum_i = np.sum(i)
+        self._denominator = n * np.sum(i * i) - self._sum_i ** 2
+        # x = linspace(0, n, n) has a spacing of n / (n - 1) instead of 1
+        self._spacing = n / (n - 1)
+        self._count = 0
+        self._sum_y = self._zeros()
+        self._sum_iy = self._zeros()
+
+    def __len__(self):
+        return len(self._window)
+
+    @property
+    def ready(self):
+        """
+        True once the window is full.
+        """
+        return len(self._window) == self.n
+
+    @property
+    def slope(self):
+        """
+        The slope of the current window, NaN until it is full.
+        """
+        if not self.ready:
+            return self._zeros() + np.nan
+        slope = (self.n * self._sum_iy - self._sum_i * self._sum_y) / self._denominator
+        return slope / self._spacing
+
+    def reset(self):
+        """
+        Forget the window.
+        """
+        self._window.clear()
+        self._count = 0
+        self._sum_y = self._zeros()
+        self._sum_iy = self._zeros()
+
+    def push(self, value):
+        """
+        Add one sample and return the new slope.
+        """
+        full = self.ready
+        if self.rows is not None:
+            value = np.asarray(value, dtype=np.float64)
+        # Copied, the slot of the oldest sample is overwritten by the new one
+        oldest = np.copy(self._window.view()[..., 0]) if full else 0.0
+        self._window.append(value)
+        self._count += 1
+        if self._count % self.n == 0:
+            y = self._window.view()
+            self._sum_y = np.sum(y, axis=-1)
+            self._sum_iy = np.dot(y, np.arange(y.shape[-1]))
+        elif full:
+            # Every sample moves one position down and the new one enters at n - 1
+            self._sum_iy += (self.n - 1) * value - (self._sum_y - oldest)
+            self._sum_y += value - oldest
+        else:
+            self._sum_iy += (len(self._window) - 1) * value
+            self._sum_y += value
+        return self.slope
+
+    def extend(self, values):
+        """
+        Add several samples, shaped (rows, samples) with `rows`, and return
+        the new slope.
+        """
+        for value in np.asarray(values, dtype=np.float64).T:
+            self.push(value)
+        return self.slope
+
+    def _zeros(self):
+        return 0.0 if self.rows is None else np.zeros(self.rows)
+
+
+def rolling_slope(y, n):
+    """
+    Least squares slope of every window of `n` consecutive samples.
+
+    Element ``k`` is the slope of ``y[k:k + n]`` with the same scale as
+    `SlidingSlope`. The whole recording is processed with one convolution,
+    which unlike cumulative sums keeps its precision on long recordings.
+    Parameters
+    ----------
+    y : array_like
+        The signal.
+    n : int
+        Number of samples in each window.
+    Returns
+    -------
+    slopes : ndarray
+        ``len(y) - n + 1`` slopes, or none if `y` is shorter than `n`.
+    """
+    y = np.asarray(y, dtype=np.float64)
+    if len(y) < n:
+        return np.empty(0)
+    centered = np.arange(n) - (n - 1) / 2
+    kernel = centered / np.sum(centered ** 2) / (n / (n - 1))
+    return np.convolve(y, kernel[::-1], mode='valid')
+
+
+def segment_flow(y, n, start_threshold, stop_threshold):
+    """
+    Find where a flow starts and stops in a whole recording.
+
+    Gives the same indices as sliding a window of `n` samples ending before
+    index ``i``, for ``n <= i < len(y) - n``, and fitting a line to each one:
+    the start is the first window whose slope is below `start_threshold`, and
+    the stop is the first window whose slope is above `stop_threshold`.
+    Windows after the first stop are ignored.
+    Parameters
+    ----------
+    y : array_like
+        The flow voltage.
+    n : int
+        Number of samples in each window.
+    start_threshold : float
+        Slope below which the flow started.
+    stop_threshold : float
+        Slope above which the flow stopped.
+    Returns
+    -------
+    start : int
+        Index where the flow started, 0 if not found.
+    stop : int
+        Index where the flow stopped, 0 if not found or if it stopped before
+        it started.
+    """
+    slopes = rolling_slope(y, n)[:max(len(y) - 2 * n, 0)]
+    with np.errstate(invalid='ignore'):
+        stops = np.flatnonzero(slopes > stop_threshold)
+        starts = np.flatnonzero(slopes < start_threshold)
+    if len(stops) > 0:
+        starts = starts[starts < stops[0]]
+    if len(starts) == 0:
+        return 0, 0
+    start = int(starts[0]) + n
+    stop = int(stops[0]) + n if len(stops) > 0 else 0
+    return start, stop
+
+
+class RangeStats:
+    """
+    Mean, minimum and maximum of any slice of a recording in constant time.
+
+    The mean comes from prefix sums. The minimum and maximum come from a sparse
+    table over blocks of `block` samples, so a query reads two table entries and
+    at most two partial blocks, and the table only needs
+    ``len(y) / block * log2(len(y) / block)`` values. Slices follow the Python
+    rules and NaN values are ignored.
+    Parameters
+    ----------
+    y : array_like
+        The recording.
+    block : int, optional
+        Number of samples per block.
+    """
+
+    def __init__(self, y, block=64):
+        self._y = np.asarray(y, dtype=np.float64)
+        self._block = block
+        finite = np.isfinite(self._y)
+        self._sum = np.concatenate(([0.0], np.cumsum(np.where(finite, self._y, 0.0))))
+        self._count = np.concatenate(([0], np.cumsum(finite)))
+
+        blocks = len(self._y) // block
+        shaped = self._y[:blocks * block].reshape(blocks, block)
+        self._min = [np.fmin.reduce(shaped, axis=1)] if blocks else []
+        self._max = [np.fmax.reduce(shaped, axis=1)] if blocks else []
+        width = 1
+        while 2 * width <= blocks:
+            self._min.append(np.fmin(self._min[-1][:-width], self._min[-1][width:]))
+            self._max.append(np.fmax(self._max[-1][:-width], self._max[-1][width:]))
+            width *= 2
+
+    def mean(self, start, stop):
+        start, stop = self._indices(start, stop)
+        count = self._count[stop] - self._count[start]
+        if count == 0:
+            return np.nan
+        return (self._sum[stop] - self._sum[start]) / count
+
+    def min(self, start, stop):
+        return self._extreme(start, stop, self._min, np.fmin)
+
+    def max(self, start, stop):
+        return self._extreme(start, stop, self._max, np.fmax)
+
+    def _indices(self, start, stop):
+        start, stop, _ = slice(start, stop).indices(len(self._y))
+        return start, max(start, stop)
+
+    def _extreme(self, start, stop, table, function):
+        start, stop = self._indices(start, stop)
+        first = -(-start // self._block)
+        last = stop // self._block
+        if first >= last:
+            return function.reduce(self._y[start:stop]) if stop > start else np.nan
+
+        level = (last - first).bit_length() - 1
+        value = function(table[level][first], table[level][last - (1 << level)])
+        head = self._y[start:first * self._block]
+        tail = self._y[last * self._block:stop]
+        for part in (head, tail):
+            if len(part) > 0:
+                value = function(value, function.reduce(part))
+        return value
@@ -0,0 +1,173 @@
+import logging
+import threading
+from collections import namedtuple
+
+from PyQt5 import QtBluetooth as QtBt
+from PyQt5.QtCore import QObject, QTimer, pyqtSignal
+from PyQt5.QtSerialPort import QSerialPortInfo
+
+import constants
+
+# A device found by DeviceDiscovery.
+# kind: "DAQ", "USB" or "BLE". key: unique name of the device within its kind, the DAQ device name, the
+# serial port or the Bluetooth address. label: text shown to the user. info: what is needed to open it, the
+# DAQ device name, the serial port, or the QBluetoothDeviceInfo and the QBluetoothUuid of the service.
+Device = namedtuple('Device', ['kind', 'key', 'label', 'info'])
+
+
+def scan_daq():
+    """
+    Return the NI DAQ devices, by name. Loads nidaqmx on first use.
+    """
+    from nidaqmx import system as daq_system
+    return {device.name: Device('DAQ', device.name, 'DAQ: {0}'.format(device.product_type), device.name)
+            for device in daq_system.System.local().devices}
+
+
+def scan_serial():
+    """
+    Return the serial ports, by name.
+    """
+    return {port.portName(): Device('USB', port.portName(), 'Serial: {0}'.format(port.portName()), port.portName())
+            for port in QSerialPortInfo.availablePorts()}
+
+
+class DeviceDiscovery(QObject):
+    """
+    Background discovery of the DAQ, serial and Bluetooth devices.
+
+    The DAQ devices and the serial ports are enumerated on a worker thread
+    every `interval` seconds, or at once after `rescan`. Bluetooth devices are
+    found by the asynchronous discovery agent of Qt, which only runs while
+    `set_ble_enabled` is on, and only the ones advertising `ble_service_uuid`
+    are kept. The devices found are cached in `devices`, and `device_added`
+    and `device_removed` are only emitted when the set of devices changes, on
+    the thread of the object, so the GUI thread never waits for a device.
+
+    :param interval: Seconds between two scans of each kind of device.
+    :type interval: float
+    :param ble_service_uuid: UUID of the service of the Bluetooth sensors, None to keep every device.
+    :type ble_service_uuid: str
+    """
+    device_added = pyqtSignal(object)
+    device_removed = pyqtSignal(object)
+    # Results of the worker thread, delivered on the thread of the object
+    _scanned = pyqtSignal(str, object)
+
+    def __init__(self, interval=constants.DISCOVERY_INTERVAL, ble_service_uuid=None, parent=None):
+        super(DeviceDiscovery, self).__init__(parent)
+        self.interval = interval
+        self.ble_service_uuid = ble_service_uuid
+        self.devices = {}
+        self._scanners = {'DAQ': scan_daq, 'USB': scan_serial}
+        self._failed = set()
+        self._running = False
+        self._wake = threading.Event()
+        self._thread = None
+        self._scanned.connect(self._update)
+
+        self._ble_enabled = False
+        self._agent = None
+        self._ble_timer = QTimer(self)
+        self._ble_timer.setSingleShot(True)
+        self._ble_timer.timeout.connect(self._start_ble_scan)
+
+    def start(self):
+        """
+        Start scanning the DAQ devices and the serial ports.
+        """
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop every scan.
+        """
+        self._running = False
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self.set_ble_enabled(False)
+
+    def rescan(self):
+        """
+        Scan the DAQ devices and the serial ports now, without waiting for the
+        interval.
+        """
+        self._wake.set()
+
+    def set_ble_enabled(self, enabled):
+        """
+        Start or stop scanning for Bluetooth devices. When stopped, the
+        Bluetooth devices are forgotten, and removed.
+        """
+        if enabled == self._ble_enabled:
+            return
+        self._ble_enabled = enabled
+        if enabled:
+            self._start_ble_scan()
+        else:
+            self._ble_timer.stop()
+            if self._agent is not None and self._agent.isActive():
+                self._agent.stop()
+            self._update('BLE', {})
+
+    def _run(self):
+        while self._running:
+            for kind, scan in self._scanners.items():
+                try:
+                    found = scan()
+                except Exception as err:
+                    # A missing driver fails every time, only log it once
+                    if kind not in self._failed:
+                        self._failed.add(kind)
+                        logging.warning("{0} discovery failed: {1}".format(kind, err))
+                    continue
+                self._failed.discard(kind)
+                self._scanned.emit(kind, found)
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def _update(self, kind, found):
+        known = {key: device for (device_kind, key), device in self.devices.items() if device_kind == kind}
+        for key in known.keys() - found.keys():
+            device = self.devices.pop((kind, key))
+            logging.debug("Device removed: {0}".format(device.label))
+            self.device_removed.emit(device)
+        for key in found.keys() - known.keys():
+            device = found[key]
+            self.devices[(kind, key)] = device
+            logging.debug("Device added: {0}".format(device.label))
+            self.device_added.emit(device)
+
+    def _start_ble_scan(self):
+        if not self._ble_enabled:
+            return
+        if self._agent is None:
+            # Starts the Bluetooth stack, so only created when first needed
+            self._agent = QtBt.QBluetoothDeviceDiscoveryAgent(self)
+            self._agent.finished.connect(self._ble_scan_done)
+            self._agent.error.connect(self._ble_scan_error)
+            self._agent.setLowEnergyDiscoveryTimeout(2000)
+        self._agent.start(QtBt.QBluetoothDeviceDiscoveryAgent.LowEnergyMethod)
+
+    def _ble_scan_done(self):
+        found = {}
+        for info in self._agent.discoveredDevices():
+            uuids, _ = info.serviceUuids()
+            for uuid in uuids:
+                if self.ble_service_uuid is None or self.ble_service_uuid.lower() in uuid.toString():
+                    # The address is null on macOS, where devices are identified by a UUID
+                    key = info.address().toString() if not info.address().isNull() else info.deviceUuid().toString()
+                    found[key] = Device('BLE', key, 'BLE: {0}'.format(info.name()), (info, uuid))
+                    break
+        if self._ble_enabled:
+            self._update('BLE', found)
+            self._ble_timer.start(int(self.interval * 1000))
+
+    def _ble_scan_error(self, error):
+        logging.warning("BLE discovery error: {0}".format(error))
+        if self._ble_enabled:
+            self._ble_timer.start(int(self.interval * 1000))
@@ -1,10 +1,63 @@
+import functools
+import operator
+
 from scipy import signal
 import numpy as np
 
-Chebyshev_filter = signal.dlti(*signal.cheby2(8, 60, 0.7 / 10))
 
+@functools.lru_cache(maxsize=None)
+def chebyshev_design(order=8, attenuation=60, cutoff=0.7 / 10):
+    """
+    Chebyshev type II low pass anti-aliasing filter, designed once per set of
+    parameters. The defaults are the filter of every IIR stage.
+    Parameters
+    ----------
+    order : int, optional
+        The order of the filter.
+    attenuation : float, optional
+        Minimum attenuation in the stop band, in dB.
+    cutoff : float, optional
+        Start of the stop band, relative to the Nyquist frequency.
+    Returns
+    -------
+    system : dlti
+        The filter in transfer function form, for `decimate`.
+    sos : ndarray
+        The filter in second-order sections, shared by every stage so it must
+        not be changed. It is not read only since `signal.sosfilt` does not
+        accept it.
+    sos_zi : ndarray
+        Steady state of the sections for a unit input, read only.
+    """
+    system = signal.dlti(*signal.cheby2(order, attenuation, cutoff))
+    sos = signal.cheby2(order, attenuation, cutoff, output='sos')
+    sos_zi = signal.sosfilt_zi(sos)
+    sos_zi.flags.writeable = False
+    return system, sos, sos_zi
 
-def decimate(x, q, n=None, ftype=Chebyshev_filter, axis=-1, zero_phase=False, zi=None):
+
+@functools.lru_cache(maxsize=None)
+def fir_taps(q):
+    """
+    Coefficients of the FIR anti-aliasing filter of `signal.decimate` for a
+    downsampling factor `q`, a Hamming windowed FIR of order ``20 * q`` with
+    cutoff at ``1 / q``, designed once per factor. The array is read only.
+    """
+    taps = signal.firwin(20 * q + 1, 1. / q, window='hamming')
+    taps.flags.writeable = False
+    return taps
+
+
+def __getattr__(name):
+    # The default filter is only designed when first used
+    if name == 'Chebyshev_filter':
+        return chebyshev_design()[0]
+    if name == 'Chebyshev_sos':
+        return chebyshev_design()[1]
+    raise AttributeError("module {0!r} has no attribute {1!r}".format(__name__, name))
+
+
+def decimate(x, q, n=None, ftype=None, axis=-1, zero_phase=False, zi=None):
     """
     https://github.com/scipy/scipy/blob/v1.8.0/scipy/signal/_signaltools.py#L4353-L4486
 
@@ -23,6 +76,7 @@ def decimate(x, q, n=None, ftype=Chebyshev_filter, axis=-1, zero_phase=False, zi
         8 for 'iir' and 20 times the downsampling factor for 'fir'.
     ftype : ``dlti`` instance, optional
         `dlti` object, uses that object to filter before downsampling.
+        Defaults to `Chebyshev_filter`.
     axis : int, optional
         The axis along which to decimate.
     zero_phase : bool, optional
@@ -58,6 +112,8 @@ def decimate(x, q, n=None, ftype=Chebyshev_filter, axis=-1, zero_phase=False, zi
     if n is not None:
         n = operator.index(n)
 
+    if ftype is None:
+        ftype = chebyshev_design()[0]
     if isinstance(ftype, signal.dlti):
         system = ftype._as_tf()  # Avoids copying if already in TF form
         b, a = system.num, system.den
@@ -95,3 +151,168 @@ def decimate(x, q, n=None, ftype=Chebyshev_filter, axis=-1, zero_phase=False, zi
         sl[axis] = slice(None, None, q)
 
     return y[tuple(sl)], zi
+
+
+class IirStage:
+    """
+    One filter and downsample stage using an IIR anti-aliasing filter in
+    second-order sections, with the filter state kept between blocks.
+    Parameters
+    ----------
+    q : int
+        The downsampling factor.
+    sos : array_like, optional
+        Second-order sections of the filter. Defaults to `Chebyshev_sos`.
+    """
+
+    def __init__(self, q, sos=None):
+        self.q = operator.index(q)
+        if sos is None:
+            _, self.sos, self._sos_zi = chebyshev_design()
+        else:
+            self.sos = np.asarray(sos, dtype=np.float64)
+            self._sos_zi = signal.sosfilt_zi(self.sos)
+        self._zi = None
+        self._phase = 0
+
+    def reset(self):
+        self._zi = None
+        self._phase = 0
+
+    def __call__(self, x):
+        if self._zi is None:
+            # Start from the steady state of the first sample, as lfilter_zi(b, a) * x[0]
+            shape = (self.sos.shape[0],) + (1,) * (x.ndim - 1) + (2,)
+            self._zi = self._sos_zi.reshape(shape) * x[np.newaxis, ..., 0, np.newaxis]
+        y, self._zi = signal.sosfilt(self.sos, x, axis=-1, zi=self._zi)
+        y = y[..., self._phase::self.q]
+        self._phase = (self._phase - x.shape[-1]) % self.q
+        return y
+
+
+class FirStage:
+    """
+    One filter and downsample stage using a linear phase FIR anti-aliasing
+    filter.
+
+    Only the outputs that are kept after downsampling are computed, each one as
+    the dot product of the taps with a strided window over the input, so the
+    cost per input sample is ``len(taps) / q`` multiplications as in a polyphase
+    implementation. The last ``len(taps) - 1`` input samples are carried over to
+    the next block, so block boundaries are seamless.
+    Parameters
+    ----------
+    q : int
+        The downsampling factor.
+    taps : array_like, optional
+        The filter coefficients. Defaults to the filter of `signal.decimate`, a
+        Hamming windowed FIR of order ``20 * q`` with cutoff at ``1 / q``.
+    """
+
+    def __init__(self, q, taps=None):
+        self.q = operator.index(q)
+        if taps is None:
+            taps = fir_taps(self.q)
+        self.taps = np.asarray(taps, dtype=np.float64)
+        self._reversed_taps = self.taps[::-1].copy()
+        self._history = None
+        self._phase = 0
+
+    def reset(self):
+        self._history = None
+        self._phase = 0
+
+    def __call__(self, x):
+        n_taps = len(self.taps)
+        if self._history is None:
+            # Assume the signal was constant before the first sample, like the IIR steady state
+            self._history = np.repeat(x[..., :1], n_taps - 1, axis=-1)
+        buffer = np.concatenate((self._history, x), axis=-1)
+
+        # Output k of the block uses buffer[k:k + n_taps], which ends at x[k]
+        count = len(range(self._phase, x.shape[-1], self.q))
+        windows = np.lib.stride_tricks.as_strided(
+            buffer[..., self._phase:],
+            shape=buffer.shape[:-1] + (count, n_taps),
+            strides=buffer.strides[:-1] + (self.q * buffer.strides[-1], buffer.strides[-1]),
+            writeable=False,
+        )
+        y = np.einsum('...kl,l->...k', windows, self._reversed_taps)
+
+        self._history = buffer[..., buffer.shape[-1] - (n_taps - 1):].copy()
+        self._phase = (self._phase - x.shape[-1]) % self.q
+        return y
+
+
+class Decimator:
+    """
+    Real time decimator for blocks of samples of several channels.
+
+    Runs a cascade of filter and downsample stages over a whole block at once.
+    Each stage uses either the 8th order Chebyshev type II of
+    `Chebyshev_filter`, designed once as second-order sections, which is
+    faster and numerically safer than the transfer function form, or a linear
+    phase FIR filter (see `FirStage`).
+    The filter state and the downsampling phase of every stage and channel are
+    kept between calls, so consecutive blocks are processed as one continuous
+    signal.
+    Parameters
+    ----------
+    factors : sequence of int, optional
+        The downsampling factor of each stage. Defaults to three stages of 10,
+        a total factor of 1000.
+    ftypes : str or sequence of str, optional
+        The filter type of each stage, 'iir' or 'fir'. A single string applies
+        to every stage. Defaults to 'iir'.
+    """
+
+    def __init__(self, factors=(10, 10, 10), ftypes='iir'):
+        if isinstance(ftypes, str):
+            ftypes = [ftypes] * len(factors)
+        if len(ftypes) != len(factors):
+            raise ValueError('one filter type is required per stage')
+
+        self.stages = []
+        for q, ftype in zip(factors, ftypes):
+            if ftype == 'iir':
+                self.stages.append(IirStage(q))
+            elif ftype == 'fir':
+                self.stages.append(FirStage(q))
+            else:
+                raise ValueError('invalid ftype')
+
+    @property
+    def factor(self):
+        """
+        The total downsampling factor.
+        """
+        factor = 1
+        for stage in self.stages:
+            factor *= stage.q
+        return factor
+
+    def reset(self):
+        """
+        Forget the filter state, the next block starts a new signal.
+        """
+        for stage in self.stages:
+            stage.reset()
+
+    def __call__(self, x):
+        """
+        Filter and downsample one block.
+        Parameters
+        ----------
+        x : array_like
+            Block of samples, shaped (channels, samples) or (samples,).
+            The number of channels must not change between calls without a
+            `reset`.
+        Returns
+        -------
+        y : ndarray
+            The down-sampled block, with the same leading shape as `x`.
+        """
+        x = np.asarray(x, dtype=np.float64)
+        for stage in self.stages:
+            x = stage(x)
+        return x
@@ -0,0 +1,169 @@
+"""
+Acquisition and flow detection without the GUI.
+
+Reads the sensor channels of a NI DAQ, analyses them with the same
+`core.FlowAnalyzer` as the GUI, appends the decimated samples to rotating
+recordings and the flow events to a CSV file, until it is interrupted or
+the duration has elapsed. Several devices are read as one synchronized
+acquisition, the first one giving its sample clock to the others, see
+`core.SynchronizedDaqAcquisition`. The options can also be given in a JSON
+file whose keys are the long option names, the command line wins::
+
+    python headless.py --device Dev1 --pump ALGW --output data/ --duration 3600
+    python headless.py --device Dev1 Dev2 --channels 1 2 3 4 --sync-terminal PFI0
+    python headless.py --config station1.json
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import time
+from datetime import datetime
+
+import constants
+import core
+import recording
+
+
+def parse_arguments(argv=None):
+    parser = argparse.ArgumentParser(description="Flow sensor acquisition without the GUI.")
+    parser.add_argument('--config', help="JSON file with default values of the options")
+    parser.add_argument('--device', nargs='+', help="names of the NI DAQ devices, e.g. Dev1, the first one "
+                                                    "is the master of the others")
+    parser.add_argument('--channels', type=int, nargs='+', choices=range(1, constants.MAX_SENSORS + 1),
+                        default=[1, 2], metavar='CHANNEL', help="sensors to read on each device, from 1 to {0}".format(
+                            constants.MAX_SENSORS))
+    parser.add_argument('--sync', choices=('clock', 'trigger'), default='clock',
+                        help="share the sample clock of the first device, or only its start trigger")
+    parser.add_argument('--sync-terminal', help="terminal wiring the devices together, e.g. PFI0, by default the "
+                                                "signal is routed by the PXI chassis or RTSI cable")
+    parser.add_argument('--pump', choices=("ALGW", "BBPS"), default="ALGW",
+                        help="pump used for the flow detection")
+    parser.add_argument('--output', default="", help="folder of the recordings")
+    parser.add_argument('--format', choices=('parquet', 'csv'), default=constants.RECORDING_FORMAT,
+                        help="format of the recordings")
+    parser.add_argument('--raw', action='store_true', help="also save the raw 10 kHz samples")
+    parser.add_argument('--duration', type=float, help="seconds to acquire, until interrupted by default")
+    parser.add_argument('--flush-interval', type=float, default=constants.HEADLESS_FLUSH_INTERVAL,
+                        help="seconds between two writes of the recordings")
+    parser.add_argument('--tester', default="", help="name saved in the recordings")
+    parser.add_argument('--sensor-id', nargs='+', default=[], help="sensor id of each channel, of each device in turn")
+    parser.add_argument('--log', help="log file, the standard error by default")
+
+    arguments, _ = parser.parse_known_args(argv)
+    if arguments.config is not None:
+        with open(arguments.config) as f:
+            parser.set_defaults(**{key.replace('-', '_'): value for key, value in json.load(f).items()})
+    arguments = parser.parse_args(argv)
+    if arguments.device is None:
+        parser.error("the DAQ device is required, by --device or in the configuration file")
+    if isinstance(arguments.device, str):
+        arguments.device = [arguments.device]
+    if len(set(arguments.device)) != len(arguments.device):
+        parser.error("a device is given twice")
+    return arguments
+
+
+def session_metadata(arguments, device, channel):
+    # The ids of the channels of the second device follow those of the first one, and so on
+    index = arguments.device.index(device) * max(arguments.channels) + channel - 1
+    sensor_ids = arguments.sensor_id
+    return {
+        'channel': channel,
+        'tester': arguments.tester,
+        'pump': arguments.pump,
+        'sensor_id': sensor_ids[index] if len(sensor_ids) > index else "",
+        'device': device,
+        'sampling_period': constants.SAMPLING_RATE,
+        'saved': datetime.now().isoformat(),
+    }
+
+
+def main(argv=None):
+    arguments = parse_arguments(argv)
+    logging.basicConfig(
+        filename=arguments.log,
+        format='%(asctime)s: %(levelname)s - %(message)s',
+        datefmt='%Y/%m/%d %I:%M:%S',
+        level=logging.DEBUG
+    )
+    if arguments.output:
+        os.makedirs(arguments.output, exist_ok=True)
+    start = datetime.now().strftime("%Y-%m-%d %H-%M-%S")
+
+    events = open(os.path.join(arguments.output, start + ' flow events.csv'), 'w', buffering=1)
+    events.write("Time,Event\n")
+
+    def flow_event(now, message):
+        events.write("{0},{1}\n".format(now.strftime("%Y-%m-%d %H:%M:%S"), message))
+        print(now.strftime("%Y-%m-%d %H:%M:%S") + ": " + message)
+
+    channels = sorted(set(arguments.channels))
+    # Sensor n of the analysis and of the events is channel n of the first device, channel n - channels[-1]
+    # of the second one...
+    several = len(arguments.device) > 1
+    sensors = {index * channels[-1] + channel - 1: (device, channel)
+               for index, device in enumerate(arguments.device) for channel in channels}
+    writers = {sensor: recording.SegmentWriter(os.path.join(arguments.output, ''),
+                                               ' data{0}.{1}'.format(' {0}-{1}'.format(device, channel) if several
+                                                                     else channel, arguments.format),
+                                               rotate_seconds=constants.AUTOSAVE_SEGMENT_SECONDS,
+                                               rotate_rows=constants.AUTOSAVE_SEGMENT_ROWS,
+                                               metadata=session_metadata(arguments, device, channel))
+               for sensor, (device, channel) in sensors.items()}
+    analyzer = core.FlowAnalyzer(constants.HEADLESS_WINDOW, arguments.pump, flow_event,
+                                 sensors=len(arguments.device) * channels[-1],
+                                 series_resistance=constants.THERMISTOR_SERIES_RESISTANCE[:channels[-1]]
+                                 * len(arguments.device))
+    analyzer.use_sensor[:] = [sensor in sensors for sensor in range(analyzer.sensors)]
+    # The merged blocks hold the sensors in the order of the dictionary
+    indices = list(sensors)
+    raw_path = None
+    if arguments.raw:
+        raw_path = os.path.join(arguments.output, start + (' raw data {device}.fsraw' if several
+                                                           else ' raw data.fsraw'))
+    daq = core.SynchronizedDaqAcquisition([(device, [channel - 1 for channel in channels])
+                                           for device in arguments.device],
+                                          lambda flow, temp, _: analyzer.add_sensor_block(flow, temp, indices),
+                                          raw_path, arguments.sync, arguments.sync_terminal)
+
+    def flush():
+        for sensor, frame in enumerate(analyzer.drain_rows()):
+            if sensor in writers:
+                writers[sensor].write(frame)
+        estimates = analyzer.flow_estimates()
+        logging.info("Flow estimates: {0}".format(", ".join(
+            "sensor {0}: {1:.1f}".format(sensor + 1, estimates[sensor]) for sensor in sensors)))
+
+    analyzer.load_backends()
+    daq.start()
+    print("Acquiring from {0}, press Ctrl+C to stop.".format(", ".join(arguments.device)))
+    stop_time = None if arguments.duration is None else time.monotonic() + arguments.duration
+    try:
+        while stop_time is None or time.monotonic() < stop_time:
+            wait = arguments.flush_interval
+            if stop_time is not None:
+                wait = max(min(wait, stop_time - time.monotonic()), 0)
+            time.sleep(wait)
+            flush()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        daq.stop()
+        flush()
+        for writer in writers.values():
+            writer.close()
+            if writer.error is not None:
+                logging.error("Recording error: %s", writer.error)
+            for path in writer.paths:
+                print("Saved: {0}".format(path))
+        if raw_path is not None:
+            for device in arguments.device:
+                print("Saved: {0}".format(raw_path.format(device=device)))
+        events.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
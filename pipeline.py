@@ -0,0 +1,140 @@
+import logging
+import threading
+
+import numpy as np
+
+
+class BlockRing:
+    """
+    Bounded single producer, single consumer queue of sample blocks.
+
+    The blocks live in preallocated slots, which the producer can either fill
+    in place with `acquire` and `commit` or copy into with `put`. The
+    consumer reads them in place with `get` and `release`. The producer only moves
+    `head` forward and the consumer only moves `tail` forward, so handing a
+    block over needs no lock and the producer never waits for the consumer.
+    When every slot is taken the new block is dropped and counted in
+    `overruns`, a slot is never overwritten while the consumer reads it.
+
+    Parameters
+    ----------
+    slots : int
+        Maximum number of blocks waiting to be processed.
+    channels : int
+        Number of channels of each block.
+    samples : int
+        Number of samples per channel of each block.
+    dtype : data-type, optional
+        Type of the samples.
+    """
+
+    def __init__(self, slots, channels, samples, dtype=np.float64):
+        self._data = np.empty((slots, channels, samples), dtype=dtype)
+        self._head = 0
+        self._tail = 0
+        self._ready = threading.Event()
+        self.overruns = 0
+        self.max_depth = 0
+
+    @property
+    def slots(self):
+        return self._data.shape[0]
+
+    @property
+    def depth(self):
+        """
+        Number of blocks waiting to be processed.
+        """
+        return self._head - self._tail
+
+    def acquire(self):
+        """
+        Return the next free slot for the producer to fill in place, or None
+        if the queue is full, which counts as an overrun. The block is only
+        handed to the consumer by `commit`.
+        """
+        if self.depth == self.slots:
+            self.overruns += 1
+            return None
+        return self._data[self._head % self.slots]
+
+    def commit(self):
+        """
+        Publish the slot returned by `acquire`. Called by the producer.
+        """
+        # Publish the slot only once it is written
+        self._head += 1
+        self.max_depth = max(self.max_depth, self.depth)
+        self._ready.set()
+
+    def put(self, block):
+        """
+        Copy a block into the next free slot. Called by the producer.
+        Returns False if the queue was full and the block was dropped.
+        """
+        slot = self.acquire()
+        if slot is None:
+            return False
+        slot[...] = block
+        self.commit()
+        return True
+
+    def get(self, timeout=None):
+        """
+        Return the oldest block, waiting up to `timeout` seconds for one.
+        Called by the consumer, which must call `release` when it is done with
+        the block. Returns None if no block arrived in time.
+        """
+        if self.depth == 0:
+            self._ready.wait(timeout)
+            self._ready.clear()
+            if self.depth == 0:
+                return None
+        return self._data[self._tail % self.slots]
+
+    def release(self):
+        """
+        Give the slot of the block returned by `get` back to the producer.
+        """
+        self._tail += 1
+
+
+class BlockConsumer(threading.Thread):
+    """
+    Worker thread that takes the blocks out of a `BlockRing` and processes
+    them, so the producer callback only has to read and enqueue.
+
+    :param ring: The queue to consume.
+    :type ring: BlockRing
+    :param process: Function called with every block, on the worker thread.
+    :type process: function
+    """
+
+    def __init__(self, ring, process):
+        super(BlockConsumer, self).__init__(daemon=True)
+        self.ring = ring
+        self.process = process
+        self._running = False
+
+    def start(self):
+        self._running = True
+        super(BlockConsumer, self).start()
+
+    def stop(self):
+        """
+        Process the blocks still queued and wait for the thread to finish.
+        """
+        self._running = False
+        self.join()
+
+    def run(self):
+        while self._running or self.ring.depth > 0:
+            block = self.ring.get(timeout=0.1)
+            if block is None:
+                continue
+            try:
+                self.process(block)
+            except Exception as err:
+                logging.exception("BlockConsumer error: %s", str(err))
+            finally:
+                self.ring.release()
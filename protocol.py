@@ -0,0 +1,494 @@
+import re
+import time
+import zlib
+from collections import deque
+
+import numpy as np
+
+# BLE frames, notified on BLEfunctions.FRAME_CHAR_UUID, little endian:
+#   version      uint8    FRAME_VERSION
+#   channels     uint8    C, 2 for the flow voltage and the temperature voltage
+#   samples      uint16   N, samples per channel
+#   counter      uint32   incremented by one for every frame
+#   data         float32  C x N, all the samples of a channel after the other
+# The sensor sizes N to the negotiated MTU, see `frame_capacity`, the host reads it from the header.
+FRAME_VERSION = 1
+FRAME_HEADER = np.dtype([('version', 'u1'), ('channels', 'u1'), ('samples', '<u2'), ('counter', '<u4')])
+FRAME_DTYPE = '<f4'
+ATT_OVERHEAD = 3  # bytes of every notification used by the ATT protocol
+
+# Legacy BLE packets, notified on BLEfunctions.CHAR_UUID: one flow voltage, or a counter followed by
+# 1 to 3 flow voltages, as float32 without header
+LEGACY_SIZES = (4, 8, 12, 16)
+
+
+def frame_capacity(mtu, channels=2):
+    """
+    Number of samples per channel that fit in one notification.
+
+    Parameters
+    ----------
+    mtu : int
+        The ATT MTU negotiated with the sensor, 23 bytes without negotiation.
+    channels : int, optional
+        Number of channels per frame.
+    """
+    size = np.dtype(FRAME_DTYPE).itemsize * channels
+    return max((mtu - ATT_OVERHEAD - FRAME_HEADER.itemsize) // size, 0)
+
+
+def encode_frame(counter, samples):
+    """
+    Build a frame, as the sensor sends it.
+
+    Parameters
+    ----------
+    counter : int
+        The frame counter.
+    samples : array_like
+        The samples, shaped (channels, samples).
+    """
+    samples = np.asarray(samples, dtype=FRAME_DTYPE)
+    header = np.array([(FRAME_VERSION, samples.shape[0], samples.shape[1], counter % 2**32)], dtype=FRAME_HEADER)
+    return header.tobytes() + samples.tobytes()
+
+
+def decode_frame(data):
+    """
+    Decode a frame.
+
+    Parameters
+    ----------
+    data : bytes
+        The payload of one notification.
+
+    Returns
+    -------
+    counter : int
+        The frame counter.
+    samples : ndarray
+        The float64 samples, shaped (channels, samples).
+    """
+    if len(data) < FRAME_HEADER.itemsize:
+        raise ValueError('frame too short: {0} bytes'.format(len(data)))
+    header = np.frombuffer(data, dtype=FRAME_HEADER, count=1)[0]
+    if header['version'] != FRAME_VERSION:
+        raise ValueError('unsupported frame version {0}'.format(header['version']))
+    channels, count = int(header['channels']), int(header['samples'])
+    if len(data) < FRAME_HEADER.itemsize + np.dtype(FRAME_DTYPE).itemsize * channels * count:
+        raise ValueError('frame truncated: {0} bytes for {1} x {2} samples'.format(len(data), channels, count))
+    samples = np.frombuffer(data, dtype=FRAME_DTYPE, count=channels * count, offset=FRAME_HEADER.itemsize)
+    return int(header['counter']), samples.reshape(channels, count).astype(np.float64)
+
+
+def decode_legacy(data):
+    """
+    Decode a legacy packet.
+
+    Parameters
+    ----------
+    data : bytes
+        The payload of one notification, see `LEGACY_SIZES`.
+
+    Returns
+    -------
+    counter : float
+        The packet counter, None for the packets without one.
+    flow_voltage : ndarray
+        The float64 flow voltages.
+    """
+    if len(data) not in LEGACY_SIZES:
+        raise ValueError('invalid packet size: {0} bytes'.format(len(data)))
+    values = np.frombuffer(data, dtype=FRAME_DTYPE).astype(np.float64)
+    if len(values) == 1:
+        return None, values
+    # The counter of the 8 and 12 bytes packets was never checked, only the one of 16 bytes packets
+    return (values[0] if len(values) == 4 else None), values[1:]
+
+
+# Binary serial frames, little endian: SERIAL_SYNC, then a BLE frame, then the CRC-32 of the BLE frame
+# as uint32. Text lines are the legacy format, "Received" lines carry the flow voltage as third number.
+SERIAL_SYNC = b'\xa5\x5a'
+SERIAL_CRC = '<u4'
+# Largest frames accepted, a header claiming more is taken as corrupted without waiting for its bytes
+SERIAL_MAX_CHANNELS = 8
+SERIAL_MAX_SAMPLES = 256
+SERIAL_TEXT_NUMBER = re.compile(r"[-+]?(?:\d*\.\d+|\d+)")
+
+
+def encode_serial_frame(counter, samples):
+    """
+    Build a serial frame, as the sensor sends it. See `encode_frame`.
+    """
+    frame = encode_frame(counter, samples)
+    return SERIAL_SYNC + frame + np.array(zlib.crc32(frame), dtype=SERIAL_CRC).tobytes()
+
+
+def _serial_frame_size(channels, count):
+    return (len(SERIAL_SYNC) + FRAME_HEADER.itemsize + np.dtype(FRAME_DTYPE).itemsize * channels * count
+            + np.dtype(SERIAL_CRC).itemsize)
+
+
+class SerialDecoder:
+    """
+    Incremental decoder of the serial stream of a sensor.
+
+    The bytes are fed as they are read, in chunks of any size. Binary frames
+    are found by their sync word and checked by their CRC. When the stream is
+    corrupted the bytes are skipped up to the next sync word, and counted in
+    `skipped`. A header is rejected as soon as it is read when it is out of
+    the limits, and an incomplete frame is given up when a valid frame starts
+    within its bytes, so a false sync word in the data never stalls the
+    stream. Frames of the same size that follow each other, the usual case,
+    are checked and converted together with NumPy.
+
+    In 'auto' mode the stream is read as legacy text until the first valid
+    binary frame, and as binary frames after it.
+
+    Parameters
+    ----------
+    mode : {'auto', 'binary', 'text'}, optional
+        The format of the stream.
+    max_channels : int, optional
+        Largest number of channels of a frame.
+    max_samples : int, optional
+        Largest number of samples per channel of a frame.
+    """
+
+    def __init__(self, mode='auto', max_channels=SERIAL_MAX_CHANNELS, max_samples=SERIAL_MAX_SAMPLES):
+        if mode not in ('auto', 'binary', 'text'):
+            raise ValueError('invalid mode')
+        self.mode = mode
+        self.max_channels = max_channels
+        self.max_samples = max_samples
+        self.frames = 0
+        self.resyncs = 0
+        self.skipped = 0
+        self._binary = b''
+        self._text = b''
+        self._first_frame = None
+
+    def feed(self, data):
+        """
+        Decode the next bytes of the stream.
+
+        Returns
+        -------
+        frames : list of (int, ndarray)
+            The counter and the samples, shaped (channels, samples), of each
+            complete frame. All the values of the text lines are returned as
+            one frame without counter, None, and with only the flow voltages.
+        messages : list of str
+            The other text lines.
+        """
+        frames, messages = [], []
+        text = data
+        binary_found = False
+        if self.mode != 'text':
+            buffered = len(self._binary)
+            frames = self._feed_binary(data)
+            if frames and self.mode == 'auto':
+                # The text lines before the first frame are still decoded, the partial one is dropped
+                binary_found = True
+                text = data[:max(self._first_frame - buffered, 0)]
+        if self.mode != 'binary':
+            values, messages = self._feed_text(text)
+            if values:
+                frames.insert(0, (None, np.array([values])))
+        if binary_found:
+            self.mode = 'binary'
+            self._text = b''
+        return frames, messages
+
+    def _feed_text(self, data):
+        lines = (self._text + data).split(b'\n')
+        self._text = lines.pop()
+        values, messages = [], []
+        for line in lines:
+            text = line.decode(errors='replace').rstrip('\r')
+            numbers = SERIAL_TEXT_NUMBER.findall(text)
+            if "Received" in text and len(numbers) > 2:
+                values.append(float(numbers[2]))
+            else:
+                messages.append(text)
+        return values, messages
+
+    def _feed_binary(self, data):
+        buffer = self._binary + data
+        frames = []
+        position = 0
+        # Where the next sync word is looked for, after the sync word of a rejected frame
+        search = 0
+        header_start = len(SERIAL_SYNC)
+        data_start = header_start + FRAME_HEADER.itemsize
+        self._first_frame = None
+        while True:
+            start = buffer.find(SERIAL_SYNC, search)
+            if start < 0:
+                # Only the end of the buffer can be the start of a sync word
+                start = max(len(buffer) - len(SERIAL_SYNC) + 1, search)
+                self._skip(start - position)
+                position = start
+                break
+            self._skip(start - position)
+            position = start
+            if len(buffer) - start < data_start:
+                break
+            shape = self._frame_shape(buffer, start)
+            if shape is None:
+                self._resync()
+                search = start + len(SERIAL_SYNC)
+                continue
+            channels, count = shape
+            size = _serial_frame_size(channels, count)
+            available = (len(buffer) - start) // size
+            if available == 0:
+                if self._frame_after(buffer, start):
+                    # A false sync word, a valid frame starts before the end of the one it announces
+                    self._resync()
+                    search = start + len(SERIAL_SYNC)
+                    continue
+                break
+
+            # Every complete frame which looks like the first one, up to the first corrupted one
+            rows = np.frombuffer(buffer, dtype=np.uint8, count=available * size, offset=start).reshape(available, size)
+            alike = (rows[:, :data_start] == rows[0, :data_start]) | (np.arange(data_start) >= data_start - 4)
+            alike = alike.all(axis=1)
+            run = available if alike.all() else int(np.argmin(alike))
+            crc = rows[:run, -4:].copy().view(SERIAL_CRC).ravel()
+            valid = 0
+            while valid < run and zlib.crc32(rows[valid, header_start:-4]) == crc[valid]:
+                valid += 1
+            if valid == 0:
+                self._resync()
+                search = start + len(SERIAL_SYNC)
+                continue
+
+            counters = rows[:valid, data_start - 4:data_start].copy().view(FRAME_HEADER['counter']).ravel()
+            samples = rows[:valid, data_start:-4].copy().view(FRAME_DTYPE).reshape(valid, channels, count)
+            frames.extend(zip(counters.tolist(), samples.astype(np.float64)))
+            if self._first_frame is None:
+                self._first_frame = start
+            self.frames += valid
+            position = search = start + valid * size
+        self._binary = buffer[position:]
+        return frames
+
+    def _frame_shape(self, buffer, start):
+        # Channels and samples of the frame whose sync word is at start, None if out of the limits
+        header = np.frombuffer(buffer, dtype=FRAME_HEADER, count=1, offset=start + len(SERIAL_SYNC))[0]
+        channels, count = int(header['channels']), int(header['samples'])
+        if (header['version'] != FRAME_VERSION or not 0 < channels <= self.max_channels
+                or not 0 < count <= self.max_samples):
+            return None
+        return channels, count
+
+    def _frame_after(self, buffer, start):
+        # Whether a complete frame with a valid CRC starts after the sync word at start
+        data_start = len(SERIAL_SYNC) + FRAME_HEADER.itemsize
+        position = buffer.find(SERIAL_SYNC, start + len(SERIAL_SYNC))
+        while 0 <= position <= len(buffer) - data_start:
+            shape = self._frame_shape(buffer, position)
+            size = 0 if shape is None else _serial_frame_size(*shape)
+            if 0 < size <= len(buffer) - position:
+                frame = buffer[position + len(SERIAL_SYNC):position + size - 4]
+                if zlib.crc32(frame) == int.from_bytes(buffer[position + size - 4:position + size], 'little'):
+                    return True
+            position = buffer.find(SERIAL_SYNC, position + len(SERIAL_SYNC))
+        return False
+
+    def _skip(self, count):
+        # Bytes outside of the frames are expected before the first frame and in text mode
+        if count > 0 and self.mode == 'binary':
+            self.skipped += count
+
+    def _resync(self):
+        if self.mode == 'binary':
+            self.resyncs += 1
+
+
+class SequenceTracker:
+    """
+    Sequence accounting of a stream of numbered packets, with the samples of
+    the lost packets filled in.
+
+    Every packet goes through `push`, which counts the lost, duplicated and
+    out of order packets from their counters, and returns the samples to add
+    to the timeline. The samples of the lost packets, as many as in the packet
+    received after them, are put back in front of it, interpolated or NaN, so
+    the timeline and the spectra stay aligned with time. The packets which
+    arrive after their place was filled are counted and dropped.
+
+    `metrics` gives the totals and the live rates: the loss rate of the link,
+    and the share of the time spent processing the packets, see `record_busy`.
+    Packets lost while the host load stays low point to the radio, a host load
+    close to 1 to a host which cannot keep up.
+
+    Parameters
+    ----------
+    fill : {'interpolate', 'nan'}, optional
+        How the lost samples are filled. NaN samples mark the gaps in the
+        recordings and the autosave, but blank the spectra and stall the
+        flow detection until the analysis windows have moved past them.
+    max_gap : int, optional
+        Longest gap filled, in samples. Longer gaps, a sensor out of range for
+        a while, are only counted.
+    modulus : int, optional
+        The counters wrap around at this value, None if they never do.
+    history : int, optional
+        Number of packets remembered to recognise the duplicated and late
+        packets. A counter further back is taken as a restart of the sensor.
+    window : float, optional
+        Seconds over which the live rates are measured.
+    """
+
+    def __init__(self, fill='interpolate', max_gap=600, modulus=None, history=256, window=5.0):
+        if fill not in ('interpolate', 'nan'):
+            raise ValueError('invalid fill')
+        self.fill = fill
+        self.max_gap = max_gap
+        self.modulus = modulus
+        self.history = history
+        self.window = window
+        self.packets = 0
+        self.samples = 0
+        self.lost = 0
+        self.duplicated = 0
+        self.out_of_order = 0
+        self.restarts = 0
+        self.filled = 0
+        self.busy = 0.0
+        self._last = None
+        self._last_samples = None
+        self._missing = set()
+        self._snapshots = deque()
+
+    def push(self, counter, samples, now=None):
+        """
+        Account for one packet.
+
+        Parameters
+        ----------
+        counter : int
+            The counter of the packet, None if it has none.
+        samples : ndarray
+            The samples of the packet, shaped (channels, samples).
+        now : float, optional
+            The time of arrival, ``time.monotonic()`` by default.
+
+        Returns
+        -------
+        samples : ndarray
+            The samples to add to the timeline, with the gap before the
+            packet filled, None if the packet is dropped.
+        """
+        now = time.monotonic() if now is None else now
+        samples = np.asarray(samples, dtype=np.float64)
+        gap = 0
+        if counter is not None:
+            counter = int(counter)
+            if self._last is not None:
+                step = self._distance(self._last, counter)
+                if step <= 0 and -step < self.history:
+                    if counter in self._missing:
+                        self._missing.discard(counter)
+                        self.lost -= 1
+                        self.out_of_order += 1
+                    else:
+                        self.duplicated += 1
+                    self._snapshot(now)
+                    return None
+                if step <= 0:
+                    self.restarts += 1
+                else:
+                    gap = step - 1
+                    self.lost += gap
+                    self._missing.update(self._counter(self._last + i)
+                                        for i in range(max(gap - self.history, 0) + 1, gap + 1))
+                    if len(self._missing) > self.history:
+                        self._missing = {c for c in self._missing if -self._distance(counter, c) < self.history}
+            self._last = counter
+
+        self.packets += 1
+        fill = gap * samples.shape[1]
+        if 0 < fill <= self.max_gap:
+            if self.fill == 'nan' or self._last_samples is None:
+                filled = np.full((len(samples), fill), np.nan)
+            else:
+                # Straight line from the last sample before the gap to the first one after it
+                steps = np.arange(1, fill + 1) / (fill + 1)
+                start = self._last_samples[:, None]
+                filled = start + (samples[:, :1] - start) * steps
+            samples = np.concatenate((filled, samples), axis=1)
+            self.filled += fill
+        self.samples += samples.shape[1]
+        if samples.shape[1] > 0:
+            self._last_samples = samples[:, -1].copy()
+        self._snapshot(now)
+        return samples
+
+    def record_busy(self, seconds):
+        """
+        Add the time spent processing a packet, for the host load.
+        """
+        self.busy += seconds
+
+    def metrics(self, now=None):
+        """
+        The totals since the start and the rates over the last `window`
+        seconds.
+
+        Returns
+        -------
+        dict
+            packets, samples, lost, duplicated, out_of_order, restarts and
+            filled: totals. loss_rate: lost packets over sent packets since
+            the start. packet_rate, sample_rate: received per second.
+            recent_loss_rate: loss rate over the window. host_load: share of
+            the window spent processing the packets.
+        """
+        now = time.monotonic() if now is None else now
+        self._expire(now)
+        totals = {
+            'packets': self.packets,
+            'samples': self.samples,
+            'lost': self.lost,
+            'duplicated': self.duplicated,
+            'out_of_order': self.out_of_order,
+            'restarts': self.restarts,
+            'filled': self.filled,
+        }
+        sent = self.packets + self.lost
+        totals['loss_rate'] = self.lost / sent if sent else 0.0
+        if self._snapshots:
+            start, packets, samples, lost, busy = self._snapshots[0]
+        else:
+            start, packets, samples, lost, busy = now, self.packets, self.samples, self.lost, self.busy
+        elapsed = max(now - start, 1e-9)
+        recent_sent = (self.packets - packets) + (self.lost - lost)
+        totals['packet_rate'] = (self.packets - packets) / elapsed
+        totals['sample_rate'] = (self.samples - samples) / elapsed
+        totals['recent_loss_rate'] = (self.lost - lost) / recent_sent if recent_sent else 0.0
+        totals['host_load'] = min((self.busy - busy) / elapsed, 1.0)
+        return totals
+
+    def _distance(self, start, stop):
+        # Number of packets from start to stop, negative when stop is behind start
+        step = stop - start
+        if self.modulus is not None:
+            step %= self.modulus
+            if step >= self.modulus // 2:
+                step -= self.modulus
+        return step
+
+    def _counter(self, value):
+        return value % self.modulus if self.modulus is not None else value
+
+    def _snapshot(self, now):
+        self._snapshots.append((now, self.packets, self.samples, self.lost, self.busy))
+        self._expire(now)
+
+    def _expire(self, now):
+        # The oldest snapshot still in the window is the start of the rates
+        while len(self._snapshots) > 1 and self._snapshots[1][0] <= now - self.window:
+            self._snapshots.popleft()
@@ -0,0 +1,467 @@
+import functools
+import json
+import logging
+import os
+import queue
+import struct
+import threading
+from datetime import datetime
+
+import numpy as np
+
+import constants
+from buffers import SAMPLE_COLUMNS, SAMPLE_DTYPES
+
+# pandas and pyarrow are only imported by the functions that read or write recordings, so that the
+# application starts without them. Processed recordings store the session metadata as JSON in the
+# Parquet schema under METADATA_KEY, see `recording_schema`.
+METADATA_KEY = b'flowsensor'
+
+# Raw capture file: magic, header length, JSON header padded to RAW_HEADER_ALIGN bytes, then the samples
+RAW_MAGIC = b'FSRAW001'
+RAW_HEADER_ALIGN = 64
+RAW_DTYPE = '<f4'
+
+
+class RawWriter:
+    """
+    Append-only binary file for the raw samples of the DAQ.
+
+    The samples are stored as little endian float32 frames, one value per
+    channel interleaved, after a small JSON header describing the channels and
+    the sample rate. The file can be opened with `read_raw` while it is still
+    being written.
+
+    `write` only copies the block into a preallocated chunk. Full chunks are
+    written and flushed by a background thread, so the memory used stays the
+    same however long the capture runs.
+
+    Parameters
+    ----------
+    path : str
+        The file to create.
+    channels : sequence of str
+        Name of each channel, in the order of the rows of the blocks.
+    sample_rate : float
+        Sample rate in Hz.
+    chunk_samples : int, optional
+        Number of samples per channel written at once.
+    chunks : int, optional
+        Number of preallocated chunks. When every chunk waits to be written,
+        `write` blocks until one is free.
+    """
+
+    def __init__(self, path, channels, sample_rate, chunk_samples=constants.RAW_CHUNK_SAMPLES,
+                 chunks=constants.RAW_CHUNKS):
+        self.path = path
+        self.channels = list(channels)
+        self.sample_rate = sample_rate
+        self.samples = 0
+        self.error = None
+
+        header = json.dumps({
+            'channels': self.channels,
+            'sample_rate': sample_rate,
+            'dtype': RAW_DTYPE,
+            'start': datetime.now().isoformat(),
+        }).encode('utf-8')
+        size = len(RAW_MAGIC) + 4 + len(header)
+        header += b' ' * (-size % RAW_HEADER_ALIGN)
+        self._file = open(path, 'wb')
+        self._file.write(RAW_MAGIC + struct.pack('<I', len(header)) + header)
+        self._file.flush()
+
+        self._free = queue.Queue()
+        for _ in range(chunks):
+            self._free.put(np.empty((chunk_samples, len(self.channels)), dtype=RAW_DTYPE))
+        self._full = queue.Queue()
+        self._chunk = self._free.get()
+        self._count = 0
+        self._thread = threading.Thread(target=self._run, name='RawWriter', daemon=True)
+        self._thread.start()
+
+    def write(self, block):
+        """
+        Append a block shaped (channels, samples).
+        """
+        block = np.asarray(block)
+        written = 0
+        while written < block.shape[1]:
+            count = min(block.shape[1] - written, len(self._chunk) - self._count)
+            self._chunk[self._count:self._count + count] = block[:, written:written + count].T
+            self._count += count
+            written += count
+            if self._count == len(self._chunk):
+                self._full.put((self._chunk, self._count))
+                self._chunk = self._free.get()
+                self._count = 0
+        self.samples += written
+
+    def close(self):
+        """
+        Write the samples still in memory and close the file.
+        """
+        if self._file is None:
+            return
+        if self._count:
+            self._full.put((self._chunk, self._count))
+        self._full.put(None)
+        self._thread.join()
+        self._file.close()
+        self._file = None
+
+    def _run(self):
+        while True:
+            item = self._full.get()
+            if item is None:
+                return
+            chunk, count = item
+            if self.error is None:
+                try:
+                    self._file.write(chunk[:count].data)
+                    self._file.flush()
+                except Exception as err:
+                    # Keep draining the chunks so the producer never blocks
+                    self.error = err
+                    logging.exception("RawWriter error: %s", str(err))
+            self._free.put(chunk)
+
+
+def read_raw_header(path):
+    """
+    Read the header of a raw capture file.
+
+    Returns
+    -------
+    header : dict
+        The channel names, sample rate, sample type and start time.
+    offset : int
+        Position of the first sample in the file.
+    """
+    with open(path, 'rb') as file:
+        if file.read(len(RAW_MAGIC)) != RAW_MAGIC:
+            raise ValueError('not a raw capture file')
+        length, = struct.unpack('<I', file.read(4))
+        header = json.loads(file.read(length).decode('utf-8'))
+    return header, len(RAW_MAGIC) + 4 + length
+
+
+def read_raw(path):
+    """
+    Open a raw capture file without loading it.
+
+    Returns
+    -------
+    header : dict
+        See `read_raw_header`.
+    samples : ndarray
+        Read only memory map shaped (samples, channels). A frame that is only
+        partly written is left out.
+    """
+    header, offset = read_raw_header(path)
+    dtype = np.dtype(header['dtype'])
+    channels = len(header['channels'])
+    with open(path, 'rb') as file:
+        file.seek(0, 2)
+        frames = (file.tell() - offset) // (dtype.itemsize * channels)
+    if frames == 0:
+        return header, np.empty((0, channels), dtype=dtype)
+    return header, np.memmap(path, dtype=dtype, mode='r', offset=offset, shape=(frames, channels))
+
+
+@functools.lru_cache(maxsize=None)
+def recording_schema():
+    """
+    The Arrow schema of the processed recordings, without the metadata.
+    """
+    import pyarrow as pa
+    return pa.schema([(name, pa.from_numpy_dtype(SAMPLE_DTYPES[name])) for name in SAMPLE_COLUMNS])
+
+
+def __getattr__(name):
+    if name == 'RECORDING_SCHEMA':
+        return recording_schema()
+    raise AttributeError("module {0!r} has no attribute {1!r}".format(__name__, name))
+
+
+def _recording_table(frame, metadata):
+    import pyarrow as pa
+    schema = recording_schema()
+    if metadata is not None:
+        schema = schema.with_metadata({METADATA_KEY: json.dumps(metadata).encode('utf-8')})
+    return pa.Table.from_pandas(frame[list(SAMPLE_COLUMNS)], schema=schema, preserve_index=False)
+
+
+def write_recording(frame, path, metadata=None):
+    """
+    Save processed samples. A path ending in ``.parquet`` is written as a
+    compressed Parquet file with the session metadata, any other one as CSV,
+    without the metadata.
+
+    Parameters
+    ----------
+    frame : DataFrame
+        The samples, with the columns of `SAMPLE_COLUMNS`.
+    path : str
+        The file to create.
+    metadata : dict, optional
+        Description of the session, must be serializable to JSON.
+    """
+    if str(path).endswith('.parquet'):
+        import pyarrow.parquet as pq
+        pq.write_table(_recording_table(frame, metadata), path, compression=constants.RECORDING_COMPRESSION)
+    else:
+        frame.to_csv(path, index=False)
+
+
+def read_recording(path, columns=None):
+    """
+    Load processed samples saved by `write_recording` or an older CSV file.
+
+    Parameters
+    ----------
+    path : str
+        The file to read.
+    columns : list of str, optional
+        Only read these columns. Defaults to all of them.
+    Returns
+    -------
+    frame : DataFrame
+        The samples.
+    metadata : dict or None
+        The session metadata, None if the file has none.
+    """
+    if str(path).endswith('.parquet'):
+        import pyarrow.parquet as pq
+        table = pq.read_table(path, columns=columns)
+        metadata = (table.schema.metadata or {}).get(METADATA_KEY)
+        return table.to_pandas(), json.loads(metadata.decode('utf-8')) if metadata else None
+    import pandas as pd
+    dtype = {name: SAMPLE_DTYPES[name] for name in (columns or SAMPLE_COLUMNS)}
+    return pd.read_csv(path, usecols=columns, dtype=dtype), None
+
+
+class RecordingLoader:
+    """
+    Reads one column of a recording in chunks, so it can be shown while the
+    rest of the file is loading.
+
+    Parquet files only read the row groups of the column, CSV files are parsed
+    `chunk_rows` at a time with an explicit type, and raw capture files
+    (``.fsraw``) are memory mapped and read without parsing. For raw files the
+    column is the first channel, the flow voltage of channel one, in mV like
+    the processed data.
+
+    Parameters
+    ----------
+    path : str
+        The file to read.
+    column : str, optional
+        The column to read.
+    chunk_rows : int, optional
+        Number of rows per chunk.
+    """
+
+    def __init__(self, path, column='flow_voltage', chunk_rows=constants.LOAD_CHUNK_ROWS):
+        self.path = str(path)
+        self.column = column
+        self.chunk_rows = chunk_rows
+        self.rows_read = 0
+        self.metadata = None
+        self.cancelled = False
+        # Fail here, before any chunk is read, if the file does not have the column
+        if self.path.endswith('.fsraw'):
+            self.metadata, self._samples = read_raw(self.path)
+            self.period = 1.0 / self.metadata['sample_rate']
+            self.rows = len(self._samples)
+        elif self.path.endswith('.parquet'):
+            import pyarrow.parquet as pq
+            self._file = pq.ParquetFile(self.path)
+            if column not in self._file.schema_arrow.names:
+                raise KeyError(column)
+            metadata = (self._file.schema_arrow.metadata or {}).get(METADATA_KEY)
+            self.metadata = json.loads(metadata.decode('utf-8')) if metadata else None
+            self.period = constants.SAMPLING_RATE
+            self.rows = self._file.metadata.num_rows
+        else:
+            import pandas as pd
+            if column not in pd.read_csv(self.path, nrows=0).columns:
+                raise KeyError(column)
+            self.period = constants.SAMPLING_RATE
+            self.rows = None
+            # Bytes read and size of the file, known once the iteration started
+            self._position = 0
+            self._size = 0
+
+    @property
+    def progress(self):
+        """
+        Fraction of the file read, between 0 and 1.
+        """
+        if self.rows is None:
+            if not self._size:
+                return 1.0 if self._position else 0.0
+            return self._position / self._size
+        return self.rows_read / self.rows if self.rows else 1.0
+
+    def cancel(self):
+        """
+        Stop the iteration before the next chunk, can be called from another
+        thread.
+        """
+        self.cancelled = True
+
+    def __iter__(self):
+        if self.path.endswith('.fsraw'):
+            for start in range(0, self.rows, self.chunk_rows):
+                if self.cancelled:
+                    return
+                values = 1000 * self._samples[start:start + self.chunk_rows, 0].astype(np.float64)
+                self.rows_read += len(values)
+                yield values
+        elif self.path.endswith('.parquet'):
+            for batch in self._file.iter_batches(batch_size=self.chunk_rows, columns=[self.column]):
+                if self.cancelled:
+                    return
+                values = batch.column(0).to_numpy(zero_copy_only=False).astype(np.float64, copy=False)
+                self.rows_read += len(values)
+                yield values
+        else:
+            import pandas as pd
+            with open(self.path, 'rb') as file:
+                file.seek(0, 2)
+                self._size = file.tell()
+                file.seek(0)
+                self._position = 0
+                for chunk in pd.read_csv(file, usecols=[self.column], dtype={self.column: np.float64},
+                                         chunksize=self.chunk_rows):
+                    if self.cancelled:
+                        return
+                    values = chunk[self.column].to_numpy()
+                    self.rows_read += len(values)
+                    # Approximate, the parser reads ahead
+                    self._position = file.tell()
+                    yield values
+            self._position = self._size
+
+
+class SegmentWriter:
+    """
+    Append-only recording split in segments, written on a background thread.
+
+    Each call to `write` queues the new rows only, and the thread appends them
+    to the current segment, so saving never waits for the disk and never
+    rewrites what was already saved. A new segment is started when the current
+    one is older than `rotate_seconds` or has `rotate_rows` rows. Its name is
+    `prefix`, the time it started and `suffix`, with a sequence number after
+    the time when a segment of the same second exists already.
+
+    A `suffix` ending in ``.parquet`` writes Parquet segments, each flush
+    being a row group, with the session metadata in the schema. A Parquet
+    segment is only readable once it is closed, by a rotation or by `close`.
+    Any other suffix writes CSV segments.
+
+    Parameters
+    ----------
+    prefix : str
+        Start of the path of the segments, usually the folder.
+    suffix : str
+        End of the path of the segments, after the start time.
+    rotate_seconds : float or None, optional
+        Maximum duration of a segment, None for no limit.
+    rotate_rows : int or None, optional
+        Maximum number of rows of a segment, None for no limit.
+    metadata : dict, optional
+        Description of the session stored in Parquet segments.
+    """
+
+    def __init__(self, prefix, suffix, rotate_seconds=None, rotate_rows=None, metadata=None):
+        self.prefix = prefix
+        self.suffix = suffix
+        self.rotate_seconds = rotate_seconds
+        self.rotate_rows = rotate_rows
+        self.metadata = metadata
+        self.parquet = suffix.endswith('.parquet')
+        self.paths = []
+        self.rows = 0
+        self.error = None
+        self._segment_start = None
+        self._segment_rows = 0
+        self._parquet_writer = None
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name='SegmentWriter', daemon=True)
+        self._thread.start()
+
+    def write(self, frame):
+        """
+        Queue rows to append, as a DataFrame. The frame must not be changed
+        afterwards.
+        """
+        if len(frame) > 0:
+            self._queue.put(frame)
+
+    def close(self):
+        """
+        Write the queued rows and stop the thread.
+        """
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join()
+        self._thread = None
+
+    def _rotate(self, now):
+        if self._segment_start is None:
+            return True
+        if self.rotate_seconds is not None and (now - self._segment_start).total_seconds() >= self.rotate_seconds:
+            return True
+        return self.rotate_rows is not None and self._segment_rows >= self.rotate_rows
+
+    def _run(self):
+        while True:
+            frame = self._queue.get()
+            if frame is None:
+                self._close_parquet()
+                return
+            try:
+                now = datetime.now()
+                new_segment = self._rotate(now)
+                if new_segment:
+                    self._close_parquet()
+                    self._segment_start = now
+                    self._segment_rows = 0
+                    self.paths.append(self._segment_path(now))
+                if self.parquet:
+                    table = _recording_table(frame, self.metadata)
+                    if new_segment:
+                        import pyarrow.parquet as pq
+                        self._parquet_writer = pq.ParquetWriter(self.paths[-1], table.schema,
+                                                                compression=constants.RECORDING_COMPRESSION)
+                    self._parquet_writer.write_table(table)
+                elif new_segment:
+                    frame.to_csv(self.paths[-1], index=False)
+                else:
+                    frame.to_csv(self.paths[-1], mode='a', header=False, index=False)
+                self._segment_rows += len(frame)
+                self.rows += len(frame)
+            except Exception as err:
+                self.error = err
+                logging.exception("SegmentWriter error: %s", str(err))
+
+    def _segment_path(self, now):
+        start = self.prefix + now.strftime("%Y-%m-%d %H-%M-%S")
+        path = start + self.suffix
+        number = 1
+        while path in self.paths or os.path.exists(path):
+            number += 1
+            path = "{0}-{1}{2}".format(start, number, self.suffix)
+        return path
+
+    def _close_parquet(self):
+        if self._parquet_writer is not None:
+            try:
+                self._parquet_writer.close()
+            except Exception as err:
+                self.error = err
+                logging.exception("SegmentWriter error: %s", str(err))
+            self._parquet_writer = None
@@ -0,0 +1,82 @@
+import logging
+import time
+from collections import deque
+
+from PyQt5.QtCore import QObject, QTimer, pyqtSignal
+
+
+class RenderScheduler(QObject):
+    """
+    Coalesces the redraw requests of several plot items into frames at a
+    capped rate.
+
+    Each item is registered with a function that redraws it and a function
+    telling if it is visible. `request` only marks items as dirty, and at most
+    `fps` times per second the dirty and visible items are redrawn once each,
+    however many requests arrived in between. Hidden items stay dirty and are
+    redrawn by the first frame after they are shown again, see `schedule`.
+    Must be used from the GUI thread.
+
+    :param fps: Maximum number of frames per second.
+    :type fps: float
+    """
+    frame_rendered = pyqtSignal(float)
+
+    def __init__(self, fps, parent=None):
+        super(RenderScheduler, self).__init__(parent)
+        self.interval = 1.0 / fps
+        self._items = {}
+        self._dirty = set()
+        self._last_frame = 0.0
+        self.frame_times = deque(maxlen=100)
+        self._timer = QTimer(self)
+        self._timer.setSingleShot(True)
+        self._timer.timeout.connect(self.render)
+
+    def register(self, name, render, visible=None):
+        """
+        Add a plot item.
+
+        :param name: Name used by `request`.
+        :param render: Function redrawing the item.
+        :param visible: Function returning False while the item is hidden, always visible by default.
+        """
+        self._items[name] = (render, visible)
+
+    def request(self, *names):
+        """
+        Mark the items as dirty, all of them if no name is given, and schedule a frame.
+        """
+        self._dirty.update(names or self._items)
+        self.schedule()
+
+    def schedule(self):
+        """
+        Schedule a frame if any item is dirty, as soon as the frame rate allows.
+        """
+        if not self._dirty or self._timer.isActive():
+            return
+        wait = self._last_frame + self.interval - time.perf_counter()
+        self._timer.start(max(int(wait * 1000), 0))
+
+    def render(self):
+        """
+        Redraw the dirty and visible items now.
+        """
+        start = time.perf_counter()
+        self._last_frame = start
+        rendered = False
+        for name in list(self._dirty):
+            render, visible = self._items[name]
+            if visible is not None and not visible():
+                continue
+            self._dirty.discard(name)
+            rendered = True
+            try:
+                render()
+            except Exception as err:
+                logging.exception("RenderScheduler error: %s", str(err))
+        if rendered:
+            frame_time = time.perf_counter() - start
+            self.frame_times.append(frame_time)
+            self.frame_rendered.emit(frame_time)
@@ -0,0 +1,238 @@
+import functools
+
+import numpy as np
+
+import constants
+from buffers import RingBuffer
+
+# Blackman window as a sum of cosines, a0 - a1 cos(2 pi m / n) + a2 cos(4 pi m / n)
+BLACKMAN_COEFFICIENTS = (0.42, 0.5, 0.08)
+
+
+@functools.lru_cache(maxsize=None)
+def kaiser_window(n, beta):
+    """
+    Symmetric Kaiser window of `n` samples, the same as
+    ``scipy.signal.windows.kaiser(n, beta)``, computed once per size and
+    shape. The array is read only.
+    """
+    window = np.kaiser(n, beta)
+    window.flags.writeable = False
+    return window
+
+
+@functools.lru_cache(maxsize=None)
+def cosine_window(n, coefficients):
+    """
+    Periodic window of `n` samples defined as a sum of cosines, the same as
+    ``scipy.signal.windows.general_cosine(n, coefficients, sym=False)``,
+    computed once per size and shape. The array is read only.
+    """
+    phase = 2 * np.pi * np.arange(n) / n
+    window = np.zeros(n)
+    for k, a in enumerate(coefficients):
+        window += (-1) ** k * a * np.cos(k * phase)
+    window.flags.writeable = False
+    return window
+
+
+class SpectralEstimator:
+    """
+    Amplitude spectrum of the most recent samples of a signal, limited to the
+    band that is displayed and analysed.
+
+    Like the original per sample FFT, the last `n` samples minus their mean are
+    windowed and transformed with `nfft` points of zero padding, and the
+    amplitude is scaled by ``2 / n``. Only the first `bins` bins are kept.
+    The window and the frequency axis are computed once, and scipy.fft is
+    only imported by the first transform.
+
+    Two modes are available:
+
+    fft
+        A real FFT of the Kaiser windowed block every `hop` samples.
+    sliding
+        A sliding DFT that updates every bin of the band in O(bins) per sample.
+        The window is applied in the frequency domain, so it must be a sum of
+        cosines and a Blackman window is used instead of the Kaiser one. It is
+        scaled to the coherent gain of the Kaiser window, so the peak
+        amplitudes of both modes are comparable. The bins are recomputed from
+        scratch every `n` samples to stop rounding errors from building up.
+
+    With `channels`, the spectra of several signals sampled together, one per
+    sensor, are estimated at once: the samples are columns of `channels`
+    values, all the channels are transformed by the same FFT call, and the
+    magnitude is shaped (channels, bins).
+
+    Parameters
+    ----------
+    n : int, optional
+        Number of samples analysed.
+    nfft : int, optional
+        Length of the zero padded transform. For the sliding mode it must be a
+        multiple of `n`.
+    bins : int, optional
+        Number of bins kept, starting at 0 Hz.
+    period : float, optional
+        Sampling period in seconds.
+    hop : int, optional
+        Number of samples between two transforms in fft mode.
+    mode : {'fft', 'sliding'}, optional
+        The estimation method.
+    beta : float, optional
+        Shape parameter of the Kaiser window.
+    channels : int or None, optional
+        Number of signals, None for a single one.
+    """
+
+    def __init__(self, n=constants.FFT_N1, nfft=constants.FFT_N2, bins=constants.FFT_BINS,
+                 period=constants.SAMPLING_RATE, hop=constants.FFT_HOP, mode=constants.FFT_MODE,
+                 beta=constants.KAISER_WINDOW_BETA, channels=None):
+        if mode not in ('fft', 'sliding'):
+            raise ValueError('invalid mode')
+        if mode == 'sliding' and nfft % n:
+            raise ValueError('nfft must be a multiple of n in sliding mode')
+
+        self.n = n
+        self.nfft = nfft
+        self.bins = bins
+        self.hop = hop
+        self.mode = mode
+        self.channels = channels
+        self.freqs = np.fft.rfftfreq(nfft, period)[:bins]
+        self.window = kaiser_window(n, beta)
+        self._history = RingBuffer(n, rows=channels)
+        self._count = 0
+        self._magnitude = np.zeros(self._shape(bins))
+
+        if mode == 'sliding':
+            # Shift, in zero padded bins, of each cosine term of the window
+            self._shift = nfft // n
+            self._extra = self._shift * (len(BLACKMAN_COEFFICIENTS) - 1)
+            k = np.arange(bins + self._extra)
+            self._rotation = np.exp(2j * np.pi * k / nfft)
+            self._newest = np.exp(-2j * np.pi * k * (n - 1) / nfft)
+            sliding_window = cosine_window(n, BLACKMAN_COEFFICIENTS)
+            self._window_spectrum = np.fft.rfft(sliding_window, nfft)[:bins]
+            self._gain = np.sum(self.window) / np.sum(sliding_window)
+            self._dft = np.zeros(self._shape(bins + self._extra), dtype=np.complex128)
+            self._sum = np.zeros(self._shape(1))
+            self._dirty = False
+
+    @property
+    def ready(self):
+        """
+        True once `n` samples have been analysed.
+        """
+        return self._count >= self.n
+
+    @property
+    def magnitude(self):
+        """
+        The amplitude of the `bins` bins of the last estimate.
+        """
+        if self.mode == 'sliding' and self._dirty:
+            self._magnitude = self._sliding_magnitude()
+            self._dirty = False
+        return self._magnitude
+
+    def reset(self):
+        """
+        Forget the signal history.
+        """
+        self._history.clear()
+        self._count = 0
+        self._magnitude = np.zeros(self._shape(self.bins))
+        if self.mode == 'sliding':
+            self._dft[:] = 0
+            self._sum[:] = 0
+            self._dirty = False
+
+    def push(self, value):
+        """
+        Add one sample, a column of `channels` values with `channels`.
+        Returns True if the spectrum was updated.
+        """
+        if self.mode == 'sliding':
+            return self._slide(value)
+
+        self._history.append(value)
+        self._count += 1
+        if not self.ready or (self._count - self.n) % self.hop:
+            return False
+        self._transform()
+        return True
+
+    def extend(self, values):
+        """
+        Add several samples, shaped (channels, samples) with `channels`. In
+        fft mode at most one spectrum is computed, of the most recent samples,
+        if a transform was due within the block. Returns True if the spectrum
+        was updated.
+        """
+        values = np.asarray(values, dtype=np.float64)
+        values = values.ravel() if self.channels is None else values.reshape(self.channels, -1)
+        if self.mode == 'sliding':
+            updated = False
+            for value in values.T:
+                updated = self._slide(value) or updated
+            return updated
+
+        previous = self._count
+        self._history.extend(values)
+        self._count += values.shape[-1]
+        if not self.ready:
+            return False
+        # Last sample count at which a transform was due
+        due = self._count - (self._count - self.n) % self.hop
+        if due <= previous:
+            return False
+        self._transform()
+        return True
+
+    def _transform(self):
+        from scipy import fft as sp_fft
+        y = self._history.view()
+        yf = sp_fft.rfft((y - np.mean(y, axis=-1, keepdims=True)) * self.window, self.nfft)
+        self._magnitude = 2.0 / self.n * np.abs(yf[..., :self.bins])
+
+    def _slide(self, value):
+        # A column of the channels, shaped (channels, 1) to scale the bins of each channel
+        value = np.reshape(value, self._shape(1))
+        # Copied, the append below overwrites the slot of the oldest sample
+        oldest = np.reshape(np.copy(self._history.view()[..., 0]), self._shape(1)) \
+            if len(self._history) == self.n else 0.0
+        self._history.append(value[..., 0])
+        self._count += 1
+        if self._count % self.n == 0:
+            # Recompute from scratch to drop the accumulated rounding errors
+            from scipy import fft as sp_fft
+            y = self._history.view()
+            self._dft = sp_fft.rfft(y, self.nfft)[..., :self._dft.shape[-1]]
+            self._sum = np.sum(y, axis=-1, keepdims=True)
+        else:
+            self._dft -= oldest
+            self._dft *= self._rotation
+            self._dft += value * self._newest
+            self._sum += value - oldest
+        self._dirty = True
+        return self.ready
+
+    def _shape(self, length):
+        return (length,) if self.channels is None else (self.channels, length)
+
+    def _sliding_magnitude(self):
+        # Multiplying by cos(2 pi r m / n) shifts the spectrum by r * shift bins,
+        # the bins below 0 Hz are the conjugates of the positive ones.
+        dft = np.concatenate((np.conj(self._dft[..., self._extra:0:-1]), self._dft), axis=-1)
+        windowed = np.zeros(self._shape(self.bins), dtype=np.complex128)
+        for r, a in enumerate(BLACKMAN_COEFFICIENTS):
+            shift = r * self._shift
+            if r == 0:
+                windowed += a * dft[..., self._extra:self._extra + self.bins]
+            else:
+                lower = dft[..., self._extra - shift:self._extra - shift + self.bins]
+                upper = dft[..., self._extra + shift:self._extra + shift + self.bins]
+                windowed += (-1) ** r * a / 2 * (lower + upper)
+        windowed -= self._sum / self.n * self._window_spectrum
+        return 2.0 / self.n * self._gain * np.abs(windowed)
@@ -0,0 +1,64 @@
+"""
+Startup profile of the application.
+
+`profile_imports` times every import made by the application itself, the
+modules they import in turn are counted in their time. `report` logs how long
+the application took to reach a point, the window being shown for example,
+and the slowest imports so far. The imports made afterwards, the backends
+loaded on first use, are logged as they happen.
+
+For the details of every module, run Python with ``-X importtime``.
+"""
+import builtins
+import logging
+import sys
+import threading
+import time
+
+START_TIME = time.perf_counter()
+import_times = {}
+
+_import = builtins.__import__
+_state = threading.local()
+_reported = False
+
+
+def _timed_import(name, globals=None, locals=None, fromlist=(), level=0):
+    depth = getattr(_state, 'depth', 0)
+    if depth > 0:
+        return _import(name, globals, locals, fromlist, level)
+    modules = len(sys.modules)
+    start = time.perf_counter()
+    _state.depth = 1
+    try:
+        return _import(name, globals, locals, fromlist, level)
+    finally:
+        _state.depth = 0
+        # Only the imports that loaded something are recorded
+        if len(sys.modules) > modules:
+            elapsed = time.perf_counter() - start
+            statement = name + (" import " + ", ".join(fromlist) if fromlist else "")
+            import_times[statement] = import_times.get(statement, 0.0) + elapsed
+            if _reported:
+                logging.debug("[Import] {0}: {1:.3f}s".format(statement, elapsed))
+
+
+def profile_imports():
+    """
+    Start timing the imports. Must be called before the modules to profile
+    are imported.
+    """
+    builtins.__import__ = _timed_import
+
+
+def report(event, count=10):
+    """
+    Log the time since the start of the application and the `count` slowest
+    imports so far.
+    """
+    global _reported
+    _reported = True
+    logging.info("[Startup] {0} after {1:.3f}s".format(event, time.perf_counter() - START_TIME))
+    slowest = sorted(import_times.items(), key=lambda item: item[1], reverse=True)[:count]
+    for statement, elapsed in slowest:
+        logging.info("[Startup] import {0}: {1:.3f}s".format(statement, elapsed))
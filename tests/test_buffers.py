@@ -0,0 +1,50 @@
+import numpy as np
+import pytest
+
+import buffers
+
+
+def test_ring_buffer_keeps_the_latest_values():
+    ring = buffers.RingBuffer(5)
+    ring.extend(np.arange(3))
+    ring.append(3)
+    ring.extend(np.arange(4, 12))
+    np.testing.assert_array_equal(ring.view(), np.arange(7, 12))
+    ring.append(12)
+    np.testing.assert_array_equal(ring.view(), np.arange(8, 13))
+    assert len(ring) == ring.capacity == 5
+
+
+def test_ring_buffer_unbounded_and_resize():
+    ring = buffers.RingBuffer()
+    ring.extend(np.arange(100))
+    assert ring.capacity is None
+    np.testing.assert_array_equal(ring.view(), np.arange(100))
+    ring.resize(10)
+    np.testing.assert_array_equal(ring.view(), np.arange(90, 100))
+    ring.clear()
+    assert len(ring) == 0
+
+
+def test_ring_buffer_rows():
+    ring = buffers.RingBuffer(4, rows=2)
+    ring.extend(np.arange(12).reshape(2, 6))
+    ring.append([100, 200])
+    np.testing.assert_array_equal(ring.view(), [[3, 4, 5, 100], [9, 10, 11, 200]])
+
+
+@pytest.mark.parametrize('start, stop, points', [(0, 10000, 50), (123, 7777, 40), (5000, 5100, 500), (0, 37, 3)])
+def test_min_max_pyramid_keeps_the_extremes(start, stop, points):
+    rng = np.random.default_rng(4)
+    values = rng.standard_normal(10000)
+    values[4321] = 50
+    values[1234] = np.nan
+    pyramid = buffers.MinMaxPyramid()
+    # Synced while the series grows, like the plot
+    for end in (100, 2500, 10000):
+        pyramid.sync(values[:end])
+    index, y = pyramid.query(values, start, stop, points)
+    assert len(y) <= 2 * points + 2 or stop - start <= points * pyramid.factor
+    assert np.nanmax(y) == np.nanmax(values[start:stop])
+    assert np.nanmin(y) == np.nanmin(values[start:stop])
+    assert index[0] <= start + pyramid.factor and np.all(np.diff(index) >= 0)
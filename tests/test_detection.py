@@ -0,0 +1,77 @@
+import numpy as np
+import pytest
+from scipy.optimize import curve_fit
+
+import detection
+
+
+def fitted_slope(y):
+    x = np.linspace(0, len(y), len(y))
+    popt, _ = curve_fit(lambda fx, fa, fb: fa + fb * fx, x, y)
+    return popt[1]
+
+
+@pytest.fixture
+def signal():
+    rng = np.random.default_rng(1)
+    return np.cumsum(rng.standard_normal(300)) + np.linspace(0, 30, 300)
+
+
+def test_sliding_slope_matches_curve_fit(signal):
+    n = 40
+    slope = detection.SlidingSlope(n)
+    for i, value in enumerate(signal):
+        result = slope.push(value)
+        if i < n - 1:
+            assert np.isnan(result)
+        elif i % 37 == 0 or i == len(signal) - 1:
+            assert result == pytest.approx(fitted_slope(signal[i - n + 1:i + 1]), rel=1e-5, abs=1e-7)
+
+
+def test_sliding_slope_rows_match_single_rows(signal):
+    n = 25
+    rows = np.vstack((signal, -2 * signal[::-1]))
+    together = detection.SlidingSlope(n, rows=2)
+    together.extend(rows)
+    for row, expected in zip(rows, together.slope):
+        single = detection.SlidingSlope(n)
+        single.extend(row)
+        assert single.slope == pytest.approx(expected)
+
+
+def test_rolling_slope_matches_sliding_slope(signal):
+    n = 30
+    slope = detection.SlidingSlope(n)
+    expected = [slope.push(value) for value in signal][n - 1:]
+    np.testing.assert_allclose(detection.rolling_slope(signal, n), expected, rtol=1e-9, atol=1e-12)
+
+
+def curve_fit_segments(y, n, start_threshold, stop_threshold):
+    # The loop of the report before the vectorized segmentation
+    detected, start, stop = False, 0, 0
+    for i in range(len(y) - n):
+        cut = y[i - n:i]
+        if len(cut) < n:
+            continue
+        b = fitted_slope(cut)
+        if b < start_threshold and not detected:
+            detected, start = True, i
+        if b > stop_threshold:
+            if detected:
+                stop = i
+            break
+    return start, stop
+
+
+@pytest.mark.parametrize('levels', [
+    (0, -1, 1),     # flow starts then stops
+    (0, -1, -1),    # flow never stops
+    (0, 0, 0),      # no flow
+    (0, 1, 0),      # stops without having started
+])
+def test_segment_flow_matches_curve_fit_loop(levels):
+    n = 20
+    slopes = np.repeat(levels, 60) * 0.5
+    rng = np.random.default_rng(2)
+    y = np.cumsum(slopes) + 0.01 * rng.standard_normal(len(slopes))
+    assert detection.segment_flow(y, n, -0.2, 0.2) == curve_fit_segments(y, n, -0.2, 0.2)
@@ -0,0 +1,34 @@
+import numpy as np
+import pytest
+
+import filters
+
+
+@pytest.mark.parametrize('ftypes', ['iir', 'fir', ('fir', 'iir', 'iir')])
+def test_decimator_blocks_are_one_continuous_signal(ftypes):
+    rng = np.random.default_rng(3)
+    x = rng.standard_normal((2, 20000))
+    whole = filters.Decimator(ftypes=ftypes)(x)
+    blocked = filters.Decimator(ftypes=ftypes)
+    parts = [blocked(x[:, start:start + 1000]) for start in range(0, x.shape[1], 1000)]
+    assert whole.shape == (2, 20)
+    np.testing.assert_allclose(np.concatenate(parts, axis=1), whole, atol=1e-12)
+
+
+def test_decimator_keeps_a_constant_and_resets():
+    decimator = filters.Decimator()
+    assert decimator.factor == 1000
+    for _ in range(20):
+        y = decimator(np.full(1000, 2.5))
+    assert y.shape == (1,)
+    assert y[0] == pytest.approx(2.5, abs=1e-3)
+    decimator.reset()
+    fresh = filters.Decimator()
+    np.testing.assert_array_equal(decimator(np.ones(1000)), fresh(np.ones(1000)))
+
+
+def test_decimator_invalid_stage():
+    with pytest.raises(ValueError):
+        filters.Decimator(factors=(10, 10), ftypes=('iir',))
+    with pytest.raises(ValueError):
+        filters.Decimator(ftypes='median')
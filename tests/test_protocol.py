@@ -0,0 +1,164 @@
+import numpy as np
+import pytest
+
+import protocol
+
+
+def serial_frame(counter, channels=2, samples=3):
+    return protocol.encode_serial_frame(counter, np.arange(channels * samples).reshape(channels, samples) + counter)
+
+
+def counters(frames):
+    return [counter for counter, _ in frames]
+
+
+def test_serial_false_sync_in_payload_does_not_stall():
+    decoder = protocol.SerialDecoder('binary')
+    # A sync word followed by a header within the limits, announcing a frame much longer than the stream
+    false_sync = protocol.SERIAL_SYNC + np.array([(1, 8, protocol.SERIAL_MAX_SAMPLES, 0)],
+                                                 dtype=protocol.FRAME_HEADER).tobytes()
+    frames, _ = decoder.feed(serial_frame(1) + false_sync + serial_frame(2) + serial_frame(3))
+    assert counters(frames) == [1, 2, 3]
+    assert decoder.resyncs == 1
+    assert decoder.skipped == len(false_sync)
+
+
+def test_serial_header_out_of_limits_rejected_at_once():
+    decoder = protocol.SerialDecoder('binary', max_samples=16)
+    too_long = protocol.SERIAL_SYNC + np.array([(1, 2, 17, 0)], dtype=protocol.FRAME_HEADER).tobytes()
+    frames, _ = decoder.feed(too_long + serial_frame(1))
+    assert counters(frames) == [1]
+    assert decoder.resyncs == 1
+
+
+def test_serial_corrupt_frame_skipped():
+    decoder = protocol.SerialDecoder('binary')
+    corrupt = bytearray(serial_frame(1))
+    corrupt[-6] ^= 0xff
+    frames, _ = decoder.feed(bytes(corrupt) + serial_frame(2))
+    assert counters(frames) == [2]
+    assert decoder.resyncs == 1
+    assert decoder.skipped == len(corrupt)
+
+
+def test_serial_truncated_frame_waits_for_the_rest():
+    decoder = protocol.SerialDecoder('binary')
+    frame = serial_frame(1)
+    assert decoder.feed(frame[:5]) == ([], [])
+    assert decoder.feed(frame[5:-1]) == ([], [])
+    frames, _ = decoder.feed(frame[-1:] + serial_frame(2))
+    assert counters(frames) == [1, 2]
+    np.testing.assert_array_equal(frames[0][1], [[1, 2, 3], [4, 5, 6]])
+    assert decoder.resyncs == 0
+
+
+def test_serial_truncated_frame_followed_by_valid_frame():
+    decoder = protocol.SerialDecoder('binary')
+    frames, _ = decoder.feed(serial_frame(1)[:-3] + serial_frame(2) + serial_frame(3))
+    assert counters(frames) == [2, 3]
+
+
+def test_serial_auto_mode_keeps_text_before_first_frame():
+    decoder = protocol.SerialDecoder()
+    frames, messages = decoder.feed(b'Received 1 2 3.5\nboot\npartial' + serial_frame(7))
+    assert frames[0][0] is None
+    np.testing.assert_array_equal(frames[0][1], [[3.5]])
+    assert counters(frames[1:]) == [7]
+    assert messages == ['boot']
+    assert decoder.mode == 'binary'
+
+
+def test_frame_round_trip():
+    samples = np.arange(8, dtype=np.float32).reshape(2, 4)
+    counter, decoded = protocol.decode_frame(protocol.encode_frame(2**32 + 5, samples))
+    assert counter == 5
+    np.testing.assert_array_equal(decoded, samples)
+
+
+def test_frame_capacity_fits_the_mtu():
+    count = protocol.frame_capacity(247)
+    frame = protocol.encode_frame(0, np.zeros((2, count)))
+    assert len(frame) <= 247 - protocol.ATT_OVERHEAD
+    assert len(frame) + 8 > 247 - protocol.ATT_OVERHEAD
+
+
+def test_frame_truncated_or_wrong_version_rejected():
+    frame = protocol.encode_frame(1, np.ones((2, 3)))
+    with pytest.raises(ValueError):
+        protocol.decode_frame(frame[:-1])
+    with pytest.raises(ValueError):
+        protocol.decode_frame(bytes([protocol.FRAME_VERSION + 1]) + frame[1:])
+
+
+def test_legacy_packets():
+    counter, values = protocol.decode_legacy(np.array([7, 1, 2, 3], dtype=np.float32).tobytes())
+    assert counter == 7
+    np.testing.assert_array_equal(values, [1, 2, 3])
+    counter, values = protocol.decode_legacy(np.array([1.5], dtype=np.float32).tobytes())
+    assert counter is None
+    np.testing.assert_array_equal(values, [1.5])
+
+
+def test_serial_frames_split_across_reads():
+    stream = b''.join(serial_frame(counter) for counter in range(5))
+    decoder = protocol.SerialDecoder('binary')
+    frames = []
+    for start in range(0, len(stream), 7):
+        frames += decoder.feed(stream[start:start + 7])[0]
+    assert counters(frames) == list(range(5))
+    assert decoder.frames == 5
+    assert decoder.skipped == 0
+
+
+def test_serial_text_mode():
+    decoder = protocol.SerialDecoder('text')
+    frames, messages = decoder.feed(b'Received 1 2 0.25\r\nReceived 1 2 0.5\nready\nReceived 1 2')
+    np.testing.assert_array_equal(frames[0][1], [[0.25, 0.5]])
+    assert messages == ['ready']
+    frames, _ = decoder.feed(b' 0.75\n')
+    np.testing.assert_array_equal(frames[0][1], [[0.75]])
+
+
+def test_tracker_interpolates_lost_packets():
+    tracker = protocol.SequenceTracker()
+    np.testing.assert_array_equal(tracker.push(0, [[0.0, 1.0]], now=0), [[0.0, 1.0]])
+    np.testing.assert_allclose(tracker.push(2, [[4.0, 5.0]], now=1), [[2.0, 3.0, 4.0, 5.0]])
+    assert (tracker.lost, tracker.filled, tracker.samples) == (1, 2, 6)
+
+
+def test_tracker_nan_fill_and_long_gaps():
+    tracker = protocol.SequenceTracker(fill='nan', max_gap=4)
+    tracker.push(0, [[1.0, 1.0]], now=0)
+    assert np.isnan(tracker.push(2, [[1.0, 1.0]], now=1)[0, :2]).all()
+    assert tracker.push(10, [[1.0, 1.0]], now=2).shape == (1, 2)
+    assert tracker.lost == 8
+    assert tracker.filled == 2
+
+
+def test_tracker_duplicated_and_late_packets():
+    tracker = protocol.SequenceTracker()
+    tracker.push(0, [[0.0]], now=0)
+    tracker.push(2, [[2.0]], now=1)
+    assert tracker.push(2, [[2.0]], now=2) is None
+    assert tracker.push(1, [[1.0]], now=3) is None
+    assert tracker.push(1, [[1.0]], now=4) is None
+    metrics = tracker.metrics(now=5)
+    assert (metrics['lost'], metrics['duplicated'], metrics['out_of_order']) == (0, 2, 1)
+    assert metrics['packets'] == 2
+
+
+def test_tracker_counter_wrap_around():
+    tracker = protocol.SequenceTracker(modulus=2**32)
+    tracker.push(2**32 - 2, [[0.0]], now=0)
+    tracker.push(2**32 - 1, [[0.0]], now=1)
+    tracker.push(0, [[0.0]], now=2)
+    assert tracker.lost == 0
+    tracker.push(2, [[0.0]], now=3)
+    assert (tracker.lost, tracker.restarts) == (1, 0)
+
+
+def test_tracker_restart():
+    tracker = protocol.SequenceTracker(history=16)
+    tracker.push(1000, [[0.0]], now=0)
+    assert tracker.push(0, [[1.0]], now=1) is not None
+    assert (tracker.restarts, tracker.lost) == (1, 0)
@@ -0,0 +1,81 @@
+import numpy as np
+import pandas as pd
+
+import buffers
+import recording
+
+
+def sample_frame(rows, start=0):
+    store = buffers.SampleStore(capacity=4)
+    index = np.arange(start, start + rows)
+    store.extend(index, index / 10, np.sin(index), np.cos(index), 20 + index / 100)
+    return store.to_dataframe()
+
+
+def test_raw_round_trip(tmp_path):
+    path = str(tmp_path / 'capture.fsraw')
+    writer = recording.RawWriter(path, ['ai1', 'ai0'], 10000.0, chunk_samples=16, chunks=2)
+    blocks = [np.arange(2 * n, dtype=np.float64).reshape(2, n) + 100 * n for n in (5, 40, 3)]
+    for block in blocks:
+        writer.write(block)
+    writer.close()
+
+    header, samples = recording.read_raw(path)
+    assert header['channels'] == ['ai1', 'ai0']
+    assert header['sample_rate'] == 10000.0
+    assert writer.samples == 48
+    np.testing.assert_array_equal(samples, np.concatenate(blocks, axis=1).T.astype(np.float32))
+
+
+def test_raw_partial_frame_left_out(tmp_path):
+    path = str(tmp_path / 'capture.fsraw')
+    writer = recording.RawWriter(path, ['ai1', 'ai0'], 10000.0)
+    writer.write(np.ones((2, 3)))
+    writer.close()
+    with open(path, 'ab') as file:
+        file.write(b'\x00\x00')
+    _, samples = recording.read_raw(path)
+    assert samples.shape == (3, 2)
+
+
+def test_recording_round_trip(tmp_path):
+    frame = sample_frame(50)
+    metadata = {'channel': 1, 'sensor_id': 'S1'}
+    path = str(tmp_path / 'data.parquet')
+    recording.write_recording(frame, path, metadata)
+    loaded, loaded_metadata = recording.read_recording(path)
+    pd.testing.assert_frame_equal(loaded, frame)
+    assert loaded_metadata == metadata
+
+    path = str(tmp_path / 'data.csv')
+    recording.write_recording(frame, path, metadata)
+    loaded, loaded_metadata = recording.read_recording(path)
+    pd.testing.assert_frame_equal(loaded, frame)
+    assert loaded_metadata is None
+
+
+def test_recording_loader_chunks(tmp_path):
+    frame = sample_frame(25)
+    for name in ('data.parquet', 'data.csv'):
+        path = str(tmp_path / name)
+        recording.write_recording(frame, path)
+        loader = recording.RecordingLoader(path, chunk_rows=10)
+        assert loader.progress == 0.0
+        chunks = list(loader)
+        np.testing.assert_allclose(np.concatenate(chunks), frame['flow_voltage'])
+        assert loader.progress == 1.0
+
+
+def test_segment_writer_rotation(tmp_path):
+    for suffix in (' data1.parquet', ' data1.csv'):
+        writer = recording.SegmentWriter(str(tmp_path) + '/', suffix, rotate_rows=20, metadata={'channel': 1})
+        frames = [sample_frame(10, start) for start in range(0, 50, 10)]
+        for frame in frames:
+            writer.write(frame)
+        writer.close()
+        assert writer.error is None
+        assert writer.rows == 50
+        # Rotations within one second still give distinct segments
+        assert len(writer.paths) == len(set(writer.paths)) == 3
+        loaded = pd.concat([recording.read_recording(path)[0] for path in writer.paths], ignore_index=True)
+        pd.testing.assert_frame_equal(loaded, pd.concat(frames, ignore_index=True))
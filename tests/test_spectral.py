@@ -0,0 +1,17 @@
+import numpy as np
+import pytest
+
+import spectral
+
+
+@pytest.mark.parametrize('channels', [None, 2])
+def test_sliding_dft_matches_rfft_of_history(channels):
+    estimator = spectral.SpectralEstimator(mode='sliding', channels=channels)
+    rng = np.random.default_rng(0)
+    shape = (estimator.n + 500,) if channels is None else (channels, estimator.n + 500)
+    estimator.extend(rng.standard_normal(shape))
+
+    history = estimator._history.view()
+    expected = np.fft.rfft(history, estimator.nfft)[..., :estimator._dft.shape[-1]]
+    np.testing.assert_allclose(estimator._dft, expected, atol=1e-8)
+    np.testing.assert_allclose(estimator._sum[..., 0], np.sum(history, axis=-1))